@@ -0,0 +1,37 @@
+"""incremental auto_vacuum
+
+Revision ID: 2c5e81b7a946
+Revises: e7a2c4d9f013
+Create Date: 2026-10-19 16:21:09.730562
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "2c5e81b7a946"
+down_revision: Union[str, None] = "e7a2c4d9f013"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Changing auto_vacuum on an existing database only takes effect after a
+    # full VACUUM, which can't run inside a transaction. This rebuilds the
+    # file once; from then on free pages are returned by the maintenance
+    # task with PRAGMA incremental_vacuum.
+    with op.get_context().autocommit_block():
+        op.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        op.execute("VACUUM")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        op.execute("PRAGMA auto_vacuum=NONE")
+        op.execute("VACUUM")
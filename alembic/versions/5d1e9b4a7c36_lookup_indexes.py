@@ -0,0 +1,42 @@
+"""user key, deleted_at and outbox done_at indexes
+
+Revision ID: 5d1e9b4a7c36
+Revises: 2c5e81b7a946
+Create Date: 2026-10-19 16:21:07.402913
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = "5d1e9b4a7c36"
+down_revision: Union[str, None] = "2c5e81b7a946"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index("idx_user_user_key", "user", ["user_key"])
+    op.create_index(
+        "idx_user_deleted_at",
+        "user",
+        ["deleted_at"],
+        sqlite_where=sa.text("deleted_at IS NOT NULL"),
+    )
+    op.create_index(
+        "idx_outbox_done_at",
+        "outbox",
+        ["done_at"],
+        sqlite_where=sa.text("done_at IS NOT NULL"),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("idx_outbox_done_at")
+    op.drop_index("idx_user_deleted_at")
+    op.drop_index("idx_user_user_key")
@@ -0,0 +1,32 @@
+"""user dashboard_version
+
+Revision ID: 8f3b6c1d4a27
+Revises: 5d1e9b4a7c36
+Create Date: 2026-10-19 17:48:31.220175
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision: str = "8f3b6c1d4a27"
+down_revision: Union[str, None] = "5d1e9b4a7c36"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column(
+        "user",
+        sa.Column("dashboard_version", sa.Integer, nullable=False, server_default="0"),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table("user") as batch_op:
+        batch_op.drop_column("dashboard_version")
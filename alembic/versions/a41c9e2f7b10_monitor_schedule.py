@@ -0,0 +1,32 @@
+"""monitor cron schedule
+
+Revision ID: a41c9e2f7b10
+Revises: 04b9027329c0
+Create Date: 2026-10-19 09:12:31.402118
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "a41c9e2f7b10"
+down_revision: Union[str, None] = "04b9027329c0"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column("monitor", sa.Column("schedule", sa.Text(), nullable=True))
+    op.add_column("monitor", sa.Column("grace", sa.Integer(), nullable=True))
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.batch_alter_table("monitor") as bop:
+        bop.drop_column("grace")
+        bop.drop_column("schedule")
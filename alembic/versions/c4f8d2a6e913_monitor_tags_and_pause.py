@@ -0,0 +1,49 @@
+"""monitor tags and pause
+
+Revision ID: c4f8d2a6e913
+Revises: b3e7a91c5d20
+Create Date: 2026-10-19 20:11:07.902664
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "c4f8d2a6e913"
+down_revision: Union[str, None] = "b3e7a91c5d20"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column("monitor", sa.Column("paused_until", sa.Integer(), nullable=True))
+    # The expiry scan filters paused monitors on the index entries
+    op.drop_index("idx_expires_at")
+    op.create_index(
+        "idx_expires_at_paused_until", "monitor", ["expires_at", "paused_until"]
+    )
+    op.create_table(
+        "monitor_tag",
+        sa.Column("user_id", sa.Integer(), nullable=False),
+        sa.Column("tag", sa.Text(), nullable=False),
+        sa.Column("monitor_id", sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(["monitor_id"], ["monitor.id"]),
+        sa.PrimaryKeyConstraint("user_id", "tag", "monitor_id"),
+        sqlite_with_rowid=False,
+    )
+    op.create_index("idx_monitor_tag_monitor_id", "monitor_tag", ["monitor_id"])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("idx_monitor_tag_monitor_id")
+    op.drop_table("monitor_tag")
+    op.drop_index("idx_expires_at_paused_until")
+    op.create_index("idx_expires_at", "monitor", ["expires_at"])
+    with op.batch_alter_table("monitor") as batch_op:
+        batch_op.drop_column("paused_until")
@@ -0,0 +1,39 @@
+"""add data_migration table
+
+Revision ID: d2b6f0e8a351
+Revises: c4f8d2a6e913
+Create Date: 2026-10-19 22:41:53.318204
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "d2b6f0e8a351"
+down_revision: Union[str, None] = "c4f8d2a6e913"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "data_migration",
+        sa.Column("name", sa.Text(), nullable=False),
+        sa.Column("cursor", sa.Integer(), nullable=True),
+        sa.Column("rows", sa.Integer(), server_default="0", nullable=False),
+        sa.Column("batches", sa.Integer(), server_default="0", nullable=False),
+        sa.Column("started_at", sa.Integer(), nullable=True),
+        sa.Column("finished_at", sa.Integer(), nullable=True),
+        sa.PrimaryKeyConstraint("name"),
+        sqlite_with_rowid=False,
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table("data_migration")
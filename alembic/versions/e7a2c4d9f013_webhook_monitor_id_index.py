@@ -0,0 +1,29 @@
+"""webhook monitor_id index
+
+Revision ID: e7a2c4d9f013
+Revises: 6b0f3d8e51c2
+Create Date: 2026-10-19 14:02:45.118304
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "e7a2c4d9f013"
+down_revision: Union[str, None] = "6b0f3d8e51c2"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_index("idx_webhook_monitor_id", "webhook", ["monitor_id"])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("idx_webhook_monitor_id")
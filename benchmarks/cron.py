@@ -0,0 +1,92 @@
+"""Next-fire computation for scheduled monitors.
+
+Usage: python -m benchmarks.cron [--monitors N] [--schedules N] [--batch N]
+
+Simulates pings for N monitors spread over a pool of distinct cron
+expressions, in batches, the way update_monitor computes expires_at. The
+first pass starts with empty caches; the second is a steady-state minute
+where every schedule has already been evaluated once.
+"""
+
+import argparse
+import random
+import statistics
+import time
+
+from restarter import cron
+
+
+def make_schedules(count, rnd):
+    templates = [
+        "{m} {h} * * *",
+        "{m} {h} * * 1-5",
+        "*/{s} * * * *",
+        "{m} */{hs} * * *",
+        "{m} {h} 1 * *",
+        "{m} {h} * * sun",
+    ]
+    schedules = set()
+    while len(schedules) < count:
+        schedules.add(
+            rnd.choice(templates).format(
+                m=rnd.randrange(60),
+                h=rnd.randrange(24),
+                s=rnd.choice([5, 10, 15, 20, 30]),
+                hs=rnd.choice([2, 3, 4, 6, 12]),
+            )
+        )
+    return sorted(schedules)
+
+
+def run(monitors, batch, now):
+    timings = []
+    for start in range(0, len(monitors), batch):
+        t0 = time.perf_counter()
+        for expr in monitors[start : start + batch]:
+            cron.next_fire(expr, now)
+        timings.append(time.perf_counter() - t0)
+    return timings
+
+
+def report(label, timings, batch):
+    ms = [t * 1000 for t in timings]
+    print(
+        f"{label}: {len(ms)} batches of {batch}, total {sum(ms):.1f} ms, "
+        f"median {statistics.median(ms):.3f} ms, max {max(ms):.3f} ms per batch"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--monitors", type=int, default=100_000)
+    parser.add_argument("--schedules", type=int, default=500)
+    parser.add_argument("--batch", type=int, default=1000)
+    args = parser.parse_args()
+
+    rnd = random.Random(42)
+    schedules = make_schedules(args.schedules, rnd)
+    monitors = [rnd.choice(schedules) for _ in range(args.monitors)]
+    now = time.time()
+
+    report("cold caches", run(monitors, args.batch, now), args.batch)
+    report("warm caches", run(monitors, args.batch, now + 1), args.batch)
+
+    # Worst case: every monitor has its own schedule and nothing is cached.
+    # Schedules are parsed when a monitor is created, so time that apart.
+    cron._next_fire_after_minute.cache_clear()
+    unique = make_schedules(args.batch, rnd)
+    t0 = time.perf_counter()
+    for expr in unique:
+        cron.parse(expr)
+    t1 = time.perf_counter()
+    for expr in unique:
+        cron.next_fire(expr, now)
+    t2 = time.perf_counter()
+    print(
+        f"uncached, {args.batch} distinct schedules: "
+        f"parse {(t1 - t0) * 1000:.1f} ms, next fire {(t2 - t1) * 1000:.1f} ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""Ping and expiry-scan queries: SQLAlchemy Core versus restarter.hotpath.
+
+Usage: python -m benchmarks.hotpath [--monitors N] [--pings N] [--expired N]
+
+Fills a scratch database with N monitors, each with a webhook, then times
+the same work through the previous SQLAlchemy implementations (reproduced
+below) and through the hot-path module:
+
+- sequential pings of random monitors
+- the expiry scan with `--expired` monitors past their deadline
+- queueing one delivery per expired webhook, which marks them called
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from contextlib import closing
+from datetime import UTC, datetime
+
+import sqlalchemy as sa
+
+from restarter import app, database, hotpath
+from restarter.database import get_engine, next_deadline, text
+
+
+async def sa_update_monitor(key):
+    query = (
+        "UPDATE monitor SET last_check=:now, "
+        "expires_at=:now_ts + frequency "
+        "WHERE api_key=:key "
+        "RETURNING monitor.id, monitor.schedule, monitor.grace"
+    )
+    now_ts = datetime.now(UTC).timestamp()
+    async with get_engine().begin() as conn:
+        result = await conn.execute(
+            text(query), {"now": datetime.now(UTC), "key": key, "now_ts": now_ts}
+        )
+        value = result.fetchone()
+        if not value:
+            return None
+        if value.schedule:
+            await conn.execute(
+                text("UPDATE monitor SET expires_at=:ea WHERE id=:id"),
+                {
+                    "ea": next_deadline(now_ts, 0, value.schedule, value.grace),
+                    "id": value.id,
+                },
+            )
+        await conn.execute(
+            text("UPDATE webhook SET last_called=NULL WHERE monitor_id=:id"),
+            {"id": value.id},
+        )
+        return value.id
+
+
+async def sa_get_expired_monitors():
+    query = (
+        "SELECT monitor.id as mid,monitor.user_id,monitor.name,monitor.slug,"
+        "monitor.expires_at,webhook.id as wid,webhook.url,"
+        "webhook.method,webhook.headers, "
+        "webhook.form_fields, webhook.body_payload "
+        "FROM monitor LEFT JOIN webhook ON  monitor.id=webhook.monitor_id "
+        "WHERE expires_at < :when AND webhook.last_called IS NULL"
+    )
+    when = datetime.now(UTC).timestamp()
+    async with get_engine().connect() as conn:
+        result = await conn.execute(text(query), {"when": when})
+        rows = result.mappings().fetchall()
+    await get_engine().dispose()
+    return rows
+
+
+async def sa_enqueue_deliveries(deliveries):
+    now_ts = datetime.now(UTC).timestamp()
+    touch = text(
+        "UPDATE webhook SET last_called=:now_ts "
+        "WHERE id IN :wids AND last_called IS NULL RETURNING id"
+    ).bindparams(sa.bindparam("wids", expanding=True))
+    insert = text(
+        "INSERT INTO outbox (webhook_ids, url, method, headers, form_fields, "
+        "created_at, available_at) VALUES (:wi, :url, :me, :he, :fo, :now, :now)"
+    )
+    queued = 0
+    async with get_engine().begin() as conn:
+        for delivery in deliveries:
+            result = await conn.execute(
+                touch, {"now_ts": now_ts, "wids": list(delivery["webhook_ids"])}
+            )
+            claimed = [row.id for row in result.fetchall()]
+            if not claimed:
+                continue
+            await conn.execute(
+                insert,
+                {
+                    "wi": json.dumps(claimed),
+                    "url": delivery["url"],
+                    "me": delivery["method"],
+                    "he": json.dumps(delivery["headers"]),
+                    "fo": json.dumps(delivery["form_fields"]),
+                    "now": now_ts,
+                },
+            )
+            queued += 1
+    await get_engine().dispose()
+    return queued
+
+
+IMPLEMENTATIONS = {
+    "sqlalchemy": (sa_update_monitor, sa_get_expired_monitors, sa_enqueue_deliveries),
+    "hotpath": (
+        hotpath.update_monitor,
+        hotpath.get_expired_monitors,
+        hotpath.enqueue_deliveries,
+    ),
+}
+
+
+def populate(dbfile, monitors):
+    with closing(sqlite3.connect(dbfile)) as conn:
+        conn.execute(
+            "INSERT INTO user (id, email, password, user_key) "
+            "VALUES (1, 'bench@example.com', 'x', 'bench')"
+        )
+        conn.executemany(
+            "INSERT INTO monitor (id, user_id, name, slug, frequency, expires_at, "
+            "api_key) VALUES (?, 1, ?, ?, 3600, 4102444800, ?)",
+            ((i, f"monitor {i}", f"m{i}", f"K{i}") for i in range(monitors)),
+        )
+        conn.executemany(
+            "INSERT INTO webhook (id, monitor_id, url, method, form_fields) "
+            "VALUES (?, ?, 'https://example.com/hook', 'post', '{}')",
+            ((i, i) for i in range(monitors)),
+        )
+        conn.commit()
+
+
+def expire(dbfile, count):
+    with closing(sqlite3.connect(dbfile)) as conn:
+        conn.execute("UPDATE webhook SET last_called=NULL")
+        conn.execute("UPDATE monitor SET expires_at=0 WHERE id < ?", (count,))
+        conn.execute("DELETE FROM outbox")
+        conn.commit()
+
+
+def deliveries(rows):
+    return [
+        {
+            "webhook_ids": [row["wid"]],
+            "url": row["url"],
+            "method": row["method"],
+            "headers": {},
+            "form_fields": {},
+        }
+        for row in rows
+    ]
+
+
+def report(label, timings):
+    us = sorted(t * 1e6 for t in timings)
+    p99 = us[min(len(us) - 1, int(len(us) * 0.99))]
+    print(
+        f"  {label}: median {statistics.median(us):,.0f} us, "
+        f"p99 {p99:,.0f} us, total {sum(us) / 1000:,.1f} ms over {len(us)}"
+    )
+
+
+async def bench(name, dbfile, args):
+    update_monitor, get_expired_monitors, enqueue_deliveries = IMPLEMENTATIONS[name]
+    rnd = random.Random(42)
+    print(name)
+
+    timings = []
+    for _ in range(args.pings):
+        key = f"K{rnd.randrange(args.monitors)}"
+        start = time.perf_counter()
+        assert await update_monitor(key)
+        timings.append(time.perf_counter() - start)
+    report("ping", timings)
+
+    scans, touches = [], []
+    for _ in range(args.rounds):
+        expire(dbfile, args.expired)
+        start = time.perf_counter()
+        rows = await get_expired_monitors()
+        scans.append(time.perf_counter() - start)
+        assert len(rows) == args.expired
+        batch = deliveries(rows)
+        start = time.perf_counter()
+        assert await enqueue_deliveries(batch) == args.expired
+        touches.append(time.perf_counter() - start)
+    report(f"scan, {args.expired} expired", scans)
+    report(f"queue {args.expired} deliveries", touches)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--monitors", type=int, default=10_000)
+    parser.add_argument("--pings", type=int, default=2000)
+    parser.add_argument("--expired", type=int, default=1000)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        dbfile = os.path.join(tmp, "bench.db")
+        app.config["DATABASE"] = dbfile
+        async with get_engine().begin() as conn:
+            await conn.run_sync(database.meta.create_all)
+        await get_engine().dispose()
+        populate(dbfile, args.monitors)
+        for name in IMPLEMENTATIONS:
+            await bench(name, dbfile, args)
+        await hotpath.close()
+        await get_engine().dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
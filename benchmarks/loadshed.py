@@ -0,0 +1,136 @@
+"""Pings while another connection holds the write lock, with and without shedding.
+
+Usage: python -m benchmarks.loadshed [--monitors N] [--rate N] [--seconds N]
+                                     [--lock-seconds N] [--client-timeout N]
+
+Sends pings at a steady `--rate` per second for `--seconds`, through the
+ASGI app (no sockets), while a separate sqlite3 connection holds the write
+lock for `--lock-seconds` in the middle, the way a backup or migration
+would. Clients give up after `--client-timeout`. Runs once with the default
+admission limits and once with them effectively off, and reports status
+counts, latency of the successful pings, and the most requests that were
+queued at once (what the worker holds in memory).
+"""
+
+import argparse
+import asyncio
+import os
+import sqlite3
+import tempfile
+import time
+from collections import Counter
+from contextlib import closing
+
+import httpx
+
+from restarter import admission, app, attempts, database, hotpath
+from restarter.database import get_engine
+
+
+def populate(dbfile, monitors):
+    with closing(sqlite3.connect(dbfile)) as conn:
+        conn.execute(
+            "INSERT INTO user (id, email, password, user_key) "
+            "VALUES (1, 'bench@example.com', 'x', 'bench')"
+        )
+        conn.executemany(
+            "INSERT INTO monitor (id, user_id, name, slug, frequency, expires_at, "
+            "api_key) VALUES (?, 1, ?, ?, 3600, 0, ?)",
+            ((i + 1, f"monitor {i}", f"m-{i}", f"K{i}") for i in range(monitors)),
+        )
+        conn.commit()
+
+
+def hold_write_lock(dbfile, start, duration):
+    time.sleep(start)
+    with closing(sqlite3.connect(dbfile, isolation_level=None)) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        time.sleep(duration)
+        conn.execute("COMMIT")
+
+
+async def ping(client, key, timeout, results):
+    start = time.perf_counter()
+    try:
+        response = await asyncio.wait_for(
+            client.post(f"/monitor/MK{key}"), timeout=timeout
+        )
+        outcome = response.status_code
+    except TimeoutError:
+        outcome = "timeout"
+    results.append((outcome, time.perf_counter() - start))
+
+
+def percentile_ms(ordered, q):
+    if not ordered:
+        return "-"
+    return f"{attempts.percentile(ordered, q) * 1000:.0f} ms"
+
+
+async def run_load(dbfile, args):
+    admission.controller = admission.AdmissionController()
+    transport = httpx.ASGITransport(app=app)
+    results = []
+    tasks = []
+    loop = asyncio.get_running_loop()
+    locker = loop.run_in_executor(None, hold_write_lock, dbfile, 1.0, args.lock_seconds)
+    async with httpx.AsyncClient(transport=transport, base_url="http://x") as client:
+        started = time.perf_counter()
+        for i in range(int(args.rate * args.seconds)):
+            delay = started + i / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(
+                asyncio.create_task(
+                    ping(client, i % args.monitors, args.client_timeout, results)
+                )
+            )
+        await asyncio.gather(*tasks)
+        await locker
+        # Let pings the clients gave up on finish before the next run
+        while admission.controller.in_flight:
+            await asyncio.sleep(0.05)
+    statuses = Counter(outcome for outcome, _ in results)
+    ok = sorted(elapsed for outcome, elapsed in results if outcome == 200)
+    return statuses, ok, admission.controller.snapshot()
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--monitors", type=int, default=1000)
+    parser.add_argument("--rate", type=int, default=500)
+    parser.add_argument("--seconds", type=float, default=6)
+    parser.add_argument("--lock-seconds", type=float, default=3)
+    parser.add_argument("--client-timeout", type=float, default=2)
+    args = parser.parse_args()
+
+    for kind in ("MONITOR", "IP"):
+        app.config[f"RATELIMIT_{kind}_RATE"] = 1e9
+        app.config[f"RATELIMIT_{kind}_BURST"] = 1e9
+
+    with tempfile.TemporaryDirectory() as tmp:
+        dbfile = os.path.join(tmp, "bench.db")
+        app.config["DATABASE"] = dbfile
+        async with get_engine().begin() as conn:
+            await conn.run_sync(database.meta.create_all)
+        populate(dbfile, args.monitors)
+
+        for label, limits in [
+            ("shedding off", (10**9, 10**9)),
+            ("shedding on (defaults)", (64, 1.0)),
+        ]:
+            app.config["ADMISSION_MAX_IN_FLIGHT"] = limits[0]
+            app.config["ADMISSION_MAX_QUEUE_WAIT_SECONDS"] = limits[1]
+            statuses, ok, snapshot = await run_load(dbfile, args)
+            print(
+                f"{label}: {dict(statuses)}, "
+                f"200s p50 {percentile_ms(ok, 0.5)} p99 {percentile_ms(ok, 0.99)}, "
+                f"peak in flight {snapshot['peak_in_flight']}, "
+                f"shed {snapshot['shed']}"
+            )
+        await hotpath.close()
+        await get_engine().dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
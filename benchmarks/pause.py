@@ -0,0 +1,139 @@
+"""Bulk pause and resume, and the expiry scan with paused monitors.
+
+Usage: python -m benchmarks.pause [--monitors N] [--rounds N]
+
+Fills a scratch database with 2N monitors for one user, N of them tagged
+"maint" with slugs "maint-<i>", and times:
+
+- database.set_paused by tag and by slug pattern, pausing and resuming the N
+  tagged monitors (the full call, and the UPDATE alone on a sqlite3
+  connection)
+- the expiry scan with all 2N monitors expired, before and after pausing
+  the tagged half
+"""
+
+import argparse
+import asyncio
+import os
+import sqlite3
+import statistics
+import tempfile
+import time
+from contextlib import closing
+
+from restarter import app, database, hotpath
+from restarter.database import get_engine
+
+
+def populate(dbfile, monitors):
+    with closing(sqlite3.connect(dbfile)) as conn:
+        conn.execute(
+            "INSERT INTO user (id, email, password, user_key) "
+            "VALUES (1, 'bench@example.com', 'x', 'bench')"
+        )
+        conn.executemany(
+            "INSERT INTO monitor (id, user_id, name, slug, frequency, expires_at, "
+            "api_key) VALUES (?, 1, ?, ?, 3600, 0, ?)",
+            (
+                (
+                    i,
+                    f"monitor {i}",
+                    f"{'maint' if i < monitors else 'web'}-{i}",
+                    f"K{i}",
+                )
+                for i in range(2 * monitors)
+            ),
+        )
+        conn.executemany(
+            "INSERT INTO webhook (monitor_id, url, method, form_fields) "
+            "VALUES (?, 'https://example.com/hook', 'post', '{}')",
+            ((i,) for i in range(2 * monitors)),
+        )
+        conn.executemany(
+            "INSERT INTO monitor_tag (user_id, tag, monitor_id) VALUES (1, 'maint', ?)",
+            ((i,) for i in range(monitors)),
+        )
+        conn.commit()
+
+
+def median_ms(timings):
+    return f"{statistics.median(timings) * 1000:.2f} ms"
+
+
+async def time_call(fn, *args):
+    start = time.perf_counter()
+    result = await fn(*args)
+    return time.perf_counter() - start, result
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--monitors", type=int, default=10_000)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        dbfile = os.path.join(tmp, "bench.db")
+        app.config["DATABASE"] = dbfile
+        async with get_engine().begin() as conn:
+            await conn.run_sync(database.meta.create_all)
+        populate(dbfile, args.monitors)
+
+        for label, kwargs in [
+            ("by tag", {"tag": "maint"}),
+            ("by slug pattern", {"slug_pattern": "maint-*"}),
+        ]:
+            pauses, resumes = [], []
+            for _ in range(args.rounds):
+                elapsed, count = await time_call(
+                    lambda: database.set_paused(
+                        1, database.PAUSED_INDEFINITELY, **kwargs
+                    )
+                )
+                assert count == args.monitors
+                pauses.append(elapsed)
+                elapsed, count = await time_call(
+                    lambda: database.set_paused(1, None, **kwargs)
+                )
+                resumes.append(elapsed)
+            print(
+                f"set_paused {label}, {args.monitors} monitors: "
+                f"pause {median_ms(pauses)}, resume {median_ms(resumes)}"
+            )
+
+        with closing(sqlite3.connect(dbfile, isolation_level=None)) as conn:
+            hotpath.add_functions(conn)
+            timings = []
+            for pu in [database.PAUSED_INDEFINITELY, None] * args.rounds:
+                start = time.perf_counter()
+                conn.execute(
+                    database.PAUSE_BY_TAG,
+                    {"pu": pu, "ui": 1, "tag": "maint", "sp": "*", "now": time.time()},
+                )
+                timings.append(time.perf_counter() - start)
+            print(f"UPDATE by tag alone, autocommit: {median_ms(timings)}")
+
+        for paused in (False, True):
+            await database.set_paused(
+                1, database.PAUSED_INDEFINITELY if paused else None, tag="maint"
+            )
+            # Resuming gave them new deadlines; expire them all again
+            with closing(sqlite3.connect(dbfile)) as conn:
+                conn.execute("UPDATE monitor SET expires_at=0")
+                conn.commit()
+            timings = []
+            for _ in range(args.rounds):
+                elapsed, rows = await time_call(hotpath.get_expired_monitors)
+                timings.append(elapsed)
+            expected = args.monitors if paused else 2 * args.monitors
+            assert len(rows) == expected
+            print(
+                f"scan, {'half paused' if paused else 'none paused'}, "
+                f"{len(rows)} rows: {median_ms(timings)}"
+            )
+        await hotpath.close()
+        await get_engine().dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,149 @@
+"""Ping latency under dashboard and scan traffic, shared versus split reads.
+
+Usage: python -m benchmarks.readpool [--monitors N] [--rate N] [--seconds N]
+                                     [--readers N]
+
+Fills a scratch database with N monitors for one user, all expired, then
+sends pings at `--rate` per second for `--seconds` through
+hotpath.update_monitor and records each one's latency. Runs three times:
+
+- pings alone
+- with reads on the writers: `--readers` tasks loading the dashboard
+  listing (get_monitors_by_user_id) in a loop, and the expiry scan running
+  back to back, all through the write engine (default pool) and the
+  hot-path thread, as before the read pool
+- the same read traffic on the read-only engine and the hot-path read
+  thread
+"""
+
+import argparse
+import asyncio
+import os
+import sqlite3
+import tempfile
+import time
+from contextlib import closing
+
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from restarter import app, attempts, database, hotpath
+from restarter.database import get_engine
+
+
+def populate(dbfile, monitors):
+    with closing(sqlite3.connect(dbfile)) as conn:
+        conn.execute(
+            "INSERT INTO user (id, email, password, user_key) "
+            "VALUES (1, 'bench@example.com', 'x', 'bench')"
+        )
+        conn.executemany(
+            "INSERT INTO monitor (id, user_id, name, slug, frequency, expires_at, "
+            "api_key) VALUES (?, 1, ?, ?, 3600, 0, ?)",
+            ((i + 1, f"monitor {i}", f"m-{i}", f"K{i}") for i in range(monitors)),
+        )
+        conn.executemany(
+            "INSERT INTO webhook (monitor_id, url, method, form_fields) "
+            "VALUES (?, 'https://example.com/hook', 'post', '{}')",
+            ((i + 1,) for i in range(monitors)),
+        )
+        conn.commit()
+
+
+async def pings(args):
+    latencies = []
+
+    async def ping(key):
+        start = time.perf_counter()
+        await hotpath.update_monitor(key)
+        latencies.append(time.perf_counter() - start)
+
+    tasks = []
+    started = time.perf_counter()
+    for i in range(int(args.rate * args.seconds)):
+        delay = started + i / args.rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        # Only pinging the first few keeps the scan's result set large
+        tasks.append(asyncio.create_task(ping(f"K{i % 100}")))
+    await asyncio.gather(*tasks)
+    return sorted(latencies)
+
+
+async def dashboard_reader(stop, counts):
+    while not stop.is_set():
+        await database.get_monitors_by_user_id(1)
+        counts["dashboard"] += 1
+
+
+async def scanner(stop, counts):
+    while not stop.is_set():
+        await hotpath.get_expired_monitors()
+        counts["scan"] += 1
+
+
+async def measure(args, readers):
+    stop = asyncio.Event()
+    counts = {"dashboard": 0, "scan": 0}
+    background = []
+    if readers:
+        background = [
+            asyncio.create_task(dashboard_reader(stop, counts))
+            for _ in range(args.readers)
+        ] + [asyncio.create_task(scanner(stop, counts))]
+    latencies = await pings(args)
+    stop.set()
+    await asyncio.gather(*background)
+    return latencies, counts
+
+
+def report(label, latencies, counts, seconds):
+    ms = [f"{attempts.percentile(latencies, q) * 1000:.1f}" for q in (0.5, 0.99)]
+    print(
+        f"{label}: ping p50 {ms[0]} ms, p99 {ms[1]} ms, "
+        f"max {latencies[-1] * 1000:.1f} ms; "
+        f"dashboards/s {counts['dashboard'] / seconds:.0f}, "
+        f"scans/s {counts['scan'] / seconds:.1f}"
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--monitors", type=int, default=5000)
+    parser.add_argument("--rate", type=int, default=200)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--readers", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        dbfile = os.path.join(tmp, "bench.db")
+        app.config["DATABASE"] = dbfile
+        async with get_engine().begin() as conn:
+            await conn.run_sync(database.meta.create_all)
+        populate(dbfile, args.monitors)
+
+        latencies, counts = await measure(args, readers=False)
+        report("pings alone", latencies, counts, args.seconds)
+
+        # As before the read pool: one engine with the default pool for
+        # everything, and the scan on the hot-path writer thread
+        shared = create_async_engine(f"sqlite+aiosqlite:///{dbfile}")
+        split = (database.get_read_engine, hotpath.read)
+        database.get_read_engine = lambda: shared
+        hotpath.read = hotpath.run
+        try:
+            latencies, counts = await measure(args, readers=True)
+        finally:
+            database.get_read_engine, hotpath.read = split
+            await shared.dispose()
+        report("reads on the writers", latencies, counts, args.seconds)
+
+        latencies, counts = await measure(args, readers=True)
+        report("reads on the read pool", latencies, counts, args.seconds)
+
+        await hotpath.close()
+        await get_engine().dispose()
+        await database.get_read_engine().dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
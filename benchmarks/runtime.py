@@ -0,0 +1,187 @@
+"""Ping throughput and latency under the standard and fast runtimes.
+
+Usage: python -m benchmarks.runtime [--monitors N] [--pings N]
+                                    [--connections N] [--rounds N]
+
+Starts `python -m serve --runtime <runtime>` with one worker on a
+scratch database, fills it with N monitors, and sends `--pings` pings over
+`--connections` keep-alive connections at once, then as many requests to
+/health/scheduler, which answers from memory and so shows the cost of the
+runtime itself without SQLite in the way. The client writes raw
+HTTP/1.1 on asyncio streams, so it costs far less per request than the
+server and doesn't cap the numbers. It runs in this process, on uvloop if
+that's installed. Rate limits are raised out of the way. Each runtime is
+measured `--rounds` times, alternating, and the median round is reported.
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from contextlib import closing
+
+import httpx
+
+from restarter import attempts
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(runtime, dbfile, port, timeout=60):
+    env = dict(
+        os.environ,
+        FLYRESTARTER_DATABASE=dbfile,
+        FLYRESTARTER_SECRET_KEY="bench",
+        FLYRESTARTER_ADMIN_KEY="bench",
+        FLYRESTARTER_RATELIMIT_MONITOR_RATE="1e9",
+        FLYRESTARTER_RATELIMIT_MONITOR_BURST="1e9",
+        FLYRESTARTER_RATELIMIT_IP_RATE="1e9",
+        FLYRESTARTER_RATELIMIT_IP_BURST="1e9",
+        FLYRESTARTER_LOG_SAMPLE_RATES='{"uvicorn.access": 1000000}',
+    )
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "serve", "--runtime", runtime]
+        + ["--port", str(port)],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        try:
+            if httpx.get(f"http://127.0.0.1:{port}/health").status_code == 200:
+                return proc
+        except httpx.TransportError:
+            pass
+        time.sleep(0.05)
+    proc.terminate()
+    raise RuntimeError("server did not become ready")
+
+
+def populate(dbfile, monitors):
+    with closing(sqlite3.connect(dbfile)) as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO user (id, email, password, user_key) "
+            "VALUES (1, 'bench@example.com', 'x', 'bench')"
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO monitor (id, user_id, name, slug, frequency, "
+            "expires_at, api_key) VALUES (?, 1, ?, ?, 3600, 9e9, ?)",
+            ((i + 1, f"monitor {i}", f"m-{i}", f"K{i}") for i in range(monitors)),
+        )
+        conn.commit()
+
+
+def ping_request(key):
+    return (
+        f"POST /monitor/MK{key} HTTP/1.1\r\nHost: bench\r\n" "Content-Length: 0\r\n\r\n"
+    ).encode()
+
+
+HEALTH_REQUEST = b"GET /health/scheduler HTTP/1.1\r\nHost: bench\r\n\r\n"
+
+
+async def connection(port, requests, latencies, statuses):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        for request in requests:
+            start = time.perf_counter()
+            writer.write(request)
+            head = await reader.readuntil(b"\r\n\r\n")
+            lines = head.decode("latin-1").split("\r\n")
+            length = next(
+                int(line.split(":", 1)[1])
+                for line in lines
+                if line.lower().startswith("content-length:")
+            )
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+            statuses[lines[0].split(" ")[1]] += 1
+    finally:
+        writer.close()
+
+
+async def load(port, requests, connections):
+    latencies, statuses = [], Counter()
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(
+            connection(port, requests[c::connections], latencies, statuses)
+            for c in range(connections)
+        )
+    )
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "rps": len(requests) / elapsed,
+        "p50": attempts.percentile(latencies, 0.5) * 1000,
+        "p99": attempts.percentile(latencies, 0.99) * 1000,
+        "statuses": dict(statuses),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--monitors", type=int, default=1000)
+    parser.add_argument("--pings", type=int, default=20_000)
+    parser.add_argument("--connections", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    try:
+        import uvloop
+
+        run = uvloop.run
+    except ModuleNotFoundError:
+        run = asyncio.run
+
+    workloads = {
+        "pings": [ping_request(i % args.monitors) for i in range(args.pings)],
+        "/health/scheduler": [HEALTH_REQUEST] * args.pings,
+    }
+    results = {
+        (workload, runtime): []
+        for workload in workloads
+        for runtime in ("standard", "fast")
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        dbfile = os.path.join(tmp, "bench.db")
+        for _ in range(args.rounds):
+            for runtime in ("standard", "fast"):
+                port = free_port()
+                proc = start_server(runtime, dbfile, port)
+                try:
+                    populate(dbfile, args.monitors)
+                    for workload, requests in workloads.items():
+                        results[workload, runtime].append(
+                            run(load(port, requests, args.connections))
+                        )
+                finally:
+                    proc.terminate()
+                    proc.wait()
+
+    for (workload, runtime), rounds in results.items():
+        median = sorted(rounds, key=lambda r: r["rps"])[len(rounds) // 2]
+        print(
+            f"{workload}, {runtime}: {median['rps']:.0f} requests/s "
+            f"(rounds: {', '.join(str(round(r['rps'])) for r in rounds)}), "
+            f"p50 {median['p50']:.1f} ms, p99 {median['p99']:.1f} ms, "
+            f"statuses {median['statuses']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
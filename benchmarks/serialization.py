@@ -0,0 +1,177 @@
+"""Request validation, response encoding and webhook payload decoding.
+
+Usage: python -m benchmarks.serialization [--items N] [--runs N]
+
+Times, over N items each:
+
+- create validation: decoding a monitor_create body with the app's JSON
+  provider and loading it into MonitorIn the way quart-schema does
+- listing: encoding a list of Monitor objects with the app's JSON provider,
+  and encoding the same monitors as NDJSON export lines
+- webhook decode: decoding the webhook_ids, headers and form fields of
+  queued outbox rows, as deliver_outbox_row does
+
+Each is run with restarter.codec as installed and with orjson disabled.
+"""
+
+import argparse
+import json
+import statistics
+import time
+import tracemalloc
+from datetime import datetime
+
+from quart_schema.conversion import model_load
+from quart_schema.extension import create_json_provider
+
+from restarter import Monitor, MonitorIn, WebhookIn, app, codec
+
+
+def create_bodies(count):
+    return [
+        json.dumps(
+            {
+                "name": f"backup job {i}",
+                "slug": f"backup-{i}",
+                "frequency": 3600,
+                "webhook": {
+                    "url": "https://api.pushover.net/1/messages.json",
+                    "method": "post",
+                    "form_fields": {"token": "t" * 30, "user": "u" * 30},
+                },
+            }
+        ).encode()
+        for i in range(count)
+    ]
+
+
+def monitors(count):
+    webhook = WebhookIn(
+        url="https://api.pushover.net/1/messages.json",
+        method="post",
+        form_fields={"token": "t" * 30, "user": "u" * 30},
+    )
+    now = datetime.now()
+    return [
+        Monitor(
+            id=i,
+            user_id=1,
+            name=f"backup job {i}",
+            slug=f"backup-{i}",
+            frequency=3600,
+            webhook=webhook,
+            last_check=now,
+            expires_at=1_800_000_000 + i,
+            api_key="k" * 32,
+        )
+        for i in range(count)
+    ]
+
+
+def export_records(count):
+    return [
+        {
+            "name": f"backup job {i}",
+            "slug": f"backup-{i}",
+            "frequency": 3600,
+            "schedule": None,
+            "grace": None,
+            "api_key": "k" * 32,
+            "webhooks": [
+                {
+                    "url": "https://api.pushover.net/1/messages.json",
+                    "method": "post",
+                    "headers": None,
+                    "form_fields": {"token": "t" * 30, "user": "u" * 30},
+                    "body_payload": None,
+                }
+            ],
+        }
+        for i in range(count)
+    ]
+
+
+def outbox_rows(count):
+    return [
+        {
+            "webhook_ids": codec.dumps([i, i + 1, i + 2]),
+            "headers": codec.dumps({"X-Request-Source": "restarter"}),
+            "form_fields": codec.dumps(
+                {"token": "t" * 30, "user": "u" * 30, "message": "m" * 200}
+            ),
+        }
+        for i in range(count)
+    ]
+
+
+def best(fn, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings), statistics.median(timings)
+
+
+def run(label, args):
+    bodies = create_bodies(args.items)
+    listing = monitors(args.items)
+    records = export_records(args.items)
+    rows = outbox_rows(args.items)
+
+    def validate():
+        for body in bodies:
+            model_load(app.json.loads(body), MonitorIn, ValueError)
+
+    def encode_listing():
+        app.json.response(listing)
+
+    def encode_export():
+        for record in records:
+            codec.dumpb(record) + b"\n"
+
+    def decode_webhooks():
+        for row in rows:
+            codec.loads(row["webhook_ids"])
+            codec.loads(row["headers"])
+            codec.loads(row["form_fields"])
+
+    print(label)
+    for name, fn in [
+        ("create validation", validate),
+        ("listing, JSON response", encode_listing),
+        ("listing, NDJSON export", encode_export),
+        ("webhook decode", decode_webhooks),
+    ]:
+        low, median = best(fn, args.runs)
+        print(f"  {name}: best {low * 1000:.1f} ms, median {median * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=10_000)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    tracemalloc.start()
+    listing = monitors(args.items)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del listing
+    print(f"{args.items} Monitor objects: {size / 1024:.0f} KiB")
+
+    run(f"codec: {'orjson' if codec.orjson else 'stdlib json'}", args)
+    if codec.orjson:
+        orjson = codec.orjson
+        provider = app.json
+        codec.orjson = None
+        app.json = create_json_provider(app)
+        try:
+            run("codec: stdlib json", args)
+        finally:
+            codec.orjson = orjson
+            app.json = provider
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Startup benchmark: import cost and time until a worker answers /health.
+
+Usage: python -m benchmarks.startup [--runs N]
+
+Reports the cumulative `python -X importtime` cost of `import restarter` with
+the heaviest top-level imports, then spawns uvicorn against a fresh database
+(cold: migrations run) and again against the now-migrated database (warm:
+alembic is skipped) and measures how long until /health returns 200.
+"""
+
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_times():
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import restarter"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        name = name[1:]
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((int(cumulative), depth, name.strip()))
+    return rows
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def time_to_ready(dbfile, timeout=60):
+    port = free_port()
+    env = dict(
+        os.environ,
+        FLYRESTARTER_DATABASE=dbfile,
+        FLYRESTARTER_SECRET_KEY="bench",
+        FLYRESTARTER_ADMIN_KEY="bench",
+    )
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "restarter:app", "--port", str(port)],
+        cwd=ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        while time.perf_counter() - start < timeout:
+            try:
+                if httpx.get(f"http://127.0.0.1:{port}/health").status_code == 200:
+                    return time.perf_counter() - start
+            except httpx.TransportError:
+                pass
+            time.sleep(0.01)
+        raise RuntimeError("server did not become ready")
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = import_times()
+    total = next(c for c, depth, name in rows if name == "restarter")
+    print(f"import restarter: {total / 1000:.1f} ms cumulative")
+    # Direct imports made while importing restarter
+    top = sorted(((c, name) for c, depth, name in rows if depth == 1), reverse=True)
+    for cumulative, name in top[:10]:
+        print(f"  {cumulative / 1000:8.1f} ms  {name}")
+
+    cold, warm = [], []
+    for _ in range(args.runs):
+        with tempfile.TemporaryDirectory() as tmp:
+            dbfile = os.path.join(tmp, "bench.db")
+            cold.append(time_to_ready(dbfile))
+            warm.append(time_to_ready(dbfile))
+    print(f"time to first ready, fresh db:    {statistics.median(cold):.3f} s median")
+    print(f"time to first ready, db at head:  {statistics.median(warm):.3f} s median")
+
+
+if __name__ == "__main__":
+    main()
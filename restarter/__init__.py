@@ -1,24 +1,27 @@
 import asyncio
-import json
+import functools
 import logging
+import math
 import os
 import random
 import re
 import string
 import time
-from dataclasses import dataclass
-from datetime import datetime
+from dataclasses import asdict
+from datetime import UTC, datetime
 
 import aiosqlite
-import apscheduler
 import httpx
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from markupsafe import Markup
+from pydantic.dataclasses import dataclass
 from quart import (
     Quart,
+    Request,
     Response,
     current_app,
     g,
     jsonify,
+    make_response,
     request,
     url_for,
     redirect,
@@ -34,27 +37,70 @@ from quart_schema import (
 )
 from uvicorn.middleware.proxy_headers import ProxyHeadersMiddleware
 
-from alembic import command
-from alembic.config import Config
+from . import (
+    admission,
+    assets,
+    attempts,
+    backup,
+    breaker,
+    codec,
+    cron,
+    database,
+    datamigrations,
+    digest,
+    fragments,
+    health,
+    hotpath,
+    logs,
+    looplag,
+    maintenance,
+    profiler,
+    ratelimit,
+)
+from .compression import CompressionMiddleware
+
+
+class StreamingRequest(Request):
+    """Requests whose body limits depend on the route.
+
+    Quart sizes the body from MAX_CONTENT_LENGTH and BODY_TIMEOUT when the
+    request arrives, before it's routed, and a body declared bigger than the
+    limit is dropped right away, so a view can't raise the limit for itself.
+    Imports are read line by line and never held whole, and an export of a
+    big account is well over Quart's 16 MB default; they get
+    IMPORT_MAX_BYTES (1 GB; None for no limit) and IMPORT_BODY_TIMEOUT
+    instead.
+    """
 
-from quart_wtf import QuartForm
-from wtforms import StringField, PasswordField
-from wtforms.validators import DataRequired, Email, EqualTo
-from wtforms.widgets import PasswordInput
+    def __init__(self, method, scheme, path, *args, **kwargs):
+        if path == "/monitors/import":
+            kwargs["max_content_length"] = app.config.get("IMPORT_MAX_BYTES", 2**30)
+            kwargs["body_timeout"] = app.config.get("IMPORT_BODY_TIMEOUT", 600)
+        super().__init__(method, scheme, path, *args, **kwargs)
 
-from . import database
 
 app = Quart(__name__)
+app.request_class = StreamingRequest
 app.asgi_app = ProxyHeadersMiddleware(
     app.asgi_app, trusted_hosts=["172.16.0.0/12", "127.0.0.1", "66.241.112.0/20"]
 )
 logger = logging.getLogger(__name__)
+# Separate loggers so the high-volume ones can be sampled on their own
+scan_logger = logging.getLogger(f"{__name__}.scan")
+delivery_logger = logging.getLogger(f"{__name__}.delivery")
 
 QuartSchema(app)
+codec.install_json_provider(app)
 
 
 app.config.from_prefixed_env(prefix="FLYRESTARTER")
 
+assets.init_app(app)
+if app.config.get("COMPRESS_RESPONSES"):
+    app.asgi_app = CompressionMiddleware(
+        app.asgi_app, minimum_size=app.config.get("COMPRESS_MIN_BYTES", 1024)
+    )
+
 
 def adapt_datetime_iso(val):
     """Adapt datetime.datetime to timezone-naive ISO 8601 date."""
@@ -88,109 +134,414 @@ def logging_after(response):
     return response
 
 
-class LoginForm(QuartForm):
-    email = StringField(
-        "Email address",
-        validators=[DataRequired("Please enter your email address"), Email()],
-    )
+# non async
+async def check_things():
+    tick = health.start_tick()
+    error = None
+    try:
+        await scan_expired(tick)
+    except Exception as e:
+        error = repr(e)
+        raise
+    finally:
+        health.finish_tick(tick, error)
 
-    password = PasswordField(
-        "Password",
-        widget=PasswordInput(hide_value=False),
-        validators=[
-            DataRequired("Please enter your password"),
-        ],
+
+async def scan_expired(tick):
+    ra = random.SystemRandom()
+    jitter = ra.randint(2, 12)
+    scan_logger.debug("Checking service - jitter time %s", jitter)
+    await asyncio.sleep(jitter)
+    start = time.perf_counter()
+    await hotpath.end_lapsed_pauses()
+    monitors = await hotpath.get_expired_monitors()
+    tick.scanned = len(monitors)
+    # Only alert on monitors whose webhooks haven't been called since their last
+    # ping. Queueing the delivery marks them called, and the dispatchers take it
+    # from there, retrying failures with backoff.
+    alertable = [m for m in monitors if m["url"] and m["method"]]
+    # Stands until the deliveries are queued
+    tick.backlog_age = health.backlog_age(
+        time.time(), oldest_expiry=min((m["expires_at"] for m in alertable), default=0)
+    )
+    groups = digest.group_expiries(
+        alertable,
+        app.config.get("DIGEST_MODE"),
+        app.config.get("DIGEST_WINDOW_SECONDS", 60),
+    )
+    digest_mode = app.config.get("DIGEST_MODE") in digest.DIGEST_MODES
+    queued = await hotpath.enqueue_deliveries(
+        [make_delivery(g, digest_mode) for g in groups]
+    )
+    tick.queued = queued
+    tick.backlog_age = health.backlog_age(
+        time.time(), oldest_due=await hotpath.get_oldest_due()
+    )
+    scan_logger.info(
+        "%s expired monitors, %s webhook deliveries queued",
+        len(monitors),
+        queued,
+        extra={
+            "expired": len(monitors),
+            "queued": queued,
+            "backlog_age": tick.backlog_age,
+            "duration_ms": round((time.perf_counter() - start) * 1000, 3),
+        },
     )
+    if queued and outbox_wakeup:
+        outbox_wakeup.set()
 
 
-class CreateAccountForm(QuartForm):
-    email = StringField(
-        "Email address",
-        validators=[DataRequired("Please enter your email address"), Email()],
-    )
+def _decode_json_dict(value):
+    if value is None:
+        return {}
+    return codec.loads(value)
 
-    password = PasswordField(
-        "Password",
-        widget=PasswordInput(hide_value=False),
-        validators=[
-            DataRequired("Please enter your password"),
-            EqualTo("password_confirm", message="Passwords must match"),
-        ],
-    )
 
-    password_confirm = PasswordField(
-        "Confirm Password",
-        widget=PasswordInput(hide_value=False),
-        validators=[DataRequired("Please confirm your password")],
-    )
+def make_delivery(group, digest_mode=False):
+    """Outbox delivery for a group of expired monitor rows sharing a webhook.
 
+    Digests list the monitors in the message; otherwise the group's webhooks
+    are identical and the request is sent as configured.
+    """
+    first = group[0]
+    return {
+        "webhook_ids": [m["wid"] for m in group],
+        "url": first["url"],
+        "method": first["method"],
+        "headers": _decode_json_dict(first["headers"]),
+        "form_fields": (
+            digest.digest_form_fields(_decode_json_dict(first["form_fields"]), group)
+            if digest_mode
+            else _decode_json_dict(first["form_fields"])
+        ),
+    }
 
-# non async
-async def check_things():
-    ra = random.SystemRandom()
-    jitter = ra.randint(2, 12)
-    app.logger.info("Checking service - jitter time %s" % jitter)
-    await asyncio.sleep(jitter)
-    monitors = await database.get_expired_monitors()
-    print(f"{len(monitors)} expired monitors")
-    # Only hit monitors if their last_hit is null. Meaning we hit them once only, unless
-    # hitting them fails; then we would keep retrying.
-    for m in [m for m in monitors if m["url"] and m["method"]]:
-        await hit_webhook(
-            m["wid"],
-            m["url"],
-            m["method"],
-            m["headers"],
-            m["form_fields"],
-            m["body_payload"],
-        )
 
+outbox_wakeup = None
+dispatchers = []
 
-async def hit_webhook(wid, url, method, headers, form_fields, body_payload):
-    if headers is None:
-        headers = {}
-    else:
-        headers = json.loads(headers)
-    if form_fields is None:
-        form_fields = {}
-    else:
-        form_fields = json.loads(form_fields)
-    # TODO:  Use a shared-pool async client or something
-    async with httpx.AsyncClient() as client:
+
+async def dispatch_outbox():
+    """Dispatcher worker: claim queued deliveries and send them, forever."""
+    while True:
         try:
-            if await database.get_webhook_to_hit_by_id(wid):
-                print(f"{url} for {wid} has not been hit recently")
-
-                resp = await client.request(
-                    method,
-                    url,
-                    headers=headers,
-                    data=form_fields,
-                    follow_redirects=True,
+            rows = await database.claim_outbox(
+                app.config.get("OUTBOX_LEASE_SECONDS", 60),
+                limit=app.config.get("OUTBOX_BATCH_SIZE", 16),
+                max_attempts=app.config.get("OUTBOX_MAX_ATTEMPTS", 10),
+            )
+        except Exception:
+            app.logger.exception("Claiming from the outbox failed")
+            rows = []
+        if not rows:
+            outbox_wakeup.clear()
+            try:
+                async with asyncio.timeout(app.config.get("OUTBOX_POLL_SECONDS", 5)):
+                    await outbox_wakeup.wait()
+            except TimeoutError:
+                pass
+            continue
+        await deliver_outbox_rows(rows)
+
+
+async def deliver_outbox_rows(rows):
+    """Send claimed deliveries concurrently.
+
+    A monitor's webhooks are queued together, so an alert takes as long as
+    its slowest target rather than the sum of them.
+    """
+    results = await asyncio.gather(
+        *(deliver_outbox_row(row) for row in rows), return_exceptions=True
+    )
+    for row, result in zip(rows, results):
+        if isinstance(result, Exception):
+            app.logger.error(
+                "Delivering outbox row %s failed", row["id"], exc_info=result
+            )
+            # Release the lease now rather than when it runs out, and count
+            # the attempt towards OUTBOX_MAX_ATTEMPTS
+            try:
+                await finish_outbox_row(row, True, repr(result))
+            except Exception:
+                app.logger.exception("Rescheduling outbox row %s failed", row["id"])
+
+
+async def deliver_outbox_row(row):
+    retry, error = await deliver_webhook(
+        codec.loads(row["webhook_ids"]),
+        row["url"],
+        row["method"],
+        codec.loads(row["headers"]),
+        codec.loads(row["form_fields"]),
+    )
+    await finish_outbox_row(row, retry, error)
+
+
+async def finish_outbox_row(row, retry, error):
+    if retry and row["attempts"] < app.config.get("OUTBOX_MAX_ATTEMPTS", 10):
+        # Exponential backoff: 30s, 60s, 120s... capped at an hour
+        delay = min(30 * 2 ** (row["attempts"] - 1), 3600)
+        await database.retry_outbox(row["id"], row["lease_token"], delay, error)
+    else:
+        await database.complete_outbox(row["id"], row["lease_token"], error)
+
+
+def start_dispatchers():
+    global outbox_wakeup
+
+    if dispatchers:
+        return
+    outbox_wakeup = asyncio.Event()
+    for _ in range(app.config.get("OUTBOX_WORKERS", 4)):
+        dispatchers.append(asyncio.create_task(dispatch_outbox()))
+
+
+async def stop_dispatchers():
+    for task in dispatchers:
+        task.cancel()
+    await asyncio.gather(*dispatchers, return_exceptions=True)
+    dispatchers.clear()
+
+
+http_client = None
+
+
+def get_http_client():
+    global http_client
+
+    if not http_client:
+        http_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(
+                app.config.get("WEBHOOK_READ_TIMEOUT", 10),
+                connect=app.config.get("WEBHOOK_CONNECT_TIMEOUT", 5),
+            ),
+            follow_redirects=True,
+            max_redirects=app.config.get("WEBHOOK_MAX_REDIRECTS", 3),
+        )
+    return http_client
+
+
+async def read_bounded(resp, limit):
+    """Read at most `limit` bytes of a streamed response body.
+
+    Whatever is left unread is discarded along with the connection when the
+    stream is closed.
+    """
+    chunks = []
+    size = 0
+    async for chunk in resp.aiter_bytes():
+        chunks.append(chunk[: limit - size])
+        size += len(chunks[-1])
+        if size >= limit:
+            break
+    return b"".join(chunks)
+
+
+async def deliver_webhook(wids, url, method, headers, form_fields):
+    """Send one webhook request.
+
+    Returns (retry, error): error is None on success, and retry says whether
+    the failure is worth another attempt later.
+    """
+    host = httpx.URL(url).host
+    cb = breaker.get_breaker(
+        host,
+        failure_threshold=app.config.get("BREAKER_FAILURE_THRESHOLD", 5),
+        reset_timeout=app.config.get("BREAKER_RESET_SECONDS", 300),
+    )
+    if not cb.allow():
+        delivery_logger.info(
+            "%s for %s skipped, circuit for %s is %s",
+            url,
+            wids,
+            host,
+            cb.state,
+            extra={"webhook_ids": wids, "host": host, "outcome": "skipped"},
+        )
+        return True, f"circuit {cb.state}"
+    attempted_at = time.time()
+    start = time.perf_counter()
+    resp = content = error_class = None
+    outcome = "error"
+    try:
+        async with asyncio.timeout(app.config.get("WEBHOOK_TOTAL_TIMEOUT", 15)):
+            async with get_http_client().stream(
+                method,
+                url,
+                headers=headers,
+                data=form_fields,
+            ) as resp:
+                content = await read_bounded(
+                    resp, app.config.get("WEBHOOK_MAX_RESPONSE_BYTES", 4096)
                 )
-                print(resp.content)
-                resp.raise_for_status()
-                print(f"{url} for {wid} hit successful, updating last_called time")
-                await database.touch_webhook_by_id(wid)
-            else:
-                print(f"{url} for {wid} was hit recently, skipping for now")
-        except httpx.UnsupportedProtocol:
-            pass
-        except httpx.HTTPStatusError:
-            print(f"{url} {wid} hit UNSUCCESSFUL but still updating last_called time")
-            await database.touch_webhook_by_id(wid)
+        if delivery_logger.isEnabledFor(logging.DEBUG):
+            delivery_logger.debug(
+                "%s responded %r", url, content[:512], extra={"webhook_ids": wids}
+            )
+        # A 4xx still means the host is up; only server errors trip the breaker
+        if resp.is_server_error:
+            cb.record_failure()
+        else:
+            breaker.record_success(host)
+        resp.raise_for_status()
+        outcome = "ok"
+        return False, None
+    except httpx.UnsupportedProtocol as e:
+        error_class = type(e).__name__
+        outcome = "unsupported_protocol"
+        return False, repr(e)
+    except httpx.HTTPStatusError:
+        outcome = "http_error"
+        retry = resp.is_server_error or resp.status_code == 429
+        return retry, f"HTTP {resp.status_code}"
+    except httpx.TooManyRedirects as e:
+        # The host answers, it just never lands anywhere; retrying won't help
+        error_class = type(e).__name__
+        outcome = "redirect_loop"
+        breaker.record_success(host)
+        return False, repr(e)
+    except (httpx.TransportError, TimeoutError) as e:
+        error_class = type(e).__name__
+        outcome = "transport_error"
+        cb.record_failure()
+        return True, repr(e)
+    except httpx.HTTPError as e:
+        # Anything else, e.g. a DecodingError on a corrupt compressed body
+        error_class = type(e).__name__
+        cb.record_failure()
+        return True, repr(e)
+    finally:
+        duration = time.perf_counter() - start
+        status_code = resp.status_code if resp is not None else None
+        attempts.record(
+            wids,
+            host,
+            attempted_at,
+            duration,
+            status_code=status_code,
+            error_class=error_class,
+            response_bytes=len(content) if content is not None else None,
+            max_pending=app.config.get("WEBHOOK_ATTEMPTS_MAX_PENDING", 10_000),
+        )
+        level = logging.INFO if outcome == "ok" else logging.WARNING
+        if delivery_logger.isEnabledFor(level):
+            delivery_logger.log(
+                level,
+                "%s %s for %s: %s",
+                method.upper(),
+                url,
+                wids,
+                outcome,
+                extra={
+                    "webhook_ids": wids,
+                    "host": host,
+                    "status_code": status_code,
+                    "error_class": error_class,
+                    "duration_ms": round(duration * 1000, 3),
+                    "outcome": outcome,
+                    "circuit": cb.state,
+                },
+            )
 
 
 async def run_migrations(db_path):
-    acfg = Config("alembic.ini")
-    acfg.set_main_option("sqlalchemy.url", f"sqlite+aiosqlite:///{db_path}")
-    await asyncio.to_thread(command.upgrade, acfg, "head")
+    # Reading alembic_version is much cheaper than loading alembic and the
+    # migration chain, which is only needed when the schema is behind.
+    if database.current_revision(db_path) == database.HEAD_REVISION:
+        app.logger.info("Schema already at %s", database.HEAD_REVISION)
+        return
+    await asyncio.to_thread(upgrade_schema, db_path)
 
 
-scheduler = AsyncIOScheduler()
-scheduler.add_job(
-    check_things, "interval", seconds=app.config.get("CHECK_INTERVAL_SECONDS", 60)
-)
+def upgrade_schema(db_path):
+    import fcntl
+
+    # Workers start together; only one of them should run the upgrade.
+    with open(f"{db_path}.migrate-lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if database.current_revision(db_path) == database.HEAD_REVISION:
+            return
+        # A new database doesn't need the migration chain, or alembic
+        if database.create_schema(db_path):
+            return
+        from alembic import command
+        from alembic.config import Config
+
+        acfg = Config("alembic.ini")
+        acfg.set_main_option("sqlalchemy.url", f"sqlite+aiosqlite:///{db_path}")
+        command.upgrade(acfg, "head")
+
+
+scheduler = None
+
+
+def start_scheduler():
+    global scheduler
+
+    if scheduler:
+        return
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+    scheduler = AsyncIOScheduler()
+    scheduler.add_job(
+        check_things, "interval", seconds=app.config.get("CHECK_INTERVAL_SECONDS", 60)
+    )
+    scheduler.add_job(
+        maintain,
+        "interval",
+        seconds=app.config.get("MAINTENANCE_INTERVAL_SECONDS", 3600),
+    )
+    if interval := app.config.get("BACKUP_INTERVAL_SECONDS"):
+        # Every worker schedules it; min_age makes all but the first skip
+        scheduler.add_job(
+            take_backup, "interval", seconds=interval, args=[interval / 2]
+        )
+    scheduler.start()
+    health.start()
+
+
+async def maintain():
+    import fcntl
+
+    dbfile = app.config.get("DATABASE", "restarter-data.db")
+    # One worker at a time; the others have nothing left to do anyway
+    with open(f"{dbfile}.maintenance-lock", "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        report = await maintenance.run_maintenance(
+            user_retention=app.config.get("USER_RETENTION_SECONDS", 7 * 86400),
+            outbox_retention=app.config.get("OUTBOX_RETENTION_SECONDS", 7 * 86400),
+            max_lock=app.config.get("MAINTENANCE_MAX_LOCK_SECONDS", 0.05),
+        )
+    app.logger.info("Maintenance done: %s", report)
+    return report
+
+
+async def take_backup(min_age=0):
+    dbfile = app.config.get("DATABASE", "restarter-data.db")
+    backup_dir = app.config.get(
+        "BACKUP_DIR", os.path.join(os.path.dirname(os.path.abspath(dbfile)), "backups")
+    )
+    report = await asyncio.to_thread(
+        backup.run_backup,
+        dbfile,
+        backup_dir,
+        keep=app.config.get("BACKUP_KEEP", 7),
+        min_age=min_age,
+    )
+    if report.path:
+        app.logger.info(
+            "Backup %s: %s pages, %s bytes in %.2fs, rotated out %s",
+            report.path,
+            report.pages,
+            report.bytes,
+            report.duration,
+            report.removed,
+        )
+    return report
 
 
 async def init_db():
@@ -200,14 +551,30 @@ async def init_db():
 
 @app.before_serving
 async def before_serving():
+    # Moves the handlers log_conf.yaml set up onto a background thread
+    logs.install(
+        json=app.config.get("LOG_FORMAT", "json") == "json",
+        sample_rates=app.config.get("LOG_SAMPLE_RATES"),
+    )
     app.logger.info("Initializing db")
     await init_db()
+    # Backfills run in batches once the schema is up to date, while serving
+    datamigrations.start(
+        max_lock=app.config.get("DATA_MIGRATION_MAX_LOCK_SECONDS", 0.05),
+        pause=app.config.get("DATA_MIGRATION_PAUSE_SECONDS", 0.05),
+    )
     # Start the scheduler
     app.logger.info("Starting scheduler")
-    try:
-        scheduler.start()
-    except apscheduler.schedulers.SchedulerAlreadyRunningError:
-        pass
+    start_scheduler()
+    start_dispatchers()
+    attempts.start(
+        app.config.get("WEBHOOK_ATTEMPTS_FLUSH_SECONDS", 1),
+        app.config.get("WEBHOOK_ATTEMPTS_KEEP", 100),
+    )
+    looplag.start(
+        app.config.get("LOOP_LAG_INTERVAL_SECONDS", 0.1),
+        app.config.get("LOOP_LAG_THRESHOLD_SECONDS", 0.25),
+    )
     app.logger.info("Setup complete, serving")
     if os.environ.get("PRINT_LOGGING_TREE"):
         try:
@@ -218,7 +585,12 @@ async def before_serving():
             pass
 
 
-@dataclass(kw_only=True)
+def check_tag(tag):
+    if not re.fullmatch(r"[a-z0-9][a-z0-9_.-]{0,31}", tag):
+        raise ValueError("tags must be a-z0-9_.- max 32 chars")
+
+
+@dataclass(kw_only=True, slots=True)
 class WebhookIn:
     url: str
     method: str
@@ -231,39 +603,64 @@ class WebhookIn:
             raise ValueError("method must be post or get")
 
 
-@dataclass
+@dataclass(slots=True)
 class Webhook(WebhookIn):
     id: int
     created_at: datetime
     updated_at: datetime
 
 
-@dataclass
+@dataclass(slots=True)
 class MonitorIn:
     name: str  # Descriptive name
     slug: str  # URLifiable slug
-    frequency: int  # Alert if last_check + frequency > now()
-    webhook: WebhookIn
+    webhook: WebhookIn | None = None  # Either one webhook,
+    webhooks: list[WebhookIn] | None = None  # or several, all called on expiry
+    frequency: int | None = None  # Alert if last_check + frequency > now()
+    schedule: str | None = None  # Or: cron expression (UTC) the job runs on
+    grace: int | None = None  # Alert if not called this long after a scheduled run
+    tags: list[str] | None = None  # For pausing and resuming monitors together
 
     def __post_init__(self):
         if len(self.name) > 255:
             raise ValueError("name must be 255 characters or less")
-        if self.frequency < 60 or self.frequency > 2592000:
+        if (self.webhook is None) == (self.webhooks is None):
+            raise ValueError("exactly one of webhook or webhooks is required")
+        if self.webhooks is None:
+            self.webhooks = [self.webhook]
+        if not 1 <= len(self.webhooks) <= 10:
+            raise ValueError("between 1 and 10 webhooks are required")
+        self.webhook = self.webhooks[0]
+        if (self.frequency is None) == (self.schedule is None):
+            raise ValueError("exactly one of frequency or schedule is required")
+        if self.schedule is not None:
+            cron.next_fire(self.schedule, time.time())  # ValueError if bogus
+            if self.grace is None:
+                self.grace = 300
+            if self.grace < 0 or self.grace > 86400:
+                raise ValueError("grace must be between 0 seconds and 1 day")
+        elif self.frequency < 60 or self.frequency > 2592000:
             raise ValueError("frequency must be between 60 seconds and 30 days")
         if not re.fullmatch(r"[^-][a-z0-9-]{1,32}", self.slug):
             raise ValueError("slug must be a-z0-9 max 32 chars")
+        if self.tags is not None:
+            self.tags = list(dict.fromkeys(self.tags))
+            if len(self.tags) > 16:
+                raise ValueError("at most 16 tags")
+            for tag in self.tags:
+                check_tag(tag)
 
 
-@dataclass
+@dataclass(kw_only=True, slots=True)
 class Monitor(MonitorIn):
     id: int
     user_id: int
     last_check: datetime | None
-    expires_at: int  # in epoch seconds
+    expires_at: float  # in epoch seconds
     api_key: str
 
 
-@dataclass
+@dataclass(slots=True)
 class UserIn:
     email: str
     password: str
@@ -273,13 +670,29 @@ class UserIn:
             raise ValueError("weird email")
 
 
-@dataclass
+@dataclass(slots=True)
 class User(UserIn):
     id: int
     user_key: str
-    deleted_at: datetime
-    created_at: datetime
-    updated_at: datetime
+    # NULL for users inserted by raw SQL, which skips the column defaults
+    deleted_at: datetime | None
+    created_at: datetime | None
+    updated_at: datetime | None
+
+
+@app.after_serving
+async def after_serving():
+    global http_client
+
+    await looplag.stop()
+    await datamigrations.stop()
+    await stop_dispatchers()
+    await attempts.stop(app.config.get("WEBHOOK_ATTEMPTS_KEEP", 100))
+    await hotpath.close()
+    if http_client:
+        await http_client.aclose()
+        http_client = None
+    logs.uninstall()
 
 
 def run() -> None:
@@ -293,25 +706,124 @@ async def handle_request_validation_error(error):
     }, 400
 
 
+# Default (rate per second, burst) for each rate limited key kind
+RATE_LIMITS = {
+    "monitor": (0.2, 5),
+    "user": (1, 20),
+    "ip": (20, 100),
+}
+
+
+def rate_limit(**keys):
+    """Take a token for each key, e.g. rate_limit(monitor=key, ip=addr).
+
+    Returns a 429 response if any bucket is empty, None otherwise. Rates come
+    from RATELIMIT_<KIND>_RATE / RATELIMIT_<KIND>_BURST.
+    """
+    for kind, key in keys.items():
+        rate, burst = RATE_LIMITS[kind]
+        limiter = ratelimit.get_limiter(
+            kind,
+            app.config.get(f"RATELIMIT_{kind.upper()}_RATE", rate),
+            app.config.get(f"RATELIMIT_{kind.upper()}_BURST", burst),
+        )
+        wait = limiter.acquire(key)
+        if wait:
+            response = jsonify({"error": "Too many requests"})
+            response.status = 429
+            response.headers["Retry-After"] = str(math.ceil(wait))
+            return response
+    return None
+
+
+def admit_write():
+    """A 503 response if the hot-path queue is too backed up, else None."""
+    wait = admission.controller.admit(
+        app.config.get("ADMISSION_MAX_IN_FLIGHT", 64),
+        app.config.get("ADMISSION_MAX_QUEUE_WAIT_SECONDS", 1.0),
+    )
+    if wait:
+        response = jsonify({"error": "Busy, try again later"})
+        response.status = 503
+        response.headers["Retry-After"] = str(wait)
+        return response
+    return None
+
+
+async def render_monitor_table(user):
+    """The user's dashboard monitor table, from the fragment cache if current."""
+    cache = fragments.get_cache(
+        "dashboard", app.config.get("DASHBOARD_CACHE_BYTES", 16 * 1024 * 1024)
+    )
+    # Monitor URLs are absolute, so the host is part of the key
+    key = (user["id"], request.host_url)
+    version = user["dashboard_version"]
+    table = cache.get(key, version)
+    if table is None:
+        # Read after the version: a write in between makes the table newer
+        # than the version says, which only costs a render next time.
+        monitors = await database.get_monitors_by_user_id(user["id"])
+        table = await render_template("monitor_table.html", monitors=monitors)
+        cache.put(key, version, table)
+    return Markup(table)
+
+
 @app.get("/")
 async def root():
+    user_key = None
+    monitor_table = None
     if session.get("logged_in", False):
         user = await database.get_user_by_user_id(session["user_id"])
-        if not user:
-            user_key = None
-            monitors = None
-        else:
+        if user:
             user_key = user["user_key"]
-            monitors = await database.get_monitors_by_user_id(user["id"])
-    else:
-        user_key = None
-        monitors = None
+            monitor_table = await render_monitor_table(user)
 
-    return await render_template("index.html", user_key=user_key, monitors=monitors)
+    response = await make_response(
+        await render_template(
+            "index.html", user_key=user_key, monitor_table=monitor_table
+        )
+    )
+    # Browsers keep the page but check back every time; unchanged pages are
+    # answered with a 304
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    await response.add_etag()
+    return await response.make_conditional(request)
+
+
+@app.get("/dashboard/checks")
+async def dashboard_checks():
+    """Slug -> when each of the logged in user's monitors was last checked.
+
+    In epoch seconds, or null before the first check. Pings don't
+    invalidate the cached monitor table, so the page gets them from here.
+    """
+    if not session.get("logged_in", False):
+        return Response(status=401)
+    checks = {
+        row["slug"]: epoch_seconds(row["last_check"])
+        for row in await database.get_last_checks(session["user_id"])
+    }
+    response = jsonify(checks)
+    response.cache_control.no_store = True
+    return response
+
+
+def epoch_seconds(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        # Naive DateTime columns are UTC
+        value = value.replace(tzinfo=UTC)
+    return value.timestamp()
 
 
 @app.route("/register", methods=["GET", "POST"])
 async def register():
+    from .forms import CreateAccountForm
+
     form = await CreateAccountForm.create_form()
     if await form.validate_on_submit():
         email = form.email.data
@@ -322,7 +834,7 @@ async def register():
         )
         if user:
             session["logged_in"] = True
-            session["user_id"] = user.id
+            session["user_id"] = user["id"]
             session["email"] = email
             await flash("User created and logged in", "success")
 
@@ -336,6 +848,8 @@ async def register():
 
 @app.route("/login", methods=["GET", "POST"])
 async def login():
+    from .forms import LoginForm
+
     form = await LoginForm.create_form()
     if await form.validate_on_submit():
         # Check password
@@ -370,14 +884,128 @@ async def logout():
     return redirect("/")
 
 
+def scheduler_problems(now):
+    interval = app.config.get("CHECK_INTERVAL_SECONDS", 60)
+    return health.problems(
+        now,
+        max_tick_age=app.config.get("HEALTH_MAX_TICK_AGE_SECONDS", 3 * interval),
+        max_tick_duration=app.config.get("HEALTH_MAX_TICK_SECONDS", 120),
+        max_backlog_age=app.config.get("HEALTH_MAX_BACKLOG_AGE_SECONDS", 900),
+    )
+
+
 @app.get("/health")
-async def health():
-    return {"health": "good!"}
+async def health_check():
+    now = time.time()
+    problems = scheduler_problems(now)
+    # The outbox may have drained, or filled up, since the last tick
+    backlog_age = health.backlog_age(now, oldest_due=await hotpath.get_oldest_due())
+    if (backlog_age or 0) > app.config.get("HEALTH_MAX_BACKLOG_AGE_SECONDS", 900):
+        problems.append(f"oldest due delivery is {backlog_age:.0f}s old")
+    if not problems:
+        return {"health": "good!"}
+    return {
+        "health": "degraded",
+        "problems": problems,
+        "backlog_age": backlog_age,
+        "scheduler": health.snapshot(now),
+    }, 503
+
+
+@app.get("/health/scheduler")
+async def health_scheduler():
+    """In-memory scan stats only, cheap enough to poll often."""
+    now = time.time()
+    problems = scheduler_problems(now)
+    return {
+        "health": "degraded" if problems else "good!",
+        "problems": problems,
+        **health.snapshot(now),
+    }, (503 if problems else 200)
+
+
+def admin_required(view):
+    """Answer 401 unless the request carries the admin key."""
+
+    @functools.wraps(view)
+    async def wrapper(*args, **kwargs):
+        if request.headers.get("x-admin-key") != current_app.config["ADMIN_KEY"]:
+            return Response(status=401)
+        return await view(*args, **kwargs)
+
+    return wrapper
+
+
+@app.get("/admin/breakers")
+@admin_required
+async def admin_breakers():
+    return {"breakers": breaker.snapshot()}
+
+
+@app.get("/admin/loop")
+@admin_required
+async def admin_loop():
+    return looplag.snapshot()
+
+
+@app.get("/admin/migrations")
+@admin_required
+async def admin_migrations():
+    return {"migrations": await datamigrations.status()}
+
+
+@app.get("/admin/admission")
+@admin_required
+async def admin_admission():
+    return admission.controller.snapshot()
+
+
+@app.post("/admin/profile")
+@admin_required
+async def admin_profile():
+    try:
+        seconds = float(request.args.get("seconds", 10))
+    except ValueError:
+        return {"error": "seconds must be a number"}, 400
+    if not 0 < seconds <= app.config.get("PROFILE_MAX_SECONDS", 60):
+        return {"error": "seconds is out of range"}, 400
+    try:
+        result = await asyncio.to_thread(
+            profiler.profile,
+            seconds,
+            app.config.get("PROFILE_INTERVAL_SECONDS", 0.01),
+            app.config.get("PROFILE_MAX_OVERHEAD", 0.05),
+        )
+    except profiler.ProfileInProgress:
+        return {"error": "A profile is already running"}, 409
+    return Response(
+        result.collapsed(),
+        content_type="text/plain",
+        headers={
+            "X-Profile-Samples": str(result.samples),
+            "X-Profile-Seconds": f"{result.duration:.3f}",
+            "X-Profile-Overhead": f"{result.overhead / result.duration:.4f}",
+        },
+    )
+
+
+@app.post("/admin/backup")
+@admin_required
+async def admin_backup():
+    try:
+        report = await take_backup()
+    except backup.BackupInProgress:
+        return {"error": "A backup is already running"}, 409
+    return asdict(report)
 
 
 @app.post("/monitor/M<string:monitor_key>")
 async def monitor_update(monitor_key):
-    if not await database.update_monitor(monitor_key):
+    if limited := rate_limit(monitor=monitor_key, ip=request.remote_addr):
+        return limited
+    if shed := admit_write():
+        return shed
+    if not await hotpath.update_monitor(monitor_key):
         return Response(status=404)
     response = jsonify("Update successful")
     response.status = 200
@@ -390,6 +1018,8 @@ async def monitor_delete(monitor_key):
     admin_key = request.headers.get("x-user-key", None)
     if not admin_key:
         return Response(status=400)
+    if limited := rate_limit(user=admin_key, ip=request.remote_addr):
+        return limited
     if not await database.delete_monitor_and_webhooks_by_monitor_key_user_key(
         monitor_key, admin_key
     ):
@@ -404,6 +1034,10 @@ def random_monitor_key(key_length=16):
     return "".join(random.SystemRandom().choice(alphabet) for _ in range(key_length))
 
 
+# What random_monitor_key() makes; ping URLs are routed on it
+MONITOR_KEY_RE = re.compile(r"[A-Z0-9]{16}")
+
+
 def passwordify(pwd):
     from argon2 import PasswordHasher
 
@@ -412,7 +1046,7 @@ def passwordify(pwd):
     return ph.hash(pwd)
 
 
-@dataclass
+@dataclass(slots=True)
 class Headers:
     x_user_key: str
 
@@ -422,61 +1056,300 @@ class Headers:
 @validate_request(MonitorIn)
 async def monitor_create(data: MonitorIn, headers: Headers):
     user_key = headers.x_user_key
+    if limited := rate_limit(user=user_key, ip=request.remote_addr):
+        return limited
     user = await database.get_user_by_user_key(user_key)
     if not user:
         return Response(status=401)
     user_id = user["id"]
     name = data.name
     new_api_key = random_monitor_key()
-    frequency = data.frequency
+    # Scheduled monitors compute their deadline from the schedule instead
+    frequency = data.frequency or 0
     slug = data.slug
-    webhook = data.webhook
     monitor_id = await database.insert_monitor(
-        user_id, name, new_api_key, frequency, slug
+        user_id,
+        name,
+        new_api_key,
+        frequency,
+        slug,
+        data.schedule,
+        data.grace,
+        data.tags or (),
     )
     if not monitor_id:
         return ({"error": "Monitor with this slug already exists"}, 400)
-    await database.insert_webhook(
-        monitor_id,
-        webhook.url,
-        webhook.method,
-        webhook.headers,
-        webhook.form_fields,
-        webhook.body_payload,
-    )
+    for webhook in data.webhooks:
+        await database.insert_webhook(
+            monitor_id,
+            webhook.url,
+            webhook.method,
+            webhook.headers,
+            webhook.form_fields,
+            webhook.body_payload,
+        )
 
     monitor = Monitor(
         user_id=user_id,
         id=monitor_id,
         api_key=new_api_key,
-        frequency=frequency,
+        frequency=data.frequency,
         last_check=datetime.now(),
-        expires_at=datetime.now().timestamp() + frequency,
+        expires_at=database.next_deadline(
+            datetime.now().timestamp(), frequency, data.schedule, data.grace
+        ),
         slug=slug,
         name=name,
-        webhook=data.webhook,
+        webhooks=data.webhooks,
+        schedule=data.schedule,
+        grace=data.grace,
+        tags=data.tags,
+    )
+    logger.info(
+        "Monitor %s created",
+        slug,
+        extra={"monitor_id": monitor_id, "user_id": user_id},
     )
-    print(monitor)
 
     return {
         "monitor_url": url_for(
             "monitor_update", monitor_key=monitor.api_key, _external=True
         ),
         "report_if_not_called_in": monitor.frequency,
+        "schedule": monitor.schedule,
+        "grace": monitor.grace,
+        "tags": monitor.tags or [],
         "name": monitor.name,
-        "webhook": {
-            "url": webhook.url,
-            "method": webhook.method,
-            "headers": webhook.headers,
-            "form_fields": webhook.form_fields,
-            "body_payload": webhook.body_payload,
-        },
+        "webhook": asdict(monitor.webhook),
+        "webhooks": [asdict(w) for w in monitor.webhooks],
+    }
+
+
+# Most deliveries /monitors/<slug>/deliveries lists at once
+MAX_DELIVERIES = 500
+
+
+@app.get("/monitors/<string:slug>/deliveries")
+@validate_headers(Headers)
+async def monitor_deliveries(slug, headers: Headers):
+    if limited := rate_limit(user=headers.x_user_key, ip=request.remote_addr):
+        return limited
+    user = await database.get_user_by_user_key(headers.x_user_key)
+    if not user:
+        return Response(status=401)
+    if not await database.get_monitor_by_user_id_slug(user["id"], slug):
+        return Response(status=404)
+    # Newest first; ?limit=0 or less still gets the newest one
+    limit = min(max(request.args.get("limit", 50, type=int), 1), MAX_DELIVERIES)
+    rows = await database.get_webhook_attempts(user["id"], slug, limit=limit)
+    return {
+        # Over every retained attempt, not just the page
+        "hosts": attempts.summarize(
+            await database.get_webhook_attempts(user["id"], slug)
+        ),
+        "deliveries": [
+            {
+                "url": row["url"],
+                "attempted_at": row["attempted_at"],
+                "duration_ms": row["duration_ms"],
+                "status_code": row["status_code"],
+                "error_class": row["error_class"],
+                "response_bytes": row["response_bytes"],
+            }
+            for row in rows
+        ],
+    }
+
+
+@dataclass(slots=True)
+class PauseIn:
+    tag: str | None = None
+    slug: str | None = None  # glob pattern, e.g. "backup-*"
+    until: float | None = None  # epoch seconds; paused until resumed if unset
+
+    def __post_init__(self):
+        if self.tag is None and self.slug is None:
+            raise ValueError("a tag or a slug pattern is required")
+        if self.tag is not None:
+            check_tag(self.tag)
+        if self.slug is not None and not re.fullmatch(
+            r"[a-z0-9*?\[\]-]{1,64}", self.slug
+        ):
+            raise ValueError("slug must be a slug or glob pattern")
+        if self.until is not None and self.until <= time.time():
+            raise ValueError("until must be in the future")
+
+
+@app.post("/monitors/pause")
+@validate_headers(Headers)
+@validate_request(PauseIn)
+async def monitors_pause(data: PauseIn, headers: Headers):
+    if limited := rate_limit(user=headers.x_user_key, ip=request.remote_addr):
+        return limited
+    user = await database.get_user_by_user_key(headers.x_user_key)
+    if not user:
+        return Response(status=401)
+    until = database.PAUSED_INDEFINITELY if data.until is None else data.until
+    paused = await database.set_paused(user["id"], until, data.tag, data.slug)
+    return {"paused": paused, "until": data.until}
+
+
+@app.post("/monitors/resume")
+@validate_headers(Headers)
+@validate_request(PauseIn)
+async def monitors_resume(data: PauseIn, headers: Headers):
+    if limited := rate_limit(user=headers.x_user_key, ip=request.remote_addr):
+        return limited
+    user = await database.get_user_by_user_key(headers.x_user_key)
+    if not user:
+        return Response(status=401)
+    resumed = await database.set_paused(user["id"], None, data.tag, data.slug)
+    return {"resumed": resumed}
+
+
+def _loads_or_none(value):
+    return None if value is None else codec.loads(value)
+
+
+async def _export_lines(user_id):
+    current = None
+    async for row in database.iter_monitors_for_export(user_id):
+        if current and current["id"] != row["mid"]:
+            current.pop("id")
+            yield codec.dumpb(current) + b"\n"
+            current = None
+        if current is None:
+            current = {
+                "id": row["mid"],
+                "name": row["name"],
+                "slug": row["slug"],
+                "frequency": row["frequency"] or None,
+                "schedule": row["schedule"],
+                "grace": row["grace"],
+                "api_key": row["api_key"],
+                "tags": codec.loads(row["tags"]),
+                "webhooks": [],
+            }
+        if row["url"]:
+            current["webhooks"].append(
+                {
+                    "url": row["url"],
+                    "method": row["method"],
+                    "headers": _loads_or_none(row["headers"]),
+                    "form_fields": _loads_or_none(row["form_fields"]),
+                    "body_payload": _loads_or_none(row["body_payload"]),
+                }
+            )
+    if current:
+        current.pop("id")
+        yield codec.dumpb(current) + b"\n"
+
+
+@app.get("/monitors/export")
+@validate_headers(Headers)
+async def monitors_export(headers: Headers):
+    if limited := rate_limit(user=headers.x_user_key, ip=request.remote_addr):
+        return limited
+    user = await database.get_user_by_user_key(headers.x_user_key)
+    if not user:
+        return Response(status=401)
+    response = Response(_export_lines(user["id"]), mimetype="application/x-ndjson")
+    response.timeout = None  # Big exports take a while, that's fine
+    return response
+
+
+async def ndjson_lines(body, max_line=65536):
+    """Split a streamed request body into lines without buffering all of it."""
+    buf = b""
+    async for chunk in body:
+        buf += chunk
+        *lines, buf = buf.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+        if len(buf) > max_line:
+            raise ValueError(f"line longer than {max_line} bytes")
+    if buf.strip():
+        yield buf
+
+
+def parse_import_line(line):
+    """Validate one exported monitor, returning the dict upsert_monitors takes."""
+    data = codec.loads(line)
+    if not isinstance(data, dict):
+        raise ValueError("expected a JSON object")
+    if "webhooks" in data:
+        data["webhooks"] = [WebhookIn(**w) for w in data["webhooks"]]
+    if data.get("webhook") is not None:
+        data["webhook"] = WebhookIn(**data["webhook"])
+    api_key = data.pop("api_key", None)
+    if not isinstance(api_key, str) or not MONITOR_KEY_RE.fullmatch(api_key):
+        # Not a key we'd have made: give the monitor a new one
+        api_key = None
+    monitor = MonitorIn(**data)
+    return {
+        "name": monitor.name,
+        "slug": monitor.slug,
+        "frequency": monitor.frequency or 0,
+        "schedule": monitor.schedule,
+        "grace": monitor.grace,
+        "api_key": api_key,
+        "tags": monitor.tags,
+        "webhooks": [asdict(w) for w in monitor.webhooks],
     }
 
 
+async def _import_chunk(user_id, chunk):
+    # Keep exported keys so existing cron jobs keep working, unless the key
+    # is already in use by some other monitor or earlier in the chunk.
+    taken = await database.get_taken_api_keys(
+        [m["api_key"] for m in chunk if m["api_key"]]
+    )
+    for m in chunk:
+        if not m["api_key"] or m["api_key"] in taken:
+            m["api_key"] = random_monitor_key()
+        taken.add(m["api_key"])
+    return await database.upsert_monitors(user_id, chunk)
+
+
+@app.post("/monitors/import")
+@validate_headers(Headers)
+async def monitors_import(headers: Headers):
+    if limited := rate_limit(user=headers.x_user_key, ip=request.remote_addr):
+        return limited
+    user = await database.get_user_by_user_key(headers.x_user_key)
+    if not user:
+        return Response(status=401)
+    chunk_size = app.config.get("IMPORT_CHUNK_SIZE", 500)
+    imported = 0
+    errors = []
+    chunk = []
+    lineno = 0
+    try:
+        async for line in ndjson_lines(request.body):
+            lineno += 1
+            try:
+                chunk.append(parse_import_line(line))
+            except (ValueError, TypeError, KeyError, IndexError) as e:
+                if len(errors) < 100:
+                    errors.append({"line": lineno, "error": str(e)})
+                continue
+            if len(chunk) >= chunk_size:
+                imported += await _import_chunk(user["id"], chunk)
+                chunk = []
+        if chunk:
+            imported += await _import_chunk(user["id"], chunk)
+    except ValueError as e:
+        errors.append({"line": lineno + 1, "error": str(e)})
+        return {"imported": imported, "errors": errors}, 400
+    return {"imported": imported, "errors": errors}
+
+
 @app.post("/users")
 @validate_request(UserIn)
 async def user_create(data: UserIn):
+    if limited := rate_limit(ip=request.remote_addr):
+        return limited
     admin_key = request.headers.get("x-admin-key", None)
     if admin_key != current_app.config["ADMIN_KEY"]:
         return Response(status=401)
@@ -0,0 +1,89 @@
+"""Admission control for hot-path database work.
+
+Everything restarter.hotpath runs goes through one thread, so when SQLite
+is busy (a backup, a long scan, another worker holding the write lock)
+calls queue up behind it. Each waiting ping holds a request, its memory
+and a client connection open until the client gives up.
+
+The controller tracks every hot-path call from submission until it
+finishes. Two signals decide whether a new ping is let in:
+
+- in-flight calls: how deep the queue is
+- queue wait: how long the oldest call that hasn't started yet has been
+  waiting. This is measured live, so it recovers as soon as the queue
+  drains, without waiting for a late sample.
+
+Over either limit the ping is shed right away with a 503 and a
+Retry-After, which costs far less than letting it queue and time out.
+Scans, deliveries and other background work are tracked too but never
+shed. Counts are per worker process.
+"""
+
+import math
+import time
+from collections import Counter
+
+
+class Ticket:
+    __slots__ = ("submitted", "started")
+
+    def __init__(self, submitted):
+        self.submitted = submitted
+        self.started = None
+
+
+class AdmissionController:
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        # Insertion ordered, so the first unstarted ticket is the oldest.
+        # Only changed on the event loop; the worker thread only sets
+        # Ticket.started.
+        self.tickets = {}
+        self.admitted = 0
+        self.shed = Counter()  # reason -> count
+        self.peak_in_flight = 0
+
+    @property
+    def in_flight(self):
+        return len(self.tickets)
+
+    def enter(self):
+        ticket = Ticket(self.clock())
+        self.tickets[ticket] = None
+        self.peak_in_flight = max(self.peak_in_flight, len(self.tickets))
+        return ticket
+
+    def leave(self, ticket):
+        self.tickets.pop(ticket, None)
+
+    def queue_wait(self):
+        """Seconds the oldest call that hasn't started has been waiting."""
+        for ticket in self.tickets:
+            if ticket.started is None:
+                return self.clock() - ticket.submitted
+        return 0.0
+
+    def admit(self, max_in_flight, max_queue_wait):
+        """Returns 0 to go ahead, or seconds the client should back off."""
+        wait = self.queue_wait()
+        if self.in_flight >= max_in_flight:
+            reason = "in_flight"
+        elif wait > max_queue_wait:
+            reason = "queue_wait"
+        else:
+            self.admitted += 1
+            return 0
+        self.shed[reason] += 1
+        return max(1, math.ceil(wait))
+
+    def snapshot(self):
+        return {
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "queue_wait": round(self.queue_wait(), 3),
+            "admitted": self.admitted,
+            "shed": dict(self.shed),
+        }
+
+
+controller = AdmissionController()
@@ -0,0 +1,131 @@
+"""Static assets: fingerprinted URLs, immutable caching, precompressed files.
+
+url_for("static", ...) gets a `v=<content hash>` query argument, and a
+request carrying the current hash is answered with a year-long immutable
+Cache-Control, so browsers stop asking for the logo and favicon on every
+dashboard load. Requests without it, or with a stale hash, get the file
+with the default headers.
+
+`python -m restarter.assets` writes .gz (and .br, when brotli from the
+speedups extra is installed) next to each static file at build time, keeping
+a variant only when it saves at least 10%; already-compressed images usually
+don't qualify. Requests that accept an encoding get the precompressed file.
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+import sys
+from functools import lru_cache
+
+from quart import abort, current_app, request, send_file
+from werkzeug.security import safe_join
+
+try:
+    import brotli
+except ModuleNotFoundError:
+    brotli = None
+
+# In order of preference
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+IMMUTABLE_MAX_AGE = 365 * 86400
+MIN_SAVING = 0.1
+
+
+@lru_cache(maxsize=256)
+def _digest(path, mtime_ns):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()[:12]
+
+
+def fingerprint(path):
+    """Short content hash of a file, or None if it doesn't exist."""
+    try:
+        return _digest(path, os.stat(path).st_mtime_ns)
+    except FileNotFoundError:
+        return None
+
+
+def add_fingerprint(endpoint, values):
+    """url_defaults hook adding the content hash to static URLs."""
+    if endpoint != "static" or "v" in values or "filename" not in values:
+        return
+    path = safe_join(current_app.static_folder, values["filename"])
+    if path and (digest := fingerprint(path)):
+        values["v"] = digest
+
+
+async def send_static(filename):
+    """Replacement for the app's static view."""
+    path = safe_join(current_app.static_folder, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    for encoding, suffix in ENCODINGS:
+        if encoding in request.accept_encodings and os.path.isfile(path + suffix):
+            response = await send_file(path + suffix, mimetype=mimetype)
+            response.content_encoding = encoding
+            break
+    else:
+        response = await send_file(path, mimetype=mimetype)
+    response.vary.add("Accept-Encoding")
+    if request.args.get("v") == fingerprint(path):
+        response.cache_control.public = True
+        response.cache_control.max_age = IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+    return await response.make_conditional(request)
+
+
+def init_app(app):
+    app.url_defaults(add_fingerprint)
+    app.view_functions["static"] = send_static
+
+
+def compressors():
+    yield ".gz", lambda data: gzip.compress(data, 9, mtime=0)
+    if brotli:
+        yield ".br", lambda data: brotli.compress(data, quality=11)
+
+
+def precompress(directory):
+    """Write compressed variants of the files under directory.
+
+    Returns (path, original size, {suffix: compressed size}) for each file;
+    variants that don't pay for themselves are removed rather than written.
+    """
+    suffixes = tuple(suffix for _, suffix in ENCODINGS)
+    results = []
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            if name.endswith(suffixes):
+                continue
+            path = os.path.join(root, name)
+            with open(path, "rb") as f:
+                data = f.read()
+            written = {}
+            for suffix, compress in compressors():
+                compressed = compress(data)
+                if len(compressed) <= len(data) * (1 - MIN_SAVING):
+                    with open(path + suffix, "wb") as f:
+                        f.write(compressed)
+                    written[suffix] = len(compressed)
+                elif os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+            results.append((path, len(data), written))
+    return results
+
+
+def main():
+    directory = (
+        sys.argv[1]
+        if len(sys.argv) > 1
+        else os.path.join(os.path.dirname(__file__), "static")
+    )
+    for path, size, written in precompress(directory):
+        variants = ", ".join(f"{s} {n} bytes" for s, n in written.items())
+        print(f"{path}: {size} bytes, {variants or 'not worth compressing'}")
+
+
+if __name__ == "__main__":
+    main()
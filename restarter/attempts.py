@@ -0,0 +1,147 @@
+"""Webhook delivery log.
+
+deliver_webhook records every request it makes (time, duration, status
+code, exception class, response size) with `record`, which only appends to
+an in-memory buffer. A background flusher writes the buffer in batches on
+the hot-path connection, one transaction per batch, and trims each webhook
+it touched back to its newest `keep` attempts, so the table stays bounded
+without a sweep. Attempts of deleted webhooks are purged by maintenance.
+
+The buffer is bounded too: if the database can't keep up, the oldest
+attempts are dropped and counted in `dropped`.
+"""
+
+import asyncio
+import math
+
+from . import hotpath
+
+INSERT_ATTEMPT = (
+    "INSERT INTO webhook_attempt (webhook_id, attempted_at, host, duration_ms, "
+    "status_code, error_class, response_bytes) "
+    "VALUES (:wi, :at, :host, :ms, :sc, :ec, :rb)"
+)
+# Everything older than the keep-th newest attempt of the webhook
+TRIM_ATTEMPTS = (
+    "DELETE FROM webhook_attempt WHERE webhook_id=:wi AND id <= "
+    "(SELECT id FROM webhook_attempt WHERE webhook_id=:wi "
+    "ORDER BY id DESC LIMIT 1 OFFSET :keep)"
+)
+
+pending = []
+dropped = 0
+flusher = None
+
+
+def record(
+    webhook_ids,
+    host,
+    attempted_at,
+    duration,
+    status_code=None,
+    error_class=None,
+    response_bytes=None,
+    max_pending=10_000,
+):
+    """Buffer one delivery attempt for each of the webhooks it was sent for."""
+    global dropped
+
+    for wid in webhook_ids:
+        pending.append(
+            {
+                "wi": wid,
+                "at": attempted_at,
+                "host": host,
+                "ms": round(duration * 1000, 3),
+                "sc": status_code,
+                "ec": error_class,
+                "rb": response_bytes,
+            }
+        )
+    if len(pending) > max_pending:
+        excess = len(pending) - max_pending
+        del pending[:excess]
+        dropped += excess
+
+
+def _write_attempts(conn, batch, keep):
+    conn.executemany(INSERT_ATTEMPT, batch)
+    for wid in {a["wi"] for a in batch}:
+        conn.execute(TRIM_ATTEMPTS, {"wi": wid, "keep": keep})
+
+
+async def flush(keep=100, batch_size=500):
+    """Write out everything buffered so far; returns the number written."""
+    written = 0
+    while pending:
+        batch = pending[:batch_size]
+        del pending[:batch_size]
+        try:
+            # Shielded so a cancelled flusher doesn't lose a batch mid-write
+            await asyncio.shield(
+                hotpath.run(hotpath._write, _write_attempts, batch, keep)
+            )
+        except Exception:
+            # Rolled back; put them back for the next flush
+            pending[:0] = batch
+            raise
+        written += len(batch)
+    return written
+
+
+async def flush_forever(interval, keep):
+    from . import app
+
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await flush(keep)
+        except Exception:
+            app.logger.exception("Writing webhook attempts failed")
+
+
+def start(interval=1, keep=100):
+    global flusher
+
+    if flusher is None:
+        flusher = asyncio.create_task(flush_forever(interval, keep))
+
+
+async def stop(keep=100):
+    global flusher
+
+    if flusher is not None:
+        flusher.cancel()
+        await asyncio.gather(flusher, return_exceptions=True)
+        flusher = None
+    await flush(keep)
+
+
+def percentile(ordered, q):
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return None
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+
+def summarize(rows):
+    """Per destination host: attempt and failure counts, latency percentiles."""
+    by_host = {}
+    for row in rows:
+        by_host.setdefault(row["host"], []).append(row)
+    summary = {}
+    for host, attempts in by_host.items():
+        latencies = sorted(a["duration_ms"] for a in attempts)
+        summary[host] = {
+            "attempts": len(attempts),
+            "failures": sum(
+                1
+                for a in attempts
+                if a["error_class"] or (a["status_code"] or 0) >= 400
+            ),
+            "p50_ms": percentile(latencies, 0.5),
+            "p90_ms": percentile(latencies, 0.9),
+            "p99_ms": percentile(latencies, 0.99),
+            "max_ms": latencies[-1],
+        }
+    return summary
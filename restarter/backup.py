@@ -0,0 +1,96 @@
+"""Online backups of the SQLite database.
+
+Backups are taken with `VACUUM INTO` from a read-only connection. With the
+database in WAL mode that connection reads a single consistent snapshot
+while pings keep committing to the WAL, so writers are never blocked and
+the copy is never torn. SQLite's page-stepping backup API isn't used
+because it restarts from scratch whenever another connection writes, which
+under steady ping traffic means it may never finish.
+
+Backups are written to a directory as restarter-<timestamp>.db and rotated,
+keeping the newest `keep`.
+"""
+
+import fcntl
+import os
+import sqlite3
+import time
+from contextlib import closing
+from dataclasses import dataclass
+from datetime import UTC, datetime
+
+PREFIX = "restarter-"
+
+
+class BackupInProgress(Exception):
+    pass
+
+
+@dataclass
+class BackupReport:
+    path: str | None
+    duration: float
+    pages: int
+    bytes: int
+    removed: list
+
+
+def list_backups(backup_dir):
+    """Backup files in backup_dir, oldest first."""
+    try:
+        names = os.listdir(backup_dir)
+    except FileNotFoundError:
+        return []
+    return sorted(
+        os.path.join(backup_dir, n)
+        for n in names
+        if n.startswith(PREFIX) and n.endswith(".db")
+    )
+
+
+def rotate(backup_dir, keep):
+    removed = list_backups(backup_dir)[:-keep] if keep > 0 else []
+    for path in removed:
+        os.remove(path)
+    return removed
+
+
+def run_backup(db_path, backup_dir, keep=7, min_age=0):
+    """Write a backup of db_path into backup_dir. Blocking; run it in a thread.
+
+    Raises BackupInProgress if another process is already backing up into
+    the same directory. If the newest backup is younger than min_age seconds
+    nothing is written (path is None); this keeps each worker's scheduler
+    from taking its own copy.
+    """
+    os.makedirs(backup_dir, exist_ok=True)
+    with open(os.path.join(backup_dir, ".lock"), "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise BackupInProgress(backup_dir) from None
+
+        existing = list_backups(backup_dir)
+        if min_age and existing:
+            if time.time() - os.path.getmtime(existing[-1]) < min_age:
+                return BackupReport(None, 0, 0, 0, [])
+
+        stamp = datetime.now(UTC).strftime("%Y%m%dT%H%M%S%fZ")
+        path = os.path.join(backup_dir, f"{PREFIX}{stamp}.db")
+        tmp_path = path + ".tmp"
+        start = time.perf_counter()
+        src = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        with closing(src):
+            src.execute("VACUUM INTO ?", (tmp_path,))
+        with closing(sqlite3.connect(tmp_path)) as dst:
+            pages = dst.execute("PRAGMA page_count").fetchone()[0]
+        # Only complete backups ever carry the final name
+        os.replace(tmp_path, path)
+        duration = time.perf_counter() - start
+        return BackupReport(
+            path=path,
+            duration=duration,
+            pages=pages,
+            bytes=os.path.getsize(path),
+            removed=rotate(backup_dir, keep),
+        )
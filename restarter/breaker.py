@@ -0,0 +1,94 @@
+"""Per-host circuit breakers for webhook deliveries.
+
+A breaker starts closed. After `failure_threshold` consecutive failures it
+opens and deliveries to that host are skipped. A skipped delivery counts as a
+failed attempt: the webhook was already marked called when the delivery was
+queued, so it's the outbox row that is retried, on retry_outbox's backoff,
+until OUTBOX_MAX_ATTEMPTS. Once `reset_timeout` seconds have passed it goes
+half-open and lets a single probe through: success closes it, failure
+opens it again.
+
+State is kept per worker process. Only hosts that have failed recently have
+an entry, so the registry stays as small as the set of misbehaving hosts.
+"""
+
+import time
+from dataclasses import dataclass, field
+from typing import Callable
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+@dataclass
+class CircuitBreaker:
+    failure_threshold: int = 5
+    reset_timeout: float = 300
+    clock: Callable[[], float] = field(default=time.monotonic, repr=False)
+    state: str = CLOSED
+    failures: int = 0
+    opened_at: float | None = None
+    probe_started_at: float | None = None
+
+    def allow(self):
+        now = self.clock()
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            if now - self.opened_at < self.reset_timeout:
+                return False
+            self.state = HALF_OPEN
+            self.probe_started_at = now
+            return True
+        # Half-open: one probe at a time, unless the last one never reported
+        if now - self.probe_started_at >= self.reset_timeout:
+            self.probe_started_at = now
+            return True
+        return False
+
+    def record_success(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = OPEN
+            self.opened_at = self.clock()
+            self.probe_started_at = None
+
+    def snapshot(self):
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "open_for": (
+                round(self.clock() - self.opened_at, 1) if self.opened_at else None
+            ),
+        }
+
+
+breakers = {}
+
+
+def get_breaker(host, failure_threshold=5, reset_timeout=300):
+    cb = breakers.get(host)
+    if cb is None:
+        cb = CircuitBreaker(
+            failure_threshold=failure_threshold, reset_timeout=reset_timeout
+        )
+        breakers[host] = cb
+    return cb
+
+
+def record_success(host):
+    # Healthy hosts don't need to be tracked
+    cb = breakers.pop(host, None)
+    if cb:
+        cb.record_success()
+
+
+def snapshot():
+    return {host: cb.snapshot() for host, cb in breakers.items()}
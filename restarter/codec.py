@@ -0,0 +1,70 @@
+"""JSON encoding for the hot paths, using orjson when it's installed.
+
+Webhook headers and form fields are encoded on every insert and decoded on
+every delivery, exports encode a line per monitor, and API responses go
+through the app's JSON provider. orjson is several times faster than the
+stdlib at all of these; it's an optional dependency (the `speedups` extra)
+and everything falls back to `json` without it.
+
+Output differs only in whitespace and in not escaping non-ASCII characters,
+so data written by either backend reads back the same with the other.
+"""
+
+import json
+
+try:
+    import orjson
+except ModuleNotFoundError:
+    orjson = None
+
+
+def dumps(obj, default=None):
+    """Encode obj to a str, for storing in a TEXT column.
+
+    default is called for objects neither backend knows how to encode.
+    """
+    if orjson:
+        return orjson.dumps(obj, default=default).decode()
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, default=default)
+
+
+def dumpb(obj):
+    """Encode obj to UTF-8 bytes, for writing to a response body."""
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def loads(data):
+    """Decode str or bytes; invalid input raises a ValueError subclass."""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def install_json_provider(app):
+    """Have the app's JSON provider encode responses with orjson.
+
+    Subclasses whatever provider is installed (quart-schema's, which knows
+    about pydantic types) so its `default` still handles anything orjson
+    doesn't. Dates keep going through it too, so responses still carry
+    them in the HTTP date format. Debug-mode indentation and other custom
+    arguments use the stdlib path unchanged.
+    """
+    if not orjson:
+        return
+    base = type(app.json)
+    options = orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+    class OrjsonProvider(base):
+        def dumps(self, obj, **kwargs):
+            if kwargs.keys() - {"separators"}:
+                return super().dumps(obj, **kwargs)
+            return orjson.dumps(obj, default=self.default, option=options).decode()
+
+        def loads(self, s, **kwargs):
+            if kwargs:
+                return super().loads(s, **kwargs)
+            return orjson.loads(s)
+
+    app.json = OrjsonProvider(app)
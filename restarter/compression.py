@@ -0,0 +1,104 @@
+"""Opt-in gzip compression of large HTML and JSON responses.
+
+An ASGI middleware, wrapped around the app like the proxy headers one.
+Responses are compressed when the client accepts gzip, the content type is
+HTML or JSON (including NDJSON exports), nothing set a Content-Encoding
+already, and the body is at least `minimum_size` bytes. A body that arrives
+in several chunks (a streamed export) is compressed as it streams; only
+the first `minimum_size` bytes are held back to decide.
+"""
+
+import zlib
+
+COMPRESSIBLE_TYPES = (
+    b"text/html",
+    b"application/json",
+    b"application/x-ndjson",
+)
+
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size=1024, level=6):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.level = level
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not accepts_gzip(scope):
+            return await self.app(scope, receive, send)
+        responder = GzipResponder(send, self.minimum_size, self.level)
+        await self.app(scope, receive, responder.send)
+
+
+def accepts_gzip(scope):
+    for name, value in scope["headers"]:
+        if name.lower() == b"accept-encoding":
+            return b"gzip" in value.lower()
+    return False
+
+
+class GzipResponder:
+    def __init__(self, send, minimum_size, level):
+        self._send = send
+        self.minimum_size = minimum_size
+        self.level = level
+        self.start = None
+        self.compressor = None
+        self.passthrough = False
+        self.pending = b""
+
+    async def send(self, message):
+        if message["type"] == "http.response.start":
+            self.start = message
+            self.passthrough = not self.compressible(message)
+            if self.passthrough:
+                await self._send(message)
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            return await self._send(message)
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.compressor is None:
+            # Frameworks often send the whole body and then an empty final
+            # chunk, so hold small chunks back until the size is known
+            body = self.pending + body
+            if more_body and len(body) < self.minimum_size:
+                self.pending = body
+                return
+            if not more_body and len(body) < self.minimum_size:
+                self.passthrough = True
+                await self._send(self.start)
+                return await self._send({**message, "body": body})
+            self.compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+            await self._send(self.compressed_start())
+
+        data = self.compressor.compress(body)
+        if not more_body:
+            data += self.compressor.flush()
+        if data or not more_body:
+            await self._send(
+                {"type": "http.response.body", "body": data, "more_body": more_body}
+            )
+
+    def compressible(self, start):
+        if start["status"] < 200 or start["status"] in (204, 206, 304):
+            return False
+        headers = {name.lower(): value for name, value in start.get("headers", [])}
+        if b"content-encoding" in headers:
+            return False
+        content_type = headers.get(b"content-type", b"").lower()
+        return content_type.startswith(COMPRESSIBLE_TYPES)
+
+    def compressed_start(self):
+        headers = []
+        for name, value in self.start.get("headers", []):
+            if name.lower() == b"content-length":
+                continue
+            if name.lower() == b"etag" and not value.startswith(b"W/"):
+                # The compressed bytes differ, so the tag is weak now
+                value = b"W/" + value
+            headers.append((name, value))
+        headers.append((b"content-encoding", b"gzip"))
+        headers.append((b"vary", b"Accept-Encoding"))
+        return {**self.start, "headers": headers}
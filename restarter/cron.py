@@ -0,0 +1,175 @@
+"""Small cron expression evaluator for scheduled monitors.
+
+Supports the five standard fields (minute, hour, day of month, month, day of
+week) with `*`, lists, ranges, steps and month/day names, plus the @hourly,
+@daily, @weekly, @monthly and @yearly shortcuts. As in Vixie cron, when both
+day of month and day of week are restricted a day matching either one fires.
+All times are UTC.
+
+Each field is expanded once, at parse time, into a lookup table or bitmask,
+so finding a fire time is integer arithmetic on epoch minutes. Parsed
+expressions and computed fire times are also cached: many monitors share a
+handful of schedules, and every ping within the same minute for the same
+schedule has the same next fire time.
+"""
+
+from dataclasses import dataclass
+from datetime import date
+from functools import lru_cache
+
+MACROS = {
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+    "@monthly": "0 0 1 * *",
+    "@weekly": "0 0 * * 0",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@hourly": "0 * * * *",
+}
+MONTHS = "jan feb mar apr may jun jul aug sep oct nov dec".split()
+WEEKDAYS = "sun mon tue wed thu fri sat".split()
+
+# (low, high, names) for minute, hour, day of month, month, day of week
+FIELDS = (
+    (0, 59, None),
+    (0, 23, None),
+    (1, 31, None),
+    (1, 12, {name: i + 1 for i, name in enumerate(MONTHS)}),
+    (0, 7, {name: i for i, name in enumerate(WEEKDAYS)}),
+)
+
+# Give up looking for a fire time after this many steps; only reachable by
+# schedules like "0 0 30 2 *" that can never fire.
+MAX_STEPS = 5000
+
+EPOCH = date(1970, 1, 1).toordinal()
+
+
+@lru_cache(maxsize=1024)
+def _bits(values):
+    return sum(1 << v for v in values)
+
+
+@lru_cache(maxsize=1024)
+def _next_table(values, size):
+    """Entry i is the first value >= i, or size if there is none."""
+    table = [size]
+    for i in range(size - 1, -1, -1):
+        table.append(i if i in values else table[-1])
+    return tuple(reversed(table))
+
+
+@dataclass(frozen=True)
+class Schedule:
+    first_minute: int
+    next_minute: tuple  # 61 entries, 60 means none left this hour
+    next_hour: tuple  # 25 entries, 24 means none left this day
+    days: int  # bitmask of days of the month
+    months: int  # bitmask of months, January is bit 1
+    weekdays: int  # bitmask of Python weekday numbers, Monday is bit 0
+    every_day: bool  # day of month, month and day of week are all *
+    either_day: bool  # both day fields restricted, either one matches
+
+    def day_matches(self, when):
+        dom = self.days >> when.day & 1
+        dow = self.weekdays >> when.weekday() & 1
+        return dom or dow if self.either_day else dom and dow
+
+    def search(self, minute):
+        """First fire time at or after `minute`, both in epoch minutes."""
+        day, minute = divmod(minute, 1440)
+        hour, minute = divmod(minute, 60)
+        day += EPOCH
+        for _ in range(MAX_STEPS):
+            if not self.every_day:
+                when = date.fromordinal(day)
+                if not self.months >> when.month & 1:
+                    year, month = divmod(when.year * 12 + when.month, 12)
+                    day = date(year, month + 1, 1).toordinal()
+                    hour = minute = 0
+                    continue
+                if not self.day_matches(when):
+                    day, hour, minute = day + 1, 0, 0
+                    continue
+            h = self.next_hour[hour]
+            if h == hour:
+                m = self.next_minute[minute]
+                if m < 60:
+                    return (day - EPOCH) * 1440 + h * 60 + m
+                h = self.next_hour[hour + 1]
+            if h < 24:
+                return (day - EPOCH) * 1440 + h * 60 + self.first_minute
+            day, hour, minute = day + 1, 0, 0
+        raise ValueError("cron expression never fires")
+
+
+def _value(token, names):
+    if names and token.lower() in names:
+        return names[token.lower()]
+    return int(token)
+
+
+def parse_field(spec, low, high, names=None):
+    if spec == "*":
+        return set(range(low, high + 1))
+    values = set()
+    for part in spec.split(","):
+        rng, _, step = part.partition("/")
+        step = int(step) if step else 1
+        if step < 1:
+            raise ValueError(f"bad step in {part!r}")
+        if rng == "*":
+            start, end = low, high
+        elif "-" in rng:
+            start, end = (_value(t, names) for t in rng.split("-", 1))
+        else:
+            start = _value(rng, names)
+            end = high if step > 1 else start
+        if not low <= start <= end <= high:
+            raise ValueError(f"{part!r} out of range {low}-{high}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+@lru_cache(maxsize=1024)
+def _field(spec, index):
+    # Schedules share most of their fields ("*", "0", "1-5"), so each field
+    # is expanded once and its lookups are reused across schedules.
+    return frozenset(parse_field(spec, *FIELDS[index]))
+
+
+@lru_cache(maxsize=1024)
+def parse(expr):
+    """Parse a cron expression into a Schedule, raising ValueError if invalid."""
+    expr = MACROS.get(expr.strip().lower(), expr)
+    specs = expr.split()
+    if len(specs) != 5:
+        raise ValueError("cron expression must have 5 fields")
+    try:
+        minutes, hours, days, months, weekdays = (
+            _field(spec, i) for i, spec in enumerate(specs)
+        )
+    except ValueError as e:
+        raise ValueError(f"invalid cron expression {expr!r}: {e}") from None
+    any_day, any_weekday = specs[2] == "*", specs[4] == "*"
+    return Schedule(
+        first_minute=min(minutes),
+        next_minute=_next_table(minutes, 60),
+        next_hour=_next_table(hours, 24),
+        days=_bits(days),
+        months=_bits(months),
+        # cron counts from Sunday (0 or 7), Python from Monday
+        weekdays=_bits(frozenset((d - 1) % 7 for d in weekdays)),
+        every_day=any_day and any_weekday and len(months) == 12,
+        either_day=not (any_day or any_weekday),
+    )
+
+
+@lru_cache(maxsize=65536)
+def _next_fire_after_minute(expr, minute):
+    return parse(expr).search(minute + 1) * 60.0
+
+
+def next_fire(expr, after):
+    """Epoch seconds of the first time `expr` fires strictly after `after`."""
+    return _next_fire_after_minute(expr, int(after // 60))
@@ -1,12 +1,16 @@
 import logging
+import secrets
+import sqlite3
+from contextlib import closing
 from datetime import datetime, UTC
-import json
 
 import sqlalchemy as sa
 from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.exc import IntegrityError, NoResultFound  # noqa
+from sqlalchemy.pool import NullPool
 from sqlalchemy.sql import text
 
+from . import codec, cron, hotpath
 
 logger = logging.getLogger(__name__)
 
@@ -14,19 +18,202 @@ meta = sa.MetaData()
 
 
 engine = None
+read_engine = None
+export_engine = None
+
+# Latest revision in alembic/versions; bump it along with every new migration.
+HEAD_REVISION = "d2b6f0e8a351"
 
 
 def get_engine():
+    """Read-write engine, for creating the schema in tests and benchmarks.
+
+    The app doesn't write through it: every write function below runs on
+    the hot-path thread (hotpath.run), so a worker has one writer, and
+    writes queue in its executor instead of retrying against SQLite's busy
+    timeout. SELECT-only functions use get_read_engine().
+    """
     from . import app
 
     global engine
 
     if not engine:
         dbfile = app.config.get("DATABASE")
-        engine = create_async_engine(f"sqlite+aiosqlite:///{dbfile}", echo=False)
+        engine = create_async_engine(
+            f"sqlite+aiosqlite:///{dbfile}",
+            echo=False,
+            pool_size=1,
+            max_overflow=0,
+        )
+        sa.event.listen(engine.sync_engine, "connect", _set_sqlite_pragmas)
     return engine
 
 
+def get_read_engine():
+    """Engine for SELECTs, on a pool of read-only connections.
+
+    With WAL each reader works from its own snapshot alongside the writer.
+    The connections are opened with mode=ro and query_only, so a write
+    that ends up here by mistake fails instead of taking the lock.
+    """
+    from . import app
+
+    global read_engine
+
+    if not read_engine:
+        read_engine = _create_read_only_engine(
+            app.config.get("DATABASE"),
+            pool_size=app.config.get("DATABASE_READ_POOL_SIZE", 4),
+            max_overflow=0,
+        )
+    return read_engine
+
+
+def get_export_engine():
+    """Engine for exports, which hold their connection for a whole download.
+
+    Read-only like get_read_engine(), but without a pool: each export opens
+    its own connection and closes it when done, so slow clients can't tie up
+    the connections that API reads wait on.
+    """
+    from . import app
+
+    global export_engine
+
+    if not export_engine:
+        export_engine = _create_read_only_engine(
+            app.config.get("DATABASE"), poolclass=NullPool
+        )
+    return export_engine
+
+
+def _create_read_only_engine(dbfile, **pool_options):
+    read_only = create_async_engine(
+        f"sqlite+aiosqlite:///file:{dbfile}?mode=ro&uri=true",
+        echo=False,
+        **pool_options,
+    )
+    sa.event.listen(read_only.sync_engine, "connect", _set_query_only)
+    return read_only
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers (backups, dashboards) run alongside the writer. The
+    # setting is persistent, so after the first connection this is a no-op.
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.close()
+
+
+def _set_query_only(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA query_only=ON")
+    cursor.close()
+
+
+def current_revision(dbfile):
+    """Schema revision recorded by alembic, or None if there isn't one yet."""
+    try:
+        with closing(sqlite3.connect(f"file:{dbfile}?mode=ro", uri=True)) as conn:
+            row = conn.execute("SELECT version_num FROM alembic_version").fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return row[0] if row else None
+
+
+def create_schema(dbfile):
+    """Create the schema at HEAD_REVISION, if the database has no tables yet.
+
+    Running every migration on a new file costs a transaction per revision
+    and a full VACUUM, on top of loading alembic; this creates the same
+    tables and indexes from `meta` in one transaction and records
+    HEAD_REVISION as alembic would. Returns False, without changing
+    anything, if the database already has tables.
+    """
+    with closing(sqlite3.connect(dbfile, isolation_level=None)) as conn:
+        # Only possible before the first table is created; migrations have
+        # to VACUUM to switch
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT 1 FROM sqlite_master").fetchone():
+                conn.execute("ROLLBACK")
+                return False
+            dialect = sa.create_engine("sqlite://").dialect
+            for table in meta.sorted_tables:
+                conn.execute(str(sa.schema.CreateTable(table).compile(dialect=dialect)))
+                for index in table.indexes:
+                    conn.execute(
+                        str(sa.schema.CreateIndex(index).compile(dialect=dialect))
+                    )
+            conn.execute(
+                "CREATE TABLE alembic_version (version_num VARCHAR(32) NOT NULL, "
+                "CONSTRAINT alembic_version_pkc PRIMARY KEY (version_num))"
+            )
+            conn.execute(
+                "INSERT INTO alembic_version VALUES (:revision)",
+                {"revision": HEAD_REVISION},
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    return True
+
+
+def next_deadline(now_ts, frequency, schedule=None, grace=None):
+    """expires_at for a monitor pinged at now_ts."""
+    if schedule:
+        return cron.next_fire(schedule, now_ts) + (grace or 0)
+    return now_ts + frequency
+
+
+def _rowcount(conn, query, params):
+    """For hotpath.run(hotpath._write, ...): one statement, rows changed."""
+    return conn.execute(query, params).rowcount
+
+
+def _datetime_param(value):
+    # How SQLAlchemy stores DateTime columns, so they compare as strings
+    return value.strftime("%Y-%m-%d %H:%M:%S.%f")
+
+
+# Invalidate cached dashboards; run in the same transaction as the change
+BUMP_DASHBOARD = "UPDATE user SET dashboard_version=dashboard_version + 1 WHERE id=:ui"
+BUMP_DASHBOARD_BY_MONITOR = (
+    "UPDATE user SET dashboard_version=dashboard_version + 1 "
+    "WHERE id=(SELECT user_id FROM monitor WHERE id=:mi)"
+)
+
+
+# paused_until for pauses without an end: 9999-12-31T23:59:59Z
+PAUSED_INDEFINITELY = 253402300799
+
+INSERT_TAG = (
+    "INSERT OR IGNORE INTO monitor_tag (user_id, tag, monitor_id) "
+    "VALUES (:ui, :tag, :mi)"
+)
+# Pause (or, with :pu NULL, resume) a user's monitors by tag or slug pattern;
+# each is a single UPDATE driven by an index range. Rows already in that state
+# are left alone, so repeating a pause or resume doesn't rewrite them. A
+# resumed monitor gets a full period from :now, as if it had just been
+# pinged, so deadlines missed while it was paused don't all alert at once.
+# next_deadline is registered on the hot-path connection.
+PAUSE_BY_TAG = (
+    "UPDATE monitor SET paused_until=:pu, expires_at=CASE WHEN :pu IS NULL "
+    "THEN next_deadline(:now, frequency, schedule, grace) ELSE expires_at END "
+    "WHERE id IN "
+    "(SELECT monitor_id FROM monitor_tag WHERE user_id=:ui AND tag=:tag) "
+    "AND slug GLOB :sp AND paused_until IS NOT :pu"
+)
+PAUSE_BY_SLUG = (
+    "UPDATE monitor SET paused_until=:pu, expires_at=CASE WHEN :pu IS NULL "
+    "THEN next_deadline(:now, frequency, schedule, grace) ELSE expires_at END "
+    "WHERE user_id=:ui AND slug GLOB :sp AND paused_until IS NOT :pu"
+)
+
+
 def utcnow():
     return datetime.now(UTC)
 
@@ -35,29 +222,52 @@ t_users = sa.Table(
     "user",
     meta,
     sa.Column("id", sa.Integer, primary_key=True),
-    sa.Column("email", sa.Text, nullable=False, unique=True),
+    sa.Column("email", sa.Text, nullable=False),
     sa.Column("password", sa.Text, nullable=False),
     sa.Column("user_key", sa.Text, nullable=False),
     sa.Column("deleted_at", sa.DateTime),
+    # Bumped whenever the user's monitor table on the dashboard changes
+    sa.Column("dashboard_version", sa.Integer, nullable=False, server_default="0"),
     sa.Column("created_at", sa.DateTime, default=datetime.now),
     sa.Column(
         "updated_at", sa.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow
     ),
+    # Constraint names as the migrations create them, see create_schema
+    sa.UniqueConstraint("email", name="unique_email"),
 )
 t_monitors = sa.Table(
     "monitor",
     meta,
     sa.Column("id", sa.Integer, primary_key=True),
-    sa.Column("user_id", sa.Integer, sa.ForeignKey("user.id"), nullable=False),
+    sa.Column(
+        "user_id",
+        sa.Integer,
+        sa.ForeignKey("user.id", name="fk_user_id_user"),
+        nullable=False,
+    ),
     sa.Column("name", sa.Text, nullable=False),
     sa.Column("slug", sa.Text, nullable=False),
     sa.Column("frequency", sa.Integer, nullable=False),
     sa.Column("expires_at", sa.Integer, nullable=False),
     sa.Column("api_key", sa.Text, nullable=False),
     sa.Column("last_check", sa.DateTime, nullable=True),
+    sa.Column("schedule", sa.Text, nullable=True),  # cron expression
+    sa.Column("grace", sa.Integer, nullable=True),  # seconds after a scheduled run
+    # No alerts until then; PAUSED_INDEFINITELY until resumed
+    sa.Column("paused_until", sa.Integer, nullable=True),
     sa.UniqueConstraint("user_id", "slug", name="uix_user_id_slug"),
 )
 
+# user_id is copied from the monitor so a user's tag is one index range
+t_monitor_tags = sa.Table(
+    "monitor_tag",
+    meta,
+    sa.Column("user_id", sa.Integer, primary_key=True),
+    sa.Column("tag", sa.Text, primary_key=True),
+    sa.Column("monitor_id", sa.Integer, sa.ForeignKey("monitor.id"), primary_key=True),
+    sqlite_with_rowid=False,
+)
+
 t_webhooks = sa.Table(
     "webhook",
     meta,
@@ -77,14 +287,87 @@ t_webhooks = sa.Table(
     ),  # timestamp of last time we called this webhook
 )
 
+# Webhook deliveries queued by the expiry scan, sent by the dispatchers
+t_outbox = sa.Table(
+    "outbox",
+    meta,
+    sa.Column("id", sa.Integer, primary_key=True),
+    sa.Column("webhook_ids", sa.Text, nullable=False),  # json list
+    sa.Column("url", sa.Text, nullable=False),
+    sa.Column("method", sa.Text, nullable=False),
+    sa.Column("headers", sa.Text, nullable=True),
+    sa.Column("form_fields", sa.Text, nullable=True),
+    sa.Column("created_at", sa.Integer, nullable=False),
+    sa.Column("available_at", sa.Integer, nullable=False),  # claimable after
+    sa.Column("attempts", sa.Integer, nullable=False, server_default="0"),
+    sa.Column("lease_token", sa.Text, nullable=True),
+    sa.Column("done_at", sa.Integer, nullable=True),
+    sa.Column("last_error", sa.Text, nullable=True),
+)
+
+# One row per webhook request, written in batches by restarter.attempts
+t_webhook_attempts = sa.Table(
+    "webhook_attempt",
+    meta,
+    sa.Column("id", sa.Integer, primary_key=True),
+    sa.Column("webhook_id", sa.Integer, nullable=False),
+    sa.Column("attempted_at", sa.Integer, nullable=False),  # timestamp
+    sa.Column("host", sa.Text, nullable=False),
+    sa.Column("duration_ms", sa.Float, nullable=False),
+    sa.Column("status_code", sa.Integer, nullable=True),  # NULL if no response
+    sa.Column("error_class", sa.Text, nullable=True),  # exception, if any
+    sa.Column("response_bytes", sa.Integer, nullable=True),
+)
+
+# Progress of the background data migrations in restarter.datamigrations
+t_data_migrations = sa.Table(
+    "data_migration",
+    meta,
+    sa.Column("name", sa.Text, primary_key=True),
+    # Where the next batch starts, e.g. the last id done; NULL before the first
+    sa.Column("cursor", sa.Integer, nullable=True),
+    sa.Column("rows", sa.Integer, nullable=False, server_default="0"),
+    sa.Column("batches", sa.Integer, nullable=False, server_default="0"),
+    sa.Column("started_at", sa.Integer, nullable=True),  # timestamp
+    sa.Column("finished_at", sa.Integer, nullable=True),  # timestamp
+    sqlite_with_rowid=False,
+)
+
 sa.Index("idx_apikey_slug", t_monitors.c.api_key, t_monitors.c.slug)
-sa.Index("idx_expires_at", t_monitors.c.expires_at)
+sa.Index(
+    "idx_expires_at_paused_until",
+    t_monitors.c.expires_at,
+    t_monitors.c.paused_until,
+)
+sa.Index("idx_monitor_tag_monitor_id", t_monitor_tags.c.monitor_id)
+sa.Index("idx_webhook_monitor_id", t_webhooks.c.monitor_id)
+sa.Index(
+    "idx_outbox_pending",
+    t_outbox.c.available_at,
+    sqlite_where=t_outbox.c.done_at.is_(None),
+)
+sa.Index("idx_user_user_key", t_users.c.user_key)
+sa.Index(
+    "idx_user_deleted_at",
+    t_users.c.deleted_at,
+    sqlite_where=t_users.c.deleted_at.isnot(None),
+)
+sa.Index(
+    "idx_outbox_done_at",
+    t_outbox.c.done_at,
+    sqlite_where=t_outbox.c.done_at.isnot(None),
+)
+sa.Index(
+    "idx_webhook_attempt_webhook_id",
+    t_webhook_attempts.c.webhook_id,
+    t_webhook_attempts.c.id,
+)
 
 
 async def get_monitor_by_api_key_slug(api_key, slug):
     query = "SELECT * from monitor " "WHERE api_key=:ap AND slug=:sl"
     statement = text(query)
-    async with get_engine().connect() as conn:
+    async with get_read_engine().connect() as conn:
         result = await conn.execute(statement, {"ap": api_key, "sl": slug})
         r = result.mappings().fetchone()
     return r
@@ -93,25 +376,64 @@ async def get_monitor_by_api_key_slug(api_key, slug):
 async def get_monitor_by_key(api_key):
     query = "SELECT * from monitor " "WHERE api_key=:ap"
     statement = text(query)
-    async with get_engine().connect() as conn:
+    async with get_read_engine().connect() as conn:
         result = await conn.execute(statement, {"ap": api_key})
         r = result.mappings().fetchone()
     return r
 
 
+async def get_monitor_by_user_id_slug(user_id, slug):
+    query = "SELECT * from monitor WHERE user_id=:ui AND slug=:sl"
+    statement = text(query)
+    async with get_read_engine().connect() as conn:
+        result = await conn.execute(statement, {"ui": user_id, "sl": slug})
+        r = result.mappings().fetchone()
+    return r
+
+
 async def get_monitors_by_user_id(uid):
     query = "SELECT * from monitor LEFT JOIN webhook on monitor.id=webhook.monitor_id WHERE user_id=:uid"
     statement = text(query)
-    async with get_engine().connect() as conn:
+    async with get_read_engine().connect() as conn:
         result = await conn.execute(statement, {"uid": uid})
         r = result.mappings().fetchall()
     return r
 
 
+async def get_last_checks(uid):
+    query = "SELECT slug, last_check FROM monitor WHERE user_id=:uid"
+    statement = text(query)
+    async with get_read_engine().connect() as conn:
+        result = await conn.execute(statement, {"uid": uid})
+        r = result.mappings().fetchall()
+    return r
+
+
+async def get_webhook_attempts(user_id, slug, limit=-1):
+    """Retained delivery attempts for a user's monitor, newest first.
+
+    At most `limit` of them; all of them by default.
+    """
+    query = (
+        "SELECT webhook_attempt.*, webhook.url FROM monitor "
+        "JOIN webhook ON webhook.monitor_id=monitor.id "
+        "JOIN webhook_attempt ON webhook_attempt.webhook_id=webhook.id "
+        "WHERE monitor.user_id=:ui AND monitor.slug=:sl "
+        "ORDER BY webhook_attempt.id DESC LIMIT :limit"
+    )
+    statement = text(query)
+    async with get_read_engine().connect() as conn:
+        result = await conn.execute(
+            statement, {"ui": user_id, "sl": slug, "limit": limit}
+        )
+        r = result.mappings().fetchall()
+    return r
+
+
 async def get_user_by_user_key(user_key):
     query = "SELECT * from user WHERE user_key=:uk"
     statement = text(query)
-    async with get_engine().connect() as conn:
+    async with get_read_engine().connect() as conn:
         result = await conn.execute(statement, {"uk": user_key})
         r = result.mappings().fetchone()
     return r
@@ -120,7 +442,7 @@ async def get_user_by_user_key(user_key):
 async def get_user_by_user_id(user_id):
     query = "SELECT * from user WHERE id=:ui"
     statement = text(query)
-    async with get_engine().connect() as conn:
+    async with get_read_engine().connect() as conn:
         result = await conn.execute(statement, {"ui": user_id})
         r = result.mappings().fetchone()
     return r
@@ -129,186 +451,441 @@ async def get_user_by_user_id(user_id):
 async def get_user_by_email(email):
     query = "SELECT * from user WHERE email=:em"
     statement = text(query)
-    async with get_engine().connect() as conn:
+    async with get_read_engine().connect() as conn:
         result = await conn.execute(statement, {"em": email})
         r = result.mappings().one()
     return r
 
 
-async def get_expired_monitors():
-    when = datetime.timestamp(datetime.now(UTC))
+def _insert_monitor(
+    conn, user_id, name, api_key, frequency, slug, schedule, grace, tags
+):
     query = (
-        "SELECT monitor.id as mid,webhook.id as wid,webhook.url,"
-        "webhook.method,webhook.headers, "
-        "webhook.form_fields, webhook.body_payload "
-        "FROM monitor LEFT JOIN webhook ON  monitor.id=webhook.monitor_id "
-        "WHERE expires_at < :when"
+        "INSERT INTO monitor (user_id, name, api_key, frequency, slug, expires_at, "
+        "schedule, grace) "
+        "VALUES (:ui, :na, :ak, :fr, :ms, :ea, :sc, :gr) returning id"
     )
-    statement = text(query)
-    # statement = sa.select(t_monitors).where(t_monitors.c.expires_at < when)
-    async with get_engine().connect() as conn:
-        result = await conn.execute(statement, {"when": when})
-        expimon = result.mappings().fetchall()
-        # result.mappings().fetchall() returns a traditional list of dicts
+    ((the_id,),) = conn.execute(
+        query,
+        {
+            "ui": user_id,
+            "na": name,
+            "ak": api_key,
+            "fr": frequency,
+            "ms": slug,
+            "ea": next_deadline(
+                datetime.now(UTC).timestamp(), frequency, schedule, grace
+            ),
+            "sc": schedule,
+            "gr": grace,
+        },
+    ).fetchall()
+    if tags:
+        conn.executemany(
+            INSERT_TAG, [{"ui": user_id, "tag": tag, "mi": the_id} for tag in tags]
+        )
+    conn.execute(BUMP_DASHBOARD, {"ui": user_id})
+    return the_id
 
-    await get_engine().dispose()
-    return expimon
+
+async def insert_monitor(
+    user_id, name, api_key, frequency, slug, schedule=None, grace=None, tags=()
+):
+    try:
+        return await hotpath.run(
+            hotpath._write,
+            _insert_monitor,
+            user_id,
+            name,
+            api_key,
+            frequency,
+            slug,
+            schedule,
+            grace,
+            tags,
+        )
+    except sqlite3.IntegrityError:
+        return None
 
 
-async def update_monitor(key):
+def _insert_webhook(conn, monitor_id, url, method, headers, form_fields, body_payload):
     query = (
-        "UPDATE monitor SET last_check=:now, "
-        "expires_at=:now_ts + frequency "
-        "WHERE api_key=:key "
-        "RETURNING monitor.id"
+        "INSERT INTO webhook (monitor_id, url, method, headers, "
+        "form_fields, body_payload) "
+        "VALUES (:mi, :url, :me, :he, :fo, :bo) returning id"
     )
-    statement = text(query)
+    ((the_id,),) = conn.execute(
+        query,
+        {
+            "mi": monitor_id,
+            "url": url,
+            "me": method,
+            "he": headers,
+            "fo": form_fields,
+            "bo": body_payload,
+        },
+    ).fetchall()
+    conn.execute(BUMP_DASHBOARD_BY_MONITOR, {"mi": monitor_id})
+    return the_id
+
 
+async def insert_webhook(monitor_id, url, method, headers, form_fields, body_payload):
+    # headers, form_fields, body_payload must be json-encoded
+    return await hotpath.run(
+        hotpath._write,
+        _insert_webhook,
+        monitor_id,
+        url,
+        method,
+        codec.dumps(headers),
+        codec.dumps(form_fields),
+        codec.dumps(body_payload),
+    )
+
+
+def _claim_outbox(conn, lease_seconds, limit, max_attempts):
     now_ts = datetime.now(UTC).timestamp()
-    async with get_engine().begin() as conn:
-        result = await conn.execute(
-            statement,
-            {
-                "now": datetime.now(UTC),
-                "key": key,
-                "now_ts": now_ts,
-            },
-        )
+    give_up = (
+        "UPDATE outbox SET done_at=:now, lease_token=NULL, "
+        "last_error='gave up after ' || attempts || ' attempts' "
+        "|| coalesce(': ' || last_error, '') "
+        "WHERE done_at IS NULL AND available_at <= :now AND attempts >= :max"
+    )
+    query = (
+        "UPDATE outbox SET lease_token=:tok, available_at=:until, "
+        "attempts=attempts + 1 "
+        "WHERE id IN (SELECT id FROM outbox WHERE done_at IS NULL "
+        "AND available_at <= :now ORDER BY available_at LIMIT :limit) "
+        "RETURNING *"
+    )
+    conn.execute(give_up, {"now": now_ts, "max": max_attempts})
+    cursor = conn.cursor()
+    cursor.row_factory = sqlite3.Row
+    rows = cursor.execute(
+        query,
+        {
+            "tok": secrets.token_hex(8),
+            "until": now_ts + lease_seconds,
+            "now": now_ts,
+            "limit": limit,
+        },
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+
+async def claim_outbox(lease_seconds, limit=1, max_attempts=10):
+    """Lease up to `limit` due deliveries.
+
+    The lease is taken with a single UPDATE ... RETURNING, so two dispatchers
+    can never claim the same row. Rows whose lease runs out without being
+    completed (e.g. the worker died) become claimable again, until they have
+    been claimed `max_attempts` times; then they're marked done, with the
+    reason in last_error, instead of being sent again.
+    """
+    return await hotpath.run(
+        hotpath._write, _claim_outbox, lease_seconds, limit, max_attempts
+    )
+
 
-        value = result.fetchone()
-        if value:
-            # Reset last_called for all my webhooks
-            id = value.id
-            wh_query = "UPDATE webhook SET last_called=NULL WHERE monitor_id=:id"
-            wh_statement = text(wh_query)
-            await conn.execute(wh_statement, {"id": id})
+async def complete_outbox(outbox_id, lease_token, error=None):
+    # Only the current lease holder can complete a delivery
+    query = (
+        "UPDATE outbox SET done_at=:now, last_error=:err, lease_token=NULL "
+        "WHERE id=:id AND lease_token=:tok"
+    )
+    params = {
+        "now": datetime.now(UTC).timestamp(),
+        "err": error,
+        "id": outbox_id,
+        "tok": lease_token,
+    }
+    return await hotpath.run(hotpath._write, _rowcount, query, params) == 1
 
-        else:
-            id = None
 
-        return id
+async def retry_outbox(outbox_id, lease_token, delay, error):
+    query = (
+        "UPDATE outbox SET available_at=:at, last_error=:err, lease_token=NULL "
+        "WHERE id=:id AND lease_token=:tok"
+    )
+    params = {
+        "at": datetime.now(UTC).timestamp() + delay,
+        "err": error,
+        "id": outbox_id,
+        "tok": lease_token,
+    }
+    return await hotpath.run(hotpath._write, _rowcount, query, params) == 1
 
 
-async def insert_monitor(user_id, name, api_key, frequency, slug):
+def _delete_monitor(conn, monitor_key, user_key):
+    params = {"monitor_key": monitor_key, "user_key": user_key}
     query = (
-        "INSERT INTO monitor (user_id, name, api_key, frequency, slug, expires_at) "
-        "VALUES (:ui, :na, :ak, :fr, :ms, :ea) returning id"
+        "DELETE FROM webhook WHERE monitor_id in "
+        "(SELECT monitor.id FROM user left join monitor on user.id=monitor.user_id "
+        "WHERE api_key=:monitor_key AND user_key=:user_key)"
     )
-    statement = text(query)
-    async with get_engine().begin() as conn:
-        try:
-            result = await conn.execute(
-                statement,
-                {
-                    "ui": user_id,
-                    "na": name,
-                    "ak": api_key,
-                    "fr": frequency,
-                    "ms": slug,
-                    "ea": datetime.now(UTC).timestamp() + frequency,
-                },
-            )
-        except IntegrityError:
-            return None
-        the_id = result.fetchone().id
-    await get_engine().dispose()
-    return the_id
+    conn.execute(query, params)
+    query = (
+        "DELETE FROM monitor_tag WHERE monitor_id in "
+        "(SELECT monitor.id FROM user left join monitor on user.id=monitor.user_id "
+        "WHERE api_key=:monitor_key AND user_key=:user_key)"
+    )
+    conn.execute(query, params)
+    query = (
+        "DELETE FROM monitor WHERE id in "
+        "(SELECT monitor.id FROM user left join monitor on user.id=monitor.user_id "
+        "WHERE api_key=:monitor_key AND user_key=:user_key) RETURNING id"
+    )
+    rows = conn.execute(query, params).fetchall()
+    if not rows:
+        return None
+    conn.execute(
+        "UPDATE user SET dashboard_version=dashboard_version + 1 "
+        "WHERE user_key=:user_key",
+        params,
+    )
+    return rows[0][0]
 
 
-async def insert_webhook(monitor_id, url, method, headers, form_fields, body_payload):
-    # headers, form_fields, body_payload must be json-encoded
-    headers = json.dumps(headers)
-    form_fields = json.dumps(form_fields)
-    body_payload = json.dumps(body_payload)
+async def delete_monitor_and_webhooks_by_monitor_key_user_key(monitor_key, user_key):
+    return await hotpath.run(hotpath._write, _delete_monitor, monitor_key, user_key)
+
+
+async def iter_monitors_for_export(uid, batch=500):
+    """Yield a user's monitors joined with their webhooks, one row per webhook.
+
+    Rows come through a server-side cursor `batch` at a time, ordered so a
+    monitor's webhooks are adjacent, and are never all held in memory. Both
+    the ordering and the join are served by indexes, so SQLite doesn't need
+    a temporary sort either.
+    """
     query = (
+        "SELECT monitor.id as mid, monitor.name, monitor.slug, monitor.frequency, "
+        "monitor.schedule, monitor.grace, monitor.api_key, "
+        "(SELECT json_group_array(tag) FROM monitor_tag "
+        "WHERE monitor_tag.monitor_id=monitor.id) AS tags, webhook.url, "
+        "webhook.method, webhook.headers, webhook.form_fields, "
+        "webhook.body_payload "
+        "FROM monitor LEFT JOIN webhook ON monitor.id=webhook.monitor_id "
+        "WHERE user_id=:uid ORDER BY monitor.slug"
+    )
+    statement = text(query).execution_options(yield_per=batch)
+    async with get_export_engine().connect() as conn:
+        result = await conn.stream(statement, {"uid": uid})
+        async for row in result.mappings():
+            yield row
+
+
+async def set_paused(user_id, paused_until, tag=None, slug_pattern=None):
+    """Pause a user's monitors until a timestamp, or resume them with None.
+
+    Monitors are picked by tag, slug glob pattern, or both. Returns how many
+    changed state.
+    """
+    params = {
+        "pu": paused_until,
+        "ui": user_id,
+        "tag": tag,
+        "sp": slug_pattern or "*",
+        "now": datetime.now(UTC).timestamp(),
+    }
+    return await hotpath.run(
+        hotpath._write, _rowcount, PAUSE_BY_TAG if tag else PAUSE_BY_SLUG, params
+    )
+
+
+async def get_taken_api_keys(api_keys):
+    query = "SELECT api_key from monitor WHERE api_key IN :keys"
+    statement = text(query).bindparams(sa.bindparam("keys", expanding=True))
+    async with get_read_engine().connect() as conn:
+        result = await conn.execute(statement, {"keys": list(api_keys)})
+        r = {row.api_key for row in result.fetchall()}
+    return r
+
+
+def _upsert_monitors(conn, user_id, monitors):
+    now_ts = datetime.now(UTC).timestamp()
+    upsert = (
+        "INSERT INTO monitor (user_id, name, slug, frequency, schedule, grace, "
+        "api_key, expires_at) VALUES (:ui, :na, :ms, :fr, :sc, :gr, :ak, :ea) "
+        "ON CONFLICT (user_id, slug) DO UPDATE SET name=excluded.name, "
+        "frequency=excluded.frequency, schedule=excluded.schedule, "
+        "grace=excluded.grace, expires_at=excluded.expires_at "
+        "RETURNING id"
+    )
+    clear_webhooks = "DELETE FROM webhook WHERE monitor_id=:mi"
+    clear_tags = "DELETE FROM monitor_tag WHERE monitor_id=:mi"
+    insert_webhook = (
         "INSERT INTO webhook (monitor_id, url, method, headers, "
         "form_fields, body_payload) "
-        "VALUES (:mi, :url, :me, :he, :fo, :bo) returning id"
+        "VALUES (:mi, :url, :me, :he, :fo, :bo)"
     )
-    statement = text(query)
-    async with get_engine().begin() as conn:
-        result = await conn.execute(
-            statement,
+    for m in monitors:
+        ((monitor_id,),) = conn.execute(
+            upsert,
             {
-                "mi": monitor_id,
-                "url": url,
-                "me": method,
-                "he": headers,
-                "fo": form_fields,
-                "bo": body_payload,
+                "ui": user_id,
+                "na": m["name"],
+                "ms": m["slug"],
+                "fr": m["frequency"],
+                "sc": m["schedule"],
+                "gr": m["grace"],
+                "ak": m["api_key"],
+                "ea": next_deadline(now_ts, m["frequency"], m["schedule"], m["grace"]),
             },
-        )
-        the_id = result.fetchone().id
-    await get_engine().dispose()
-    return the_id
+        ).fetchall()
+        conn.execute(clear_webhooks, {"mi": monitor_id})
+        conn.execute(clear_tags, {"mi": monitor_id})
+        if m.get("tags"):
+            conn.executemany(
+                INSERT_TAG,
+                [{"ui": user_id, "tag": t, "mi": monitor_id} for t in m["tags"]],
+            )
+        if m["webhooks"]:
+            conn.executemany(
+                insert_webhook,
+                [
+                    {
+                        "mi": monitor_id,
+                        "url": w["url"],
+                        "me": w["method"],
+                        "he": codec.dumps(w["headers"]),
+                        "fo": codec.dumps(w["form_fields"]),
+                        "bo": codec.dumps(w["body_payload"]),
+                    }
+                    for w in m["webhooks"]
+                ],
+            )
+    conn.execute(BUMP_DASHBOARD, {"ui": user_id})
+    return len(monitors)
 
 
-async def get_webhook_to_hit_by_id(wh_id):
-    query = "SELECT * from webhook WHERE id=:wh_id AND last_called IS NULL"
-    statement = text(query)
-    async with get_engine().connect() as conn:
-        result = await conn.execute(statement, {"wh_id": wh_id})
-        r = result.mappings().fetchone()
-    await get_engine().dispose()
-    return r
+async def upsert_monitors(user_id, monitors):
+    """Insert or update (by slug) a chunk of monitors in one transaction.
 
+    Each monitor is a dict with name, slug, frequency, schedule, grace,
+    api_key, a list of webhooks and optionally a list of tags. Existing
+    monitors keep their api_key and have their webhooks and tags replaced.
+    Returns the number of monitors written.
+    """
+    return await hotpath.run(hotpath._write, _upsert_monitors, user_id, monitors)
 
-async def touch_webhook_by_id(wid):
-    now_ts = datetime.now(UTC).timestamp()
-    query = "UPDATE webhook SET last_called=:now_ts " "WHERE id=:wid "
-    statement = text(query)
 
-    async with get_engine().begin() as conn:
-        await conn.execute(
-            statement,
-            {"now_ts": now_ts, "wid": wid},
-        )
-    await get_engine().dispose()
+def _purge_deleted_user_monitors(conn, cutoff, limit):
+    pick = (
+        "SELECT monitor.id FROM user JOIN monitor ON user.id=monitor.user_id "
+        "WHERE user.deleted_at < :cutoff LIMIT :limit"
+    )
+    # As one JSON array, like hotpath.TOUCH_WEBHOOKS
+    delete_webhooks = (
+        "DELETE FROM webhook WHERE monitor_id IN (SELECT value FROM json_each(:ids))"
+    )
+    delete_tags = (
+        "DELETE FROM monitor_tag "
+        "WHERE monitor_id IN (SELECT value FROM json_each(:ids))"
+    )
+    delete_monitors = (
+        "DELETE FROM monitor WHERE id IN (SELECT value FROM json_each(:ids))"
+    )
+    monitor_ids = [
+        id for (id,) in conn.execute(pick, {"cutoff": cutoff, "limit": limit})
+    ]
+    if not monitor_ids:
+        return 0, 0
+    ids = {"ids": codec.dumps(monitor_ids)}
+    webhooks = conn.execute(delete_webhooks, ids).rowcount
+    conn.execute(delete_tags, ids)
+    conn.execute(delete_monitors, ids)
+    return len(monitor_ids), webhooks
+
+
+async def purge_deleted_user_monitors(cutoff, limit):
+    """Delete up to `limit` monitors of users deleted before cutoff.
+
+    Their webhooks go in the same transaction. Returns (monitors, webhooks)
+    deleted.
+    """
+    return await hotpath.run(
+        hotpath._write, _purge_deleted_user_monitors, _datetime_param(cutoff), limit
+    )
 
 
-async def delete_monitor_and_webhooks_by_monitor_key_user_key(monitor_key, user_key):
-    async with get_engine().begin() as conn:
-        query = (
-            "DELETE FROM webhook WHERE monitor_id in "
-            "(SELECT monitor.id FROM user left join monitor on user.id=monitor.user_id "
-            "WHERE api_key=:monitor_key AND user_key=:user_key)"
-        )
-        statement = text(query)
-        await conn.execute(
-            statement, {"monitor_key": monitor_key, "user_key": user_key}
-        )
-        query = (
-            "DELETE FROM monitor WHERE id in "
-            "(SELECT monitor.id FROM user left join monitor on user.id=monitor.user_id "
-            "WHERE api_key=:monitor_key AND user_key=:user_key) RETURNING id"
-        )
-        statement = text(query)
-        result = await conn.execute(
-            statement, {"monitor_key": monitor_key, "user_key": user_key}
-        )
-        value = result.fetchone()
-        if value:
-            return value.id
-        else:
-            return None
-    await get_engine().dispose()
+async def purge_deleted_users(cutoff, limit):
+    """Delete up to `limit` users deleted before cutoff that have no monitors."""
+    query = (
+        "DELETE FROM user WHERE id IN (SELECT id FROM user "
+        "WHERE deleted_at < :cutoff AND NOT EXISTS "
+        "(SELECT 1 FROM monitor WHERE monitor.user_id=user.id) LIMIT :limit)"
+    )
+    params = {"cutoff": _datetime_param(cutoff), "limit": limit}
+    return await hotpath.run(hotpath._write, _rowcount, query, params)
 
 
-async def insert_user(email, password_crypted, user_key):
+async def purge_orphan_webhooks(limit):
+    query = (
+        "DELETE FROM webhook WHERE id IN (SELECT webhook.id FROM webhook "
+        "LEFT JOIN monitor ON monitor.id=webhook.monitor_id "
+        "WHERE monitor.id IS NULL LIMIT :limit)"
+    )
+    return await hotpath.run(hotpath._write, _rowcount, query, {"limit": limit})
+
+
+async def purge_orphan_attempts(limit):
+    query = (
+        "DELETE FROM webhook_attempt WHERE id IN (SELECT webhook_attempt.id "
+        "FROM webhook_attempt LEFT JOIN webhook "
+        "ON webhook.id=webhook_attempt.webhook_id "
+        "WHERE webhook.id IS NULL LIMIT :limit)"
+    )
+    return await hotpath.run(hotpath._write, _rowcount, query, {"limit": limit})
+
+
+async def purge_outbox(cutoff_ts, limit):
+    query = (
+        "DELETE FROM outbox WHERE id IN (SELECT id FROM outbox "
+        "WHERE done_at < :cutoff LIMIT :limit)"
+    )
+    params = {"cutoff": cutoff_ts, "limit": limit}
+    return await hotpath.run(hotpath._write, _rowcount, query, params)
+
+
+def _incremental_vacuum(conn, pages):
+    (before,) = conn.execute("PRAGMA freelist_count").fetchone()
+    conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+    (after,) = conn.execute("PRAGMA freelist_count").fetchone()
+    return before - after
+
+
+async def incremental_vacuum(pages):
+    """Return up to `pages` free pages to the filesystem.
+
+    Only does anything once auto_vacuum is INCREMENTAL. Returns the number
+    of pages reclaimed.
+    """
+    return await hotpath.run(hotpath._write, _incremental_vacuum, pages)
+
+
+async def optimize():
+    await hotpath.run(lambda conn: conn.execute("PRAGMA optimize").fetchall())
+
+
+def _insert_user(conn, email, password_crypted, user_key):
     query = (
         "INSERT INTO user (email, password, user_key) "
-        "VALUES (:em, :pw, :uk) returning *"
+        "VALUES (:em, :pw, :uk) "
+        "RETURNING id, email, password, user_key, deleted_at, created_at, updated_at"
     )
-    statement = text(query)
-    async with get_engine().begin() as conn:
-        try:
-            result = await conn.execute(
-                statement,
-                {"em": email, "pw": password_crypted, "uk": user_key},
-            )
-        except IntegrityError:
-            return None
+    cursor = conn.cursor()
+    cursor.row_factory = sqlite3.Row
+    (row,) = cursor.execute(
+        query, {"em": email, "pw": password_crypted, "uk": user_key}
+    ).fetchall()
+    return dict(row)
+
 
-        the_user = result.mappings().fetchone()
-    await get_engine().dispose()
-    return the_user
+async def insert_user(email, password_crypted, user_key):
+    try:
+        return await hotpath.run(
+            hotpath._write, _insert_user, email, password_crypted, user_key
+        )
+    except sqlite3.IntegrityError:
+        return None
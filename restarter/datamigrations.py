@@ -0,0 +1,202 @@
+"""Online data migrations: backfills that run in the background in batches.
+
+Alembic revisions should only change the schema. An ALTER TABLE ... ADD
+COLUMN is instant on SQLite, but a backfill that rewrites every row holds
+the write lock for as long as it runs. At boot that keeps the service down,
+and it stalls every ping. Backfills go here instead, as a DataMigration
+whose `step(conn, cursor, limit)` processes up to `limit` rows after
+`cursor` and returns `(cursor, rows)`, with cursor None once done. The code
+reading the data has to cope with rows that haven't been backfilled yet.
+
+`run_pending` runs every unfinished migration in REGISTRY, in order,
+after the schema upgrade and in the background. Each batch is one write
+transaction on the hot-path connection. It reads the cursor, does the step
+and saves the new cursor, so a batch either commits with its progress or
+not at all. After a crash or restart the next run picks up at the last
+committed batch, and workers running the same migration at once just take
+turns.
+
+Batches throttle themselves the way maintenance does. The batch size
+adapts so a batch holds the write lock for at most `max_lock` seconds.
+The pause between batches doubles, up to `max_pause`, while batches wait
+longer than `max_wait` to get the lock, meaning pings or another writer
+are contending for it.
+"""
+
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Callable
+
+from . import codec, hotpath
+from .maintenance import BatchSizer
+
+START_MIGRATION = (
+    "INSERT INTO data_migration (name, started_at) VALUES (:name, :now) "
+    "ON CONFLICT (name) DO NOTHING"
+)
+GET_MIGRATION = "SELECT cursor, finished_at FROM data_migration WHERE name=:name"
+LIST_MIGRATIONS = (
+    "SELECT name, cursor, rows, batches, started_at, finished_at FROM data_migration"
+)
+SAVE_PROGRESS = (
+    "UPDATE data_migration SET cursor=:cursor, rows=rows + :rows, "
+    "batches=batches + 1, finished_at=:finished_at WHERE name=:name"
+)
+
+
+@dataclass
+class DataMigration:
+    name: str
+    # step(conn, cursor, limit) -> (cursor, rows), cursor None when done
+    step: Callable
+
+
+WEBHOOKS_AFTER = (
+    "SELECT id, headers, form_fields FROM webhook WHERE id > :cursor "
+    "ORDER BY id LIMIT :limit"
+)
+SET_WEBHOOK_JSON = "UPDATE webhook SET headers=:he, form_fields=:fo WHERE id=:id"
+
+
+def compact(text):
+    try:
+        return codec.dumps(codec.loads(text))
+    except ValueError:
+        return text
+
+
+def compact_webhook_json(conn, cursor, limit):
+    """Re-encode webhook headers and form fields the way codec.dumps does.
+
+    Webhooks created before restarter.codec have json.dumps' spacing, so
+    identical targets didn't compare equal when grouping deliveries.
+    """
+    rows = conn.execute(WEBHOOKS_AFTER, {"cursor": cursor or 0, "limit": limit})
+    rows = rows.fetchall()
+    changed = []
+    for id, headers, form_fields in rows:
+        he = headers and compact(headers)
+        fo = form_fields and compact(form_fields)
+        if (he, fo) != (headers, form_fields):
+            changed.append({"id": id, "he": he, "fo": fo})
+    conn.executemany(SET_WEBHOOK_JSON, changed)
+    return (rows[-1][0] if len(rows) == limit else None), len(rows)
+
+
+REGISTRY = [
+    DataMigration("compact_webhook_json", compact_webhook_json),
+]
+
+
+def _run_batch(conn, migration, limit, submitted):
+    conn.execute("BEGIN IMMEDIATE")
+    # Queued behind other hot-path work, then waiting on the lock
+    waited = time.perf_counter() - submitted
+    try:
+        cursor, finished_at = conn.execute(
+            GET_MIGRATION, {"name": migration.name}
+        ).fetchone()
+        if finished_at is not None:
+            # Another worker finished it meanwhile
+            conn.execute("ROLLBACK")
+            return waited, 0, True
+        cursor, rows = migration.step(conn, cursor, limit)
+        conn.execute(
+            SAVE_PROGRESS,
+            {
+                "name": migration.name,
+                "cursor": cursor,
+                "rows": rows,
+                "finished_at": None if cursor is not None else int(time.time()),
+            },
+        )
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+    return waited, rows, cursor is None
+
+
+async def run_migration(
+    migration, max_lock=0.05, pause=0.05, max_pause=5, max_wait=0.1
+):
+    """Run one migration to the end; returns the rows it processed."""
+    await hotpath.run(
+        lambda conn: conn.execute(
+            START_MIGRATION, {"name": migration.name, "now": int(time.time())}
+        )
+    )
+    sizer = BatchSizer(max_lock=max_lock)
+    delay = pause
+    total = 0
+    while True:
+        limit = sizer.size
+        submitted = time.perf_counter()
+        waited, rows, done = await hotpath.run(_run_batch, migration, limit, submitted)
+        sizer.update(time.perf_counter() - submitted - waited)
+        total += rows
+        if done:
+            return total
+        if waited > max_wait:
+            delay = min(max_pause, delay * 2)
+        else:
+            delay = pause
+        await asyncio.sleep(delay)
+
+
+async def run_pending(**throttle):
+    from . import app
+
+    for migration in REGISTRY:
+        start = time.perf_counter()
+        try:
+            rows = await run_migration(migration, **throttle)
+        except Exception:
+            app.logger.exception("Data migration %s failed", migration.name)
+            return
+        if rows:
+            app.logger.info(
+                "Data migration %s: %d rows in %.1fs",
+                migration.name,
+                rows,
+                time.perf_counter() - start,
+            )
+
+
+def _status(conn):
+    return {
+        name: {
+            "cursor": cursor,
+            "rows": rows,
+            "batches": batches,
+            "started_at": started_at,
+            "finished_at": finished_at,
+        }
+        for name, cursor, rows, batches, started_at, finished_at in conn.execute(
+            LIST_MIGRATIONS
+        )
+    }
+
+
+async def status():
+    return await hotpath.run(_status)
+
+
+runner = None
+
+
+def start(**throttle):
+    global runner
+
+    if runner is None:
+        runner = asyncio.create_task(run_pending(**throttle))
+
+
+async def stop():
+    global runner
+
+    if runner is not None:
+        runner.cancel()
+        await asyncio.gather(runner, return_exceptions=True)
+        runner = None
@@ -0,0 +1,73 @@
+"""Coalescing of webhook deliveries for monitors that expire together.
+
+When a host dies, every monitor on it tends to expire in the same check
+tick. With a digest mode enabled, expiries that share a destination and land
+within a short window of each other are grouped so they result in a single
+outbound request listing all affected monitors.
+
+Modes:
+    "user": group by owning user and webhook URL/method. The first webhook's
+        headers and form fields are used for the delivery.
+    "webhook": group only identical destinations (URL, method, headers and
+        form fields), which may span users since the recipient is the same.
+
+Without a digest mode, webhooks whose requests would be byte-for-byte the
+same (URL, method, headers, form fields and body) still go out once per
+tick, since the recipient can't tell the copies apart anyway.
+"""
+
+DIGEST_MODES = ("user", "webhook")
+
+
+def destination_key(row, mode):
+    if mode == "user":
+        return (row["user_id"], row["url"], row["method"].upper())
+    return (row["url"], row["method"].upper(), row["headers"], row["form_fields"])
+
+
+def target_key(row):
+    return (
+        row["url"],
+        row["method"].upper(),
+        row["headers"],
+        row["form_fields"],
+        row["body_payload"],
+    )
+
+
+def group_expiries(rows, mode=None, window=60):
+    """Split expired monitor rows into delivery groups.
+
+    Without a digest mode rows are only grouped with identical targets, so
+    each distinct request is sent once. Otherwise rows with the same
+    destination key are grouped as long as their expires_at is within
+    `window` seconds of the first row in the group.
+    """
+    if mode not in DIGEST_MODES:
+        targets = {}
+        for row in rows:
+            targets.setdefault(target_key(row), []).append(row)
+        return list(targets.values())
+    buckets = {}
+    for row in sorted(rows, key=lambda r: r["expires_at"]):
+        groups = buckets.setdefault(destination_key(row, mode), [])
+        if groups and row["expires_at"] - groups[-1][0]["expires_at"] <= window:
+            groups[-1].append(row)
+        else:
+            groups.append([row])
+    return [group for groups in buckets.values() for group in groups]
+
+
+def digest_form_fields(form_fields, rows):
+    """Form fields for a digest delivery covering `rows`.
+
+    A single row keeps its webhook's form fields untouched. For several rows,
+    the "message" field (what Pushover and most notifiers display) is
+    replaced with a listing of the affected monitors.
+    """
+    if len(rows) == 1:
+        return form_fields
+    fields = dict(form_fields or {})
+    names = ", ".join(f"{row['name']} ({row['slug']})" for row in rows)
+    fields["message"] = f"{len(rows)} monitors expired: {names}"
+    return fields
@@ -0,0 +1,62 @@
+"""In-memory cache of rendered page fragments.
+
+The dashboard's monitor table means a join over all of a user's monitors
+and webhooks plus a template render, but it only changes when one of them
+is created, deleted or imported. Those all bump the user's
+dashboard_version in the same transaction, so a fragment rendered for a
+version stays valid until the version moves on. Pings don't: the page
+fills in each monitor's last check from /dashboard/checks. The version lives in the
+database rather than here because the other workers see the same writes.
+
+Entries are kept in an OrderedDict in last-used order and evicted from the
+front once their total size goes over `max_bytes`. Per worker process.
+"""
+
+from collections import OrderedDict
+
+
+class FragmentCache:
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()  # key -> (version, fragment)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        """The fragment cached for key at exactly this version, or None."""
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != version:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, version, fragment):
+        self.discard(key)
+        if len(fragment) > self.max_bytes:
+            return
+        self.entries[key] = (version, fragment)
+        self.size += len(fragment)  # characters; near enough bytes for HTML
+        while self.size > self.max_bytes:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def __len__(self):
+        return len(self.entries)
+
+
+caches = {}
+
+
+def get_cache(name, max_bytes):
+    cache = caches.get(name)
+    if cache is None or cache.max_bytes != max_bytes:
+        cache = caches[name] = FragmentCache(max_bytes)
+    return cache
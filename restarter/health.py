@@ -0,0 +1,108 @@
+"""Expiry-scan tick statistics and the health checks built on them.
+
+check_things records a Tick for every run: when it started and finished,
+how many rows the scan returned, how many deliveries it queued, and the
+age of the oldest expiry whose alert hasn't been delivered yet. `problems`
+compares the latest ticks with thresholds, so a scan that has stopped
+running, is stuck, or is falling behind shows up in /health instead of in
+a user's missing alert.
+
+Every worker runs its own scheduler, so the stats are per process.
+"""
+
+import time
+from collections import deque
+from dataclasses import asdict, dataclass
+
+
+@dataclass
+class Tick:
+    started_at: float
+    finished_at: float | None = None
+    scanned: int = 0
+    queued: int = 0
+    # Seconds since the oldest expiry still waiting for its alert
+    backlog_age: float | None = None
+    error: str | None = None
+
+    @property
+    def duration(self):
+        if self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+
+# Set when this process starts its scheduler; None means no ticks expected
+started_at = None
+ticks = deque(maxlen=20)
+completed = 0
+failed = 0
+
+
+def start(now=None):
+    global started_at, completed, failed
+
+    started_at = time.time() if now is None else now
+    ticks.clear()
+    completed = failed = 0
+
+
+def start_tick():
+    tick = Tick(started_at=time.time())
+    ticks.append(tick)
+    return tick
+
+
+def finish_tick(tick, error=None):
+    global completed, failed
+
+    tick.finished_at = time.time()
+    tick.error = error
+    completed += 1
+    if error:
+        failed += 1
+
+
+def backlog_age(now, oldest_expiry=None, oldest_due=None):
+    """Age of the oldest undelivered expiry.
+
+    That's an expired monitor the scan found but couldn't queue, or a queued
+    delivery that is due but hasn't gone out; for the latter the time it
+    became due stands in for the expiry, which was at most a tick earlier.
+    Deliveries backing off after a failed attempt don't count, so a user's
+    dead endpoint doesn't make the service look behind.
+    """
+    oldest = min((t for t in (oldest_expiry, oldest_due) if t), default=None)
+    return None if oldest is None else max(0.0, now - oldest)
+
+
+def problems(now, max_tick_age, max_tick_duration, max_backlog_age):
+    """Reasons the scheduler looks unhealthy; empty when all is well."""
+    if started_at is None:
+        return []
+    found = []
+    last = ticks[-1] if ticks else None
+    since = now - (last.started_at if last else started_at)
+    if since > max_tick_age:
+        found.append(f"no scan started for {since:.0f}s")
+    if last and last.finished_at is None and since > max_tick_duration:
+        found.append(f"scan running for {since:.0f}s")
+    done = [t for t in ticks if t.finished_at is not None]
+    if done and done[-1].error:
+        found.append(f"last scan failed: {done[-1].error}")
+    if done and done[-1].duration > max_tick_duration:
+        found.append(f"last scan took {done[-1].duration:.0f}s")
+    if done and (done[-1].backlog_age or 0) > max_backlog_age:
+        found.append(f"oldest undelivered expiry is {done[-1].backlog_age:.0f}s old")
+    return found
+
+
+def snapshot(now):
+    last = ticks[-1] if ticks else None
+    return {
+        "started_at": started_at,
+        "ticks": completed,
+        "failed": failed,
+        "seconds_since_tick": now - last.started_at if last else None,
+        "last_tick": asdict(last) | {"duration": last.duration} if last else None,
+    }
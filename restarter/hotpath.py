@@ -0,0 +1,272 @@
+"""Ping and expiry-scan queries on a dedicated sqlite3 connection.
+
+Pings and the expiry scan run far more often than anything else, and for
+them SQLAlchemy's per-call costs (building the statement, the greenlet
+bridge to aiosqlite, result mapping) are several times the SQLite work.
+This module runs them on one long-lived sqlite3 connection confined to a
+single-thread executor:
+
+- each operation is one hop to that thread, however many statements it runs
+- SQL strings are constants, so the connection's statement cache hands back
+  prepared statements instead of compiling them again
+- rows are plain tuples, or sqlite3.Row where callers look columns up by name
+
+Write transactions start with BEGIN IMMEDIATE so they wait on the busy
+timeout for the write lock rather than failing to upgrade a read.
+
+This thread is also the worker's only writer: the write functions in
+restarter.database (outbox leases, retention, imports, pause and resume)
+run here as well. They queue behind pings in the executor, in order,
+instead of contending with them for the lock; only other worker processes
+still meet the busy timeout.
+
+The expiry scan and other reads that can take a while go through `read`
+instead, on a second thread with a read-only connection. With WAL they
+read a snapshot alongside the writer, and pings don't queue behind them.
+"""
+
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import UTC, datetime
+
+from . import admission, codec, database
+
+executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="hotpath")
+read_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="hotpath-read")
+
+# Only touched from the executor thread
+connection = None
+connection_path = None
+# Only touched from the read executor thread
+read_connection = None
+read_connection_path = None
+
+UPDATE_MONITOR = (
+    "UPDATE monitor SET last_check=:now, expires_at=:now_ts + frequency "
+    "WHERE api_key=:key RETURNING id, schedule, grace"
+)
+SET_EXPIRES_AT = "UPDATE monitor SET expires_at=:ea WHERE id=:id"
+RESET_WEBHOOKS = "UPDATE webhook SET last_called=NULL WHERE monitor_id=:id"
+EXPIRED_MONITORS = (
+    "SELECT monitor.id AS mid, monitor.user_id, monitor.name, monitor.slug, "
+    "monitor.expires_at, webhook.id AS wid, webhook.url, webhook.method, "
+    "webhook.headers, webhook.form_fields, webhook.body_payload "
+    "FROM monitor LEFT JOIN webhook ON monitor.id=webhook.monitor_id "
+    "WHERE expires_at < :when AND webhook.last_called IS NULL "
+    # Checked on the index entries, before the row is read
+    "AND (paused_until IS NULL OR paused_until <= :when)"
+)
+# The ids go in as one JSON array so the SQL, and so the cached statement,
+# is the same whatever the batch size
+TOUCH_WEBHOOKS = (
+    "UPDATE webhook SET last_called=:now_ts "
+    "WHERE id IN (SELECT value FROM json_each(:wids)) AND last_called IS NULL "
+    "RETURNING id"
+)
+# Pauses whose `until` has passed, for monitors whose deadline fell inside
+# the pause: they get a full period from the end of the pause, as if resumed
+# then, instead of all alerting on the next scan. Pauses that ended before
+# the deadline need nothing, and are left for the next pause or resume.
+END_LAPSED_PAUSES = (
+    "UPDATE monitor SET paused_until=NULL, "
+    "expires_at=next_deadline(paused_until, frequency, schedule, grace) "
+    "WHERE expires_at < :now AND paused_until <= :now AND expires_at < paused_until"
+)
+# Deliveries waiting out a retry backoff, or leased to a dispatcher, aren't due
+OLDEST_DUE = (
+    "SELECT min(available_at) FROM outbox "
+    "WHERE done_at IS NULL AND available_at <= :now"
+)
+INSERT_OUTBOX = (
+    "INSERT INTO outbox (webhook_ids, url, method, headers, form_fields, "
+    "created_at, available_at) VALUES (:wi, :url, :me, :he, :fo, :now, :now)"
+)
+
+
+def add_functions(conn):
+    """Register the SQL functions that writes here use."""
+    conn.create_function("next_deadline", 4, database.next_deadline, deterministic=True)
+
+
+def _connect(path):
+    global connection, connection_path
+
+    if connection is not None and connection_path == path:
+        return connection
+    if connection is not None:
+        connection.close()
+    connection = sqlite3.connect(path, isolation_level=None)
+    connection.execute("PRAGMA journal_mode=WAL")
+    add_functions(connection)
+    connection_path = path
+    return connection
+
+
+def _connect_read(path):
+    global read_connection, read_connection_path
+
+    if read_connection is not None and read_connection_path == path:
+        return read_connection
+    if read_connection is not None:
+        read_connection.close()
+    read_connection = sqlite3.connect(
+        f"file:{path}?mode=ro", uri=True, isolation_level=None
+    )
+    read_connection.execute("PRAGMA query_only=ON")
+    read_connection_path = path
+    return read_connection
+
+
+def _write(conn, work, *args):
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        result = work(conn, *args)
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+    return result
+
+
+async def run(fn, *args):
+    """Run fn(connection, *args) on the hot-path thread."""
+    from . import app
+
+    path = app.config.get("DATABASE")
+    loop = asyncio.get_running_loop()
+    ticket = admission.controller.enter()
+
+    def call():
+        ticket.started = admission.controller.clock()
+        return fn(_connect(path), *args)
+
+    try:
+        return await loop.run_in_executor(executor, call)
+    finally:
+        admission.controller.leave(ticket)
+
+
+async def read(fn, *args):
+    """Run fn(read-only connection, *args) on the read thread."""
+    from . import app
+
+    path = app.config.get("DATABASE")
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        read_executor, lambda: fn(_connect_read(path), *args)
+    )
+
+
+def _close():
+    global connection, connection_path
+
+    if connection is not None:
+        connection.close()
+    connection = connection_path = None
+
+
+def _close_read():
+    global read_connection, read_connection_path
+
+    if read_connection is not None:
+        read_connection.close()
+    read_connection = read_connection_path = None
+
+
+async def close():
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(executor, _close)
+    await loop.run_in_executor(read_executor, _close_read)
+
+
+def _update_monitor(conn, key, now):
+    now_ts = now.timestamp()
+    rows = conn.execute(
+        UPDATE_MONITOR, {"now": now, "now_ts": now_ts, "key": key}
+    ).fetchall()
+    if not rows:
+        return None
+    id, schedule, grace = rows[0]
+    if schedule:
+        # Scheduled monitors expire a grace period after the next run
+        conn.execute(
+            SET_EXPIRES_AT,
+            {"ea": database.next_deadline(now_ts, 0, schedule, grace), "id": id},
+        )
+    conn.execute(RESET_WEBHOOKS, {"id": id})
+    # The dashboard's cached table doesn't change: it fetches the time of
+    # the last check separately
+    return id
+
+
+async def update_monitor(key):
+    """Record a ping; returns the monitor id, or None for an unknown key."""
+    return await run(_write, _update_monitor, key, datetime.now(UTC))
+
+
+def _end_lapsed_pauses(conn, now_ts):
+    return conn.execute(END_LAPSED_PAUSES, {"now": now_ts}).rowcount
+
+
+async def end_lapsed_pauses():
+    """Apply END_LAPSED_PAUSES; returns how many monitors it moved."""
+    return await run(_write, _end_lapsed_pauses, datetime.now(UTC).timestamp())
+
+
+def _get_expired_monitors(conn, when):
+    cursor = conn.cursor()
+    # digest and make_delivery look columns up by name
+    cursor.row_factory = sqlite3.Row
+    return cursor.execute(EXPIRED_MONITORS, {"when": when}).fetchall()
+
+
+async def get_expired_monitors():
+    return await read(_get_expired_monitors, datetime.now(UTC).timestamp())
+
+
+def _enqueue_deliveries(conn, deliveries, now_ts):
+    queued = 0
+    for delivery in deliveries:
+        wids = codec.dumps(list(delivery["webhook_ids"]))
+        claimed = [
+            id
+            for (id,) in conn.execute(TOUCH_WEBHOOKS, {"now_ts": now_ts, "wids": wids})
+        ]
+        if not claimed:
+            continue
+        conn.execute(
+            INSERT_OUTBOX,
+            {
+                "wi": codec.dumps(claimed),
+                "url": delivery["url"],
+                "me": delivery["method"],
+                "he": codec.dumps(delivery["headers"]),
+                "fo": codec.dumps(delivery["form_fields"]),
+                "now": now_ts,
+            },
+        )
+        queued += 1
+    return queued
+
+
+async def enqueue_deliveries(deliveries):
+    """Queue webhook deliveries and mark their webhooks as called.
+
+    Each delivery is a dict with webhook_ids, url, method, headers and
+    form_fields. Everything happens in one transaction, and a delivery is
+    only queued for webhooks that weren't already marked, so a concurrent
+    scan in another worker can't queue the same alert twice. Returns the
+    number of deliveries queued.
+    """
+    now_ts = datetime.now(UTC).timestamp()
+    return await run(_write, _enqueue_deliveries, deliveries, now_ts)
+
+
+def _get_oldest_due(conn, now):
+    return conn.execute(OLDEST_DUE, {"now": now}).fetchone()[0]
+
+
+async def get_oldest_due():
+    """When the longest-waiting due outbox delivery became due, or None."""
+    return await read(_get_oldest_due, datetime.now(UTC).timestamp())
@@ -0,0 +1,154 @@
+"""Non-blocking, structured logging.
+
+The handlers log_conf.yaml sets up write synchronously to stdout/stderr,
+which stalls the event loop whenever the pipe is slow to drain. `install`
+moves every configured handler behind a QueueHandler: the calling thread
+only formats the message and puts the record on a queue, and a
+QueueListener thread does the formatting and writing.
+
+With `json=True` the handlers write one JSON object per record: time,
+level, logger, message, plus anything passed in `extra` (monitor_id,
+webhook_ids, duration_ms, outcome...). Exceptions come out as an `exc`
+field. With `json=False` the handlers keep the formatters log_conf.yaml
+gave them, and records keep their args, which uvicorn's formatters read.
+
+Records below WARNING can be sampled per logger: with rates
+{"restarter.delivery": 10} only every 10th delivery record gets through,
+tagged with "sampled": 10 so counts can be scaled back up. A rate set for
+a logger applies to its children too. Warnings and errors are never
+sampled.
+"""
+
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+from . import codec
+
+# Attributes every LogRecord has; anything else came from `extra`. uvicorn
+# adds a copy of some messages with terminal colours.
+RESERVED = set(vars(logging.makeLogRecord({}))) | {
+    "message",
+    "asctime",
+    "color_message",
+}
+
+listeners = []
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in RESERVED:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return codec.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Let through one in every N records below WARNING, per logger."""
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+        self.resolved = {}  # logger name -> rate, including inherited ones
+        self.counters = {}
+
+    def rate(self, name):
+        if name not in self.resolved:
+            parts = name.split(".")
+            self.resolved[name] = next(
+                (
+                    self.rates[".".join(parts[:i])]
+                    for i in range(len(parts), 0, -1)
+                    if ".".join(parts[:i]) in self.rates
+                ),
+                1,
+            )
+        return self.resolved[name]
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate(record.name)
+        if rate <= 1:
+            return True
+        seen = self.counters.get(record.name, 0)
+        self.counters[record.name] = seen + 1
+        if seen % rate:
+            return False
+        record.sampled = rate
+        return True
+
+
+class StructuredQueueHandler(QueueHandler):
+    def __init__(self, queue, keep_args=False):
+        super().__init__(queue)
+        # The text formatters from log_conf.yaml are kept as they are, and
+        # uvicorn's AccessFormatter reads the client and request line from
+        # record.args
+        self.keep_args = keep_args
+
+    def prepare(self, record):
+        # The stock prepare() folds the traceback into the message; keep it
+        # apart so the JSON formatter can put it in its own field.
+        record = logging.makeLogRecord(vars(record))
+        if not self.keep_args:
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def install(json=True, sample_rates=None):
+    """Put every logger's handlers behind a queue and a listener thread."""
+    if listeners:
+        return
+    sampler = SamplingFilter(sample_rates or {})
+    formatter = JSONFormatter() if json else None
+    loggers = [logging.getLogger()] + [
+        logger
+        for logger in logging.Logger.manager.loggerDict.values()
+        if isinstance(logger, logging.Logger)
+    ]
+    for logger in loggers:
+        handlers = [h for h in logger.handlers if not isinstance(h, QueueHandler)]
+        if not handlers:
+            continue
+        formatters = [h.formatter for h in handlers]
+        if formatter:
+            for handler in handlers:
+                handler.setFormatter(formatter)
+        q = queue.SimpleQueue()
+        handler = StructuredQueueHandler(q, keep_args=not json)
+        handler.addFilter(sampler)
+        for old in handlers:
+            logger.removeHandler(old)
+        logger.addHandler(handler)
+        listener = QueueListener(q, *handlers, respect_handler_level=True)
+        listener.start()
+        listeners.append((logger, handler, listener, handlers, formatters))
+
+
+def uninstall():
+    """Stop the listeners, writing out what's queued, and restore handlers."""
+    while listeners:
+        logger, handler, listener, handlers, formatters = listeners.pop()
+        listener.stop()
+        logger.removeHandler(handler)
+        for old, formatter in zip(handlers, formatters):
+            old.setFormatter(formatter)
+            logger.addHandler(old)
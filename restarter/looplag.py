@@ -0,0 +1,167 @@
+"""Event loop lag: how late timers fire, and what was blocking the loop.
+
+HTTP handlers, scheduler jobs, deliveries and the argon2 hashing in
+passwordify/login all share one event loop per worker, so anything that
+runs without yielding delays everything else. Two pieces watch for that:
+
+- `measure_forever` sleeps `interval` at a time and records how late it
+  woke up in a histogram. That's the delay every other timer and ready
+  callback saw too.
+- A watchdog thread checks the time of the last wakeup. If the loop has
+  gone `threshold` past when it should have woken, it takes the loop
+  thread's current stack, which is the callback that is blocking it, and
+  logs it once per stall.
+
+asyncio's debug mode also reports slow callbacks, but only once they
+have finished, without a stack, and it slows the loop down. The watchdog
+catches the callback while it is still running.
+
+Stats are per worker process.
+"""
+
+import asyncio
+import bisect
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+logger = logging.getLogger("restarter.loop")
+
+# Upper bounds, in milliseconds; lags above the last go in a final bucket
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+histogram = [0] * (len(BUCKETS_MS) + 1)
+samples = 0
+total_ms = 0.0
+max_ms = 0.0
+stalls = deque(maxlen=10)
+stall_count = 0
+
+# Set on the loop thread, read by the watchdog
+heartbeat = None
+loop_thread = None
+
+measurer = None
+watchdog = None
+stopping = threading.Event()
+
+
+def reset():
+    global histogram, samples, total_ms, max_ms, stall_count
+
+    histogram = [0] * (len(BUCKETS_MS) + 1)
+    samples = 0
+    total_ms = max_ms = 0.0
+    stalls.clear()
+    stall_count = 0
+
+
+def observe(lag):
+    global samples, total_ms, max_ms
+
+    ms = lag * 1000
+    histogram[bisect.bisect_left(BUCKETS_MS, ms)] += 1
+    samples += 1
+    total_ms += ms
+    max_ms = max(max_ms, ms)
+
+
+async def measure_forever(interval):
+    global heartbeat
+
+    loop = asyncio.get_running_loop()
+    while True:
+        heartbeat = time.monotonic()
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        observe(max(0.0, loop.time() - expected))
+
+
+def check_stall(now, interval, threshold, reported):
+    """Log the loop thread's stack if it's stuck; returns the beat reported."""
+    global stall_count
+
+    beat = heartbeat
+    if beat is None or beat == reported:
+        return reported
+    blocked = now - beat - interval
+    if blocked < threshold:
+        return reported
+    frame = sys._current_frames().get(loop_thread)
+    stack = "".join(traceback.format_stack(frame)) if frame else ""
+    stall_count += 1
+    stalls.append(
+        {"at": time.time(), "blocked_ms": round(blocked * 1000, 1), "stack": stack}
+    )
+    logger.warning(
+        "Event loop blocked for %.0f ms",
+        blocked * 1000,
+        extra={"blocked_ms": round(blocked * 1000, 1), "stack": stack},
+    )
+    return beat
+
+
+def watch(interval, threshold):
+    reported = None
+    while not stopping.wait(min(interval, threshold) / 2):
+        reported = check_stall(time.monotonic(), interval, threshold, reported)
+
+
+def start(interval=0.1, threshold=0.25):
+    """Start measuring the running loop, and its watchdog thread."""
+    global measurer, watchdog, loop_thread, heartbeat
+
+    if measurer is not None:
+        return
+    loop_thread = threading.get_ident()
+    heartbeat = None
+    stopping.clear()
+    measurer = asyncio.create_task(measure_forever(interval))
+    watchdog = threading.Thread(
+        target=watch, args=(interval, threshold), name="looplag", daemon=True
+    )
+    watchdog.start()
+
+
+async def stop():
+    global measurer, watchdog
+
+    if measurer is None:
+        return
+    stopping.set()
+    measurer.cancel()
+    await asyncio.gather(measurer, return_exceptions=True)
+    watchdog.join()
+    measurer = watchdog = None
+
+
+def percentile_ms(q):
+    """Upper bound of the bucket holding the q-th percentile."""
+    if not samples:
+        return None
+    rank = q * samples
+    seen = 0
+    for bound, count in zip(BUCKETS_MS + (None,), histogram):
+        seen += count
+        if seen >= rank:
+            return bound if bound is not None else max_ms
+    return max_ms
+
+
+def snapshot():
+    return {
+        "samples": samples,
+        "mean_ms": round(total_ms / samples, 3) if samples else None,
+        "p50_ms": percentile_ms(0.5),
+        "p99_ms": percentile_ms(0.99),
+        "max_ms": round(max_ms, 3),
+        "histogram": [
+            {"le_ms": bound, "count": count}
+            for bound, count in zip(BUCKETS_MS + (None,), histogram)
+        ],
+        "stalls": stall_count,
+        "recent_stalls": list(stalls),
+    }
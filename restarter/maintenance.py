@@ -0,0 +1,104 @@
+"""Background retention and compaction.
+
+Purges users soft-deleted more than a retention period ago together with
+their monitors and webhooks, webhooks left behind by deleted monitors, the
+delivery log of deleted webhooks, and delivered outbox rows, then returns
+free pages to the filesystem with PRAGMA incremental_vacuum and finishes
+with PRAGMA optimize.
+
+Everything runs in small batches, each its own short write transaction, with
+a pause in between so pings can take the write lock. Batch sizes adapt so a
+batch holds the lock for at most `max_lock` seconds.
+"""
+
+import asyncio
+import time
+from dataclasses import dataclass
+from datetime import UTC, datetime, timedelta
+
+from . import database
+
+
+@dataclass
+class MaintenanceReport:
+    users: int = 0
+    monitors: int = 0
+    webhooks: int = 0
+    attempts: int = 0
+    outbox: int = 0
+    pages_reclaimed: int = 0
+    duration: float = 0
+
+
+class BatchSizer:
+    """Halve the batch when it held the lock too long, double it when quick."""
+
+    def __init__(self, size=500, max_lock=0.05, minimum=10, maximum=5000):
+        self.size = size
+        self.max_lock = max_lock
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def update(self, elapsed):
+        if elapsed > self.max_lock:
+            self.size = max(self.minimum, self.size // 2)
+        elif elapsed < self.max_lock / 4:
+            self.size = min(self.maximum, self.size * 2)
+
+
+async def drain(step, sizer, pause):
+    """Call step(limit) until it comes back short; returns summed counts.
+
+    step returns an int, or a tuple whose first element is compared with the
+    limit.
+    """
+    totals = None
+    while True:
+        limit = sizer.size
+        start = time.perf_counter()
+        counts = await step(limit)
+        sizer.update(time.perf_counter() - start)
+        if isinstance(counts, int):
+            counts = (counts,)
+        totals = counts if totals is None else tuple(map(sum, zip(totals, counts)))
+        if counts[0] < limit:
+            return totals
+        await asyncio.sleep(pause)
+
+
+async def run_maintenance(
+    user_retention=7 * 86400,
+    outbox_retention=7 * 86400,
+    max_lock=0.05,
+    pause=0.05,
+    vacuum_pages=256,
+):
+    start = time.perf_counter()
+    now = datetime.now(UTC)
+    # deleted_at is naive UTC, like the other DateTime columns
+    user_cutoff = (now - timedelta(seconds=user_retention)).replace(tzinfo=None)
+    sizer = BatchSizer(max_lock=max_lock)
+    report = MaintenanceReport()
+
+    report.monitors, report.webhooks = await drain(
+        lambda n: database.purge_deleted_user_monitors(user_cutoff, n), sizer, pause
+    )
+    (report.users,) = await drain(
+        lambda n: database.purge_deleted_users(user_cutoff, n), sizer, pause
+    )
+    (orphans,) = await drain(database.purge_orphan_webhooks, sizer, pause)
+    report.webhooks += orphans
+    (report.attempts,) = await drain(database.purge_orphan_attempts, sizer, pause)
+    (report.outbox,) = await drain(
+        lambda n: database.purge_outbox(now.timestamp() - outbox_retention, n),
+        sizer,
+        pause,
+    )
+
+    while reclaimed := await database.incremental_vacuum(vacuum_pages):
+        report.pages_reclaimed += reclaimed
+        await asyncio.sleep(pause)
+    await database.optimize()
+
+    report.duration = time.perf_counter() - start
+    return report
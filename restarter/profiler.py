@@ -0,0 +1,94 @@
+"""Sampling profiler for a running worker.
+
+A background thread wakes up every `interval` seconds, reads every other
+thread's current stack with sys._current_frames(), and counts identical
+stacks. Nothing is hooked into the interpreter, so the threads being
+profiled run at full speed; the cost is the sampler's own work, which
+holds the GIL while it walks the frames.
+
+That cost is capped: the sampler times each sample and sleeps long enough
+that it stays under `max_overhead` of wall time, lowering the sample rate
+if it has to. cProfile isn't used because it only sees the thread that
+enabled it and slows down every call it traces.
+
+The result is in collapsed-stack format, one line per distinct stack,
+"thread;module:function;module:function count", root first, which
+flamegraph.pl, speedscope and inferno read directly. On the event loop
+thread, time spent waiting for I/O shows up under the selector's select().
+
+Only one profile runs at a time per worker process.
+"""
+
+import sys
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+
+lock = threading.Lock()
+
+
+class ProfileInProgress(Exception):
+    pass
+
+
+@dataclass
+class Profile:
+    stacks: Counter
+    samples: int
+    duration: float
+    # Seconds the sampler itself spent taking samples
+    overhead: float
+
+    def collapsed(self):
+        return "".join(
+            f"{stack} {count}\n" for stack, count in self.stacks.most_common()
+        )
+
+
+def frame_label(frame):
+    code = frame.f_code
+    return f"{frame.f_globals.get('__name__', '?')}:{code.co_qualname}"
+
+
+def collapse(frame, thread_name):
+    labels = []
+    while frame is not None:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    labels.append(thread_name)
+    return ";".join(reversed(labels))
+
+
+def sample(stacks, skip):
+    names = {t.ident: t.name for t in threading.enumerate()}
+    for ident, frame in sys._current_frames().items():
+        if ident != skip:
+            stacks[collapse(frame, names.get(ident, str(ident)))] += 1
+
+
+def profile(seconds, interval=0.01, max_overhead=0.05):
+    """Sample every thread's stack for `seconds`; blocks the calling thread.
+
+    Raises ProfileInProgress if another profile is running.
+    """
+    if not lock.acquire(blocking=False):
+        raise ProfileInProgress()
+    try:
+        me = threading.get_ident()
+        stacks = Counter()
+        samples = 0
+        overhead = 0.0
+        start = time.perf_counter()
+        deadline = start + seconds
+        while (now := time.perf_counter()) < deadline:
+            sample(stacks, me)
+            cost = time.perf_counter() - now
+            samples += 1
+            overhead += cost
+            # cost / (cost + pause) <= max_overhead
+            pause = max(interval, cost * (1 - max_overhead) / max_overhead)
+            time.sleep(min(pause, max(0.0, deadline - time.perf_counter())))
+        return Profile(stacks, samples, time.perf_counter() - start, overhead)
+    finally:
+        lock.release()
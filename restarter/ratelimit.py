@@ -0,0 +1,57 @@
+"""In-memory token-bucket rate limiting.
+
+Each key gets a bucket holding up to `burst` tokens, refilled at `rate`
+tokens per second. A request takes one token or is rejected with the number
+of seconds until one is available.
+
+Buckets live in an OrderedDict kept in last-used order, so eviction only
+ever looks at the front. A bucket untouched for burst / rate seconds is full
+again, which is the same as having no bucket, so dropping it is free;
+`max_keys` is a hard cap on top of that. Limits are per worker process.
+"""
+
+import time
+from collections import OrderedDict
+
+
+class TokenBucketLimiter:
+    def __init__(self, rate, burst, max_keys=100_000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.clock = clock
+        self.idle_ttl = burst / rate
+        self.buckets = OrderedDict()  # key -> (tokens, last update)
+
+    def acquire(self, key):
+        """Take a token for `key`. Returns 0 if allowed, else seconds to wait."""
+        now = self.clock()
+        self.evict(now)
+        tokens, updated = self.buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        if tokens >= 1:
+            self.buckets[key] = (tokens - 1, now)
+            return 0
+        self.buckets[key] = (tokens, now)
+        return (1 - tokens) / self.rate
+
+    def evict(self, now):
+        buckets = self.buckets
+        while buckets:
+            key, (_, updated) = next(iter(buckets.items()))
+            if now - updated < self.idle_ttl and len(buckets) < self.max_keys:
+                break
+            del buckets[key]
+
+    def __len__(self):
+        return len(self.buckets)
+
+
+limiters = {}
+
+
+def get_limiter(name, rate, burst):
+    limiter = limiters.get(name)
+    if limiter is None or (limiter.rate, limiter.burst) != (rate, burst):
+        limiter = limiters[name] = TokenBucketLimiter(rate, burst)
+    return limiter
@@ -1,9 +1,51 @@
+import ast
+import asyncio
+import gzip
+import io
+import json
+import logging
+import os
+import re
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import closing
+from datetime import UTC, datetime
 from urllib import parse
 
+import httpx
 import pytest
 import pytest_asyncio
+import quart
+import sqlalchemy as sa
 
-from . import app, database
+import restarter
+import serve
+
+from . import (
+    admission,
+    app,
+    assets,
+    attempts,
+    backup,
+    breaker,
+    codec,
+    cron,
+    database,
+    datamigrations,
+    digest,
+    fragments,
+    health,
+    hotpath,
+    logs,
+    looplag,
+    maintenance,
+    ratelimit,
+)
+from .compression import CompressionMiddleware
 from .database import get_monitor_by_key, get_user_by_user_key, text
 
 
@@ -29,6 +71,11 @@ async def db(test_app):
         await conn.run_sync(database.meta.drop_all)
 
 
+@pytest.fixture(autouse=True)
+def fresh_rate_limits(monkeypatch):
+    monkeypatch.setattr(ratelimit, "limiters", {})
+
+
 @pytest.fixture
 def min_create_payload(test_app):
     return dict(
@@ -214,3 +261,1635 @@ async def test_monitor_delete(test_app, min_create_payload, sample_user, test_us
         assert len(result.fetchall()) == 0
         result = await conn.execute(text("SELECT * FROM webhook"))
         assert len(result.fetchall()) == 0
+
+
+def _expired_row(wid, expires_at, user_id=1, url="https://foo2.com", **kw):
+    row = dict(
+        mid=wid,
+        wid=wid,
+        user_id=user_id,
+        name=f"mon{wid}",
+        slug=f"mon{wid}",
+        expires_at=expires_at,
+        url=url,
+        method="post",
+        headers="{}",
+        form_fields='{"token": "t"}',
+        body_payload=None,
+    )
+    row.update(kw)
+    return row
+
+
+def test_group_expiries_no_digest_dedupes_identical_targets():
+    rows = [
+        _expired_row(1, 100),
+        _expired_row(2, 101, url="https://other.com"),
+        _expired_row(3, 5000, user_id=2),  # same request as the first
+        _expired_row(4, 100, body_payload='"down"'),
+    ]
+    groups = digest.group_expiries(rows)
+    assert [[r["wid"] for r in g] for g in groups] == [[1, 3], [2], [4]]
+    # Not a digest: the request goes out exactly as configured
+    assert restarter.make_delivery(groups[0])["form_fields"] == {"token": "t"}
+
+
+def test_group_expiries_by_user_and_window():
+    rows = [
+        _expired_row(1, 100),
+        _expired_row(2, 130),
+        _expired_row(3, 500),  # outside the window of the first group
+        _expired_row(4, 100, user_id=2),
+    ]
+    groups = digest.group_expiries(rows, "user", window=60)
+    assert [[r["wid"] for r in g] for g in groups] == [[1, 2], [3], [4]]
+
+
+def test_group_expiries_by_webhook_spans_users():
+    rows = [
+        _expired_row(1, 100),
+        _expired_row(2, 100, user_id=2),
+        _expired_row(3, 100, user_id=2, form_fields='{"token": "other"}'),
+    ]
+    groups = digest.group_expiries(rows, "webhook", window=60)
+    assert [[r["wid"] for r in g] for g in groups] == [[1, 2], [3]]
+
+
+def test_digest_form_fields_lists_monitors():
+    rows = [_expired_row(1, 100), _expired_row(2, 100)]
+    fields = digest.digest_form_fields({"token": "t", "message": "down"}, rows)
+    assert fields["token"] == "t"
+    assert fields["message"] == "2 monitors expired: mon1 (mon1), mon2 (mon2)"
+    assert digest.digest_form_fields({"message": "down"}, rows[:1]) == {
+        "message": "down"
+    }
+
+
+@pytest_asyncio.fixture
+async def expired_monitor(sample_user, test_user_key):
+    user = await get_user_by_user_key(test_user_key)
+    mid = await database.insert_monitor(user["id"], "m", "KEY1", 60, "m1")
+    wid = await database.insert_webhook(
+        mid, "https://foo2.com", "post", {}, {"token": "t"}, None
+    )
+    async with database.get_engine().begin() as conn:
+        await conn.execute(text("UPDATE monitor SET expires_at=0"))
+    return wid
+
+
+@pytest.mark.asyncio
+async def test_check_things_enqueues_once(test_app, monkeypatch, expired_monitor):
+    async def no_sleep(seconds):
+        pass
+
+    monkeypatch.setattr(restarter.asyncio, "sleep", no_sleep)
+    await restarter.check_things()
+    await restarter.check_things()  # webhook already marked, nothing queued
+
+    rows = await database.claim_outbox(lease_seconds=60, limit=10)
+    assert len(rows) == 1
+    assert json.loads(rows[0]["webhook_ids"]) == [expired_monitor]
+    assert json.loads(rows[0]["form_fields"]) == {"token": "t"}
+    assert rows[0]["attempts"] == 1
+    # Leased rows can't be claimed again until the lease runs out
+    assert await database.claim_outbox(lease_seconds=60) == []
+
+
+@pytest.fixture
+def fresh_health(monkeypatch):
+    for name, value in [("started_at", None), ("completed", 0), ("failed", 0)]:
+        monkeypatch.setattr(health, name, value)
+    monkeypatch.setattr(health, "ticks", deque(maxlen=20))
+
+
+def test_health_problems(fresh_health):
+    limits = dict(max_tick_age=300, max_tick_duration=60, max_backlog_age=600)
+    assert health.problems(10_000, **limits) == []  # no scheduler here
+    health.start(now=1000)
+    assert health.problems(1200, **limits) == []
+    assert health.problems(1400, **limits) == ["no scan started for 400s"]
+
+    tick = health.Tick(started_at=1300)
+    health.ticks.append(tick)
+    assert health.problems(1400, **limits) == ["scan running for 100s"]
+    tick.finished_at, tick.error, tick.backlog_age = 1310, "TimeoutError()", 700
+    assert health.problems(1400, **limits) == [
+        "last scan failed: TimeoutError()",
+        "oldest undelivered expiry is 700s old",
+    ]
+    assert health.backlog_age(100, oldest_expiry=40, oldest_due=70) == 60
+    assert health.backlog_age(100) is None
+
+
+@pytest.mark.asyncio
+async def test_check_things_records_ticks(
+    test_app, monkeypatch, expired_monitor, fresh_health
+):
+    async def no_sleep(seconds):
+        pass
+
+    monkeypatch.setattr(restarter.asyncio, "sleep", no_sleep)
+    health.start()
+    await restarter.check_things()
+    client = test_app.test_client()
+    response = await client.get("/health/scheduler")
+    assert response.status_code == 200
+    data = await response.get_json()
+    assert data["health"] == "good!" and data["ticks"] == 1
+    assert data["last_tick"]["scanned"] == 1 and data["last_tick"]["queued"] == 1
+    assert data["last_tick"]["backlog_age"] < 5
+
+    # The delivery was never sent and the scheduler went quiet
+    monkeypatch.setitem(test_app.config, "HEALTH_MAX_BACKLOG_AGE_SECONDS", 60)
+    monkeypatch.setattr(time, "time", lambda: data["last_tick"]["started_at"] + 3600)
+    response = await client.get("/health")
+    assert response.status_code == 503
+    data = await response.get_json()
+    assert data["health"] == "degraded"
+    assert data["problems"][0] == "no scan started for 3600s"
+    assert data["problems"][-1].startswith("oldest due delivery is")
+    assert data["scheduler"]["ticks"] == 1
+
+
+@pytest.mark.asyncio
+async def test_multiple_webhooks_fan_out_concurrently(
+    test_app, monkeypatch, min_create_payload, sample_user, test_user_key
+):
+    async def no_sleep(seconds):
+        pass
+
+    client = test_app.test_client()
+    headers = {"x-user-key": test_user_key}
+    payload = dict(min_create_payload["json"])
+    payload["webhooks"] = [
+        payload.pop("webhook"),
+        {"url": "https://foo3.com", "method": "get"},
+        {"url": "https://foo4.com", "method": "post", "form_fields": {"a": "b"}},
+    ]
+    response = await client.post("/monitors", json=payload, headers=headers)
+    assert response.status_code == 200
+    jr = await response.get_json()
+    assert [w["url"] for w in jr["webhooks"]] == [
+        "https://foo2.com",
+        "https://foo3.com",
+        "https://foo4.com",
+    ]
+    assert jr["webhook"]["url"] == "https://foo2.com"
+    for bad in [
+        dict(payload, slug="both", webhook=payload["webhooks"][0]),
+        dict(payload, slug="many", webhooks=payload["webhooks"] * 4),
+    ]:
+        response = await client.post("/monitors", json=bad, headers=headers)
+        assert response.status_code == 400
+
+    async with database.get_engine().begin() as conn:
+        await conn.execute(text("UPDATE monitor SET expires_at=0"))
+    monkeypatch.setattr(restarter.asyncio, "sleep", no_sleep)
+    await restarter.check_things()
+    rows = await database.claim_outbox(lease_seconds=60, limit=16)
+    assert len(rows) == 3
+
+    in_flight = []
+    all_started = asyncio.Event()
+
+    async def deliver_webhook(wids, url, *args):
+        # Only returns once every delivery is in flight at the same time
+        in_flight.append(url)
+        if len(in_flight) == 3:
+            all_started.set()
+        async with asyncio.timeout(1):
+            await all_started.wait()
+        return False, None
+
+    monkeypatch.setattr(restarter, "deliver_webhook", deliver_webhook)
+    await restarter.deliver_outbox_rows(rows)
+    async with database.get_engine().connect() as conn:
+        done = await conn.execute(
+            text("SELECT count(*) FROM outbox WHERE done_at IS NOT NULL")
+        )
+        assert done.scalar() == 3
+    assert await database.claim_outbox(lease_seconds=0, limit=16) == []
+
+
+@pytest.mark.parametrize("fast", [True, False])
+def test_codec_backends_agree(monkeypatch, fast):
+    if not fast:
+        monkeypatch.setattr(codec, "orjson", None)
+    elif codec.orjson is None:
+        pytest.skip("orjson not installed")
+    value = {"message": "déjà vu", "ids": [1, 2], "body": None}
+    assert codec.loads(codec.dumps(value)) == value
+    assert codec.loads(codec.dumpb(value)) == value
+    assert json.loads(codec.dumps(value)) == value
+    with pytest.raises(ValueError):
+        codec.loads("{nope")
+
+
+@pytest.mark.asyncio
+async def test_hotpath_enqueue_rolls_back(expired_monitor):
+    good = {
+        "webhook_ids": [expired_monitor],
+        "url": "https://foo2.com",
+        "method": "post",
+        "headers": {},
+        "form_fields": {},
+    }
+    # Fails after the webhook was marked, while writing the outbox row
+    with pytest.raises(TypeError):
+        await hotpath.enqueue_deliveries([{**good, "headers": object()}])
+    # Nothing was marked called, so the scan still sees the monitor
+    (row,) = await hotpath.get_expired_monitors()
+    assert row["wid"] == expired_monitor
+    assert await hotpath.enqueue_deliveries([good]) == 1
+    assert await hotpath.get_expired_monitors() == []
+
+
+@pytest.mark.asyncio
+async def test_outbox_lease_guards_completion(expired_monitor):
+    delivery = {
+        "webhook_ids": [expired_monitor],
+        "url": "https://foo2.com",
+        "method": "post",
+        "headers": {},
+        "form_fields": {},
+    }
+    assert await hotpath.enqueue_deliveries([delivery]) == 1
+    (row,) = await database.claim_outbox(lease_seconds=0)
+    # Lease expired: another dispatcher takes it over
+    (row2,) = await database.claim_outbox(lease_seconds=60)
+    assert row2["id"] == row["id"] and row2["attempts"] == 2
+    assert not await database.complete_outbox(row["id"], row["lease_token"])
+    assert await database.retry_outbox(row2["id"], row2["lease_token"], 0, "HTTP 503")
+    (row3,) = await database.claim_outbox(lease_seconds=60)
+    assert await database.complete_outbox(row3["id"], row3["lease_token"])
+    assert await database.claim_outbox(lease_seconds=0) == []
+
+
+@pytest.mark.asyncio
+async def test_outbox_row_gives_up_when_delivery_raises(
+    test_app, monkeypatch, expired_monitor
+):
+    monkeypatch.setitem(test_app.config, "OUTBOX_MAX_ATTEMPTS", 2)
+    calls = []
+
+    async def deliver_webhook(*args):
+        calls.append(args)
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(restarter, "deliver_webhook", deliver_webhook)
+    delivery = {
+        "webhook_ids": [expired_monitor],
+        "url": "https://foo2.com",
+        "method": "post",
+        "headers": {},
+        "form_fields": {},
+    }
+    assert await hotpath.enqueue_deliveries([delivery]) == 1
+
+    async def outbox_row():
+        async with database.get_engine().connect() as conn:
+            result = await conn.execute(text("SELECT * FROM outbox"))
+            return result.mappings().one()
+
+    (row,) = await database.claim_outbox(lease_seconds=60, max_attempts=2)
+    await restarter.deliver_outbox_rows([row])
+    # The lease was released and the row backs off like any failed delivery
+    row = await outbox_row()
+    assert row["lease_token"] is None and row["done_at"] is None
+    assert "boom" in row["last_error"]
+    assert row["available_at"] > time.time() + 20
+
+    async with database.get_engine().begin() as conn:
+        await conn.execute(text("UPDATE outbox SET available_at=0"))
+    (row,) = await database.claim_outbox(lease_seconds=60, max_attempts=2)
+    await restarter.deliver_outbox_rows([row])
+    # The last attempt raised too: done, not rescheduled
+    row = await outbox_row()
+    assert row["done_at"] is not None and "boom" in row["last_error"]
+    assert await database.claim_outbox(lease_seconds=0, max_attempts=2) == []
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_claim_outbox_gives_up_on_expired_leases(expired_monitor):
+    delivery = {
+        "webhook_ids": [expired_monitor],
+        "url": "https://foo2.com",
+        "method": "post",
+        "headers": {},
+        "form_fields": {},
+    }
+    assert await hotpath.enqueue_deliveries([delivery]) == 1
+    # Each dispatcher dies holding the lease
+    for _ in range(2):
+        assert len(await database.claim_outbox(lease_seconds=0, max_attempts=2)) == 1
+    assert await database.claim_outbox(lease_seconds=0, max_attempts=2) == []
+    async with database.get_engine().connect() as conn:
+        result = await conn.execute(text("SELECT done_at, last_error FROM outbox"))
+        done_at, last_error = result.one()
+    assert done_at is not None and last_error == "gave up after 2 attempts"
+
+
+@pytest.mark.asyncio
+async def test_deliver_outbox_row_retries_with_backoff(test_app, monkeypatch):
+    retried = []
+
+    async def deliver_webhook(*args):
+        return True, "HTTP 503"
+
+    async def retry_outbox(*args):
+        retried.append(args)
+
+    monkeypatch.setattr(restarter, "deliver_webhook", deliver_webhook)
+    monkeypatch.setattr(database, "retry_outbox", retry_outbox)
+    row = dict(
+        id=1,
+        lease_token="tok",
+        attempts=3,
+        webhook_ids="[1]",
+        url="https://foo2.com",
+        method="post",
+        headers="{}",
+        form_fields="{}",
+    )
+    await restarter.deliver_outbox_row(row)
+    assert retried == [(1, "tok", 120, "HTTP 503")]
+
+
+def test_circuit_breaker_transitions():
+    now = [0.0]
+    cb = breaker.CircuitBreaker(
+        failure_threshold=2, reset_timeout=10, clock=lambda: now[0]
+    )
+    assert cb.allow()
+    cb.record_failure()
+    assert cb.state == breaker.CLOSED
+    cb.record_failure()
+    assert cb.state == breaker.OPEN
+    assert not cb.allow()
+
+    now[0] = 11
+    assert cb.allow()  # the probe
+    assert cb.state == breaker.HALF_OPEN
+    assert not cb.allow()  # only one probe at a time
+    cb.record_failure()
+    assert cb.state == breaker.OPEN
+
+    now[0] = 22
+    assert cb.allow()
+    cb.record_success()
+    assert cb.state == breaker.CLOSED
+    assert cb.allow()
+
+
+@pytest.mark.asyncio
+async def test_read_bounded_truncates():
+    client = httpx.AsyncClient(
+        transport=httpx.MockTransport(
+            lambda r: httpx.Response(200, content=b"x" * 10**6)
+        )
+    )
+    async with client.stream("GET", "https://foo2.com") as resp:
+        content = await restarter.read_bounded(resp, 4096)
+    await client.aclose()
+    assert len(content) == 4096
+
+
+@pytest.mark.asyncio
+async def test_deliver_webhook_opens_breaker(test_app, monkeypatch):
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(503)
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(restarter, "http_client", client)
+    monkeypatch.setattr(breaker, "breakers", {})
+    monkeypatch.setitem(test_app.config, "BREAKER_FAILURE_THRESHOLD", 2)
+    monkeypatch.setattr(attempts, "pending", [])
+    results = [
+        await restarter.deliver_webhook([1], "https://dead.example", "POST", {}, {})
+        for _ in range(4)
+    ]
+    await client.aclose()
+
+    assert len(calls) == 2  # the rest were skipped by the open breaker
+    assert results == [(True, "HTTP 503")] * 2 + [(True, "circuit open")] * 2
+    assert breaker.snapshot()["dead.example"]["state"] == breaker.OPEN
+    # Skipped deliveries made no request, so only two attempts were logged
+    assert [a["sc"] for a in attempts.pending] == [503, 503]
+
+
+@pytest.mark.asyncio
+async def test_deliver_webhook_redirect_loop_and_bad_body(test_app, monkeypatch):
+    def handler(request):
+        if request.url.host == "loop.example":
+            return httpx.Response(302, headers={"Location": str(request.url)})
+        # Claims gzip but isn't
+        return httpx.Response(
+            200, headers={"Content-Encoding": "gzip"}, content=b"not gzip"
+        )
+
+    client = httpx.AsyncClient(
+        transport=httpx.MockTransport(handler), follow_redirects=True, max_redirects=3
+    )
+    monkeypatch.setattr(restarter, "http_client", client)
+    monkeypatch.setattr(breaker, "breakers", {})
+    monkeypatch.setitem(test_app.config, "BREAKER_FAILURE_THRESHOLD", 1)
+    monkeypatch.setattr(attempts, "pending", [])
+
+    retry, error = await restarter.deliver_webhook(
+        [1], "https://loop.example/a", "POST", {}, {}
+    )
+    assert not retry and "TooManyRedirects" in error
+    # The host answered, so a half-open probe resolves and nothing is tracked
+    assert "loop.example" not in breaker.snapshot()
+
+    retry, error = await restarter.deliver_webhook(
+        [2], "https://gzip.example/a", "POST", {}, {}
+    )
+    assert retry and "DecodingError" in error
+    # The failure counts against the host
+    assert breaker.snapshot()["gzip.example"]["state"] == breaker.OPEN
+    await client.aclose()
+
+    assert [a["ec"] for a in attempts.pending] == ["TooManyRedirects", "DecodingError"]
+    summary = attempts.summarize(
+        [
+            {
+                "host": "h",
+                "duration_ms": 1,
+                "error_class": a["ec"],
+                "status_code": a["sc"],
+            }
+            for a in attempts.pending
+        ]
+    )
+    assert summary["h"]["failures"] == 2
+
+
+@pytest.mark.asyncio
+async def test_delivery_log_batches_trims_and_summarizes(
+    test_app, monkeypatch, expired_monitor, test_user_key
+):
+    statuses = iter([200, 200, 503, 200])
+
+    def handler(request):
+        return httpx.Response(next(statuses), content=b"ok")
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(restarter, "http_client", client)
+    monkeypatch.setattr(breaker, "breakers", {})
+    monkeypatch.setattr(attempts, "pending", [])
+    for _ in range(4):
+        await restarter.deliver_webhook(
+            [expired_monitor], "https://foo2.com/hook", "POST", {}, {}
+        )
+    await client.aclose()
+    assert len(attempts.pending) == 4
+
+    assert await attempts.flush(keep=3, batch_size=10) == 4
+    assert attempts.pending == []
+    response = await test_app.test_client().get(
+        "/monitors/m1/deliveries?limit=2", headers={"x-user-key": test_user_key}
+    )
+    assert response.status_code == 200
+    data = await response.get_json()
+    # Only the newest three were kept
+    assert [d["status_code"] for d in data["deliveries"]] == [200, 503]
+    host = data["hosts"]["foo2.com"]
+    assert host["attempts"] == 3 and host["failures"] == 1
+    assert 0 <= host["p50_ms"] <= host["p99_ms"] == host["max_ms"]
+    assert data["deliveries"][0]["response_bytes"] == 2
+
+    for limit, expected in [("-1", [200]), ("0", [200]), ("1000", [200, 503, 200])]:
+        response = await test_app.test_client().get(
+            f"/monitors/m1/deliveries?limit={limit}",
+            headers={"x-user-key": test_user_key},
+        )
+        data = await response.get_json()
+        assert [d["status_code"] for d in data["deliveries"]] == expected
+        assert data["hosts"]["foo2.com"]["attempts"] == 3
+
+    response = await test_app.test_client().get(
+        "/monitors/nope/deliveries", headers={"x-user-key": test_user_key}
+    )
+    assert response.status_code == 404
+
+
+def test_percentile_nearest_rank():
+    values = list(range(1, 101))
+    assert attempts.percentile(values, 0.5) == 50
+    assert attempts.percentile(values, 0.99) == 99
+    assert attempts.percentile([7], 0.9) == 7
+    assert attempts.percentile([], 0.5) is None
+
+
+def test_logs_queue_json_and_sampling():
+    stream = io.StringIO()
+    logger = logging.getLogger("restarter.test.delivery")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.addHandler(logging.StreamHandler(stream))
+    logs.install(sample_rates={"restarter.test": 3})
+    try:
+        assert isinstance(logger.handlers[0], logs.StructuredQueueHandler)
+        for i in range(6):
+            logger.info("hit %s", i, extra={"webhook_ids": [i], "outcome": "ok"})
+        logger.debug("disabled, never formatted %s", object())
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            logger.exception("failed", extra={"monitor_id": 7})
+    finally:
+        logs.uninstall()
+    assert type(logger.handlers[0]) is logging.StreamHandler
+    logger.handlers.clear()
+
+    records = [json.loads(line) for line in stream.getvalue().splitlines()]
+    # Every third info record, and the error regardless of sampling
+    assert [r["message"] for r in records] == ["hit 0", "hit 3", "failed"]
+    assert records[1]["webhook_ids"] == [3] and records[1]["sampled"] == 3
+    assert records[2]["monitor_id"] == 7 and records[2]["level"] == "ERROR"
+    assert "ZeroDivisionError" in records[2]["exc"]
+
+
+def test_logs_queue_text_keeps_access_formatter():
+    from uvicorn.logging import AccessFormatter
+
+    stream = io.StringIO()
+    logger = logging.getLogger("restarter.test.access")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(AccessFormatter("%(request_line)s %(status_code)s"))
+    logger.addHandler(handler)
+    logs.install(json=False)
+    try:
+        logger.info(
+            '%s - "%s %s HTTP/%s" %d', "1.2.3.4:5", "GET", "/health", "1.1", 200
+        )
+    finally:
+        logs.uninstall()
+    logger.handlers.clear()
+    assert stream.getvalue() == "GET /health HTTP/1.1 200 OK\n"
+
+
+def test_head_revision_matches_alembic():
+    from alembic.config import Config
+    from alembic.script import ScriptDirectory
+
+    script = ScriptDirectory.from_config(Config("alembic.ini"))
+    assert script.get_current_head() == database.HEAD_REVISION
+
+
+@pytest.mark.asyncio
+async def test_run_migrations_skips_when_at_head(test_app, tmp_path, monkeypatch):
+    dbfile = str(tmp_path / "migrated.db")
+    assert database.current_revision(dbfile) is None
+    monkeypatch.setitem(test_app.config, "DATABASE", dbfile)
+    await restarter.run_migrations(dbfile)
+    assert database.current_revision(dbfile) == database.HEAD_REVISION
+    with closing(sqlite3.connect(dbfile)) as conn:
+        assert conn.execute("PRAGMA auto_vacuum").fetchone() == (2,)  # incremental
+
+    def fail(db_path):
+        raise AssertionError("alembic should not run")
+
+    monkeypatch.setattr(restarter, "upgrade_schema", fail)
+    await restarter.run_migrations(dbfile)
+
+
+def test_create_schema_matches_migrations(test_app, tmp_path, monkeypatch):
+    from alembic import command
+    from alembic.autogenerate import compare_metadata
+    from alembic.config import Config
+    from alembic.migration import MigrationContext
+
+    migrated, created = str(tmp_path / "migrated.db"), str(tmp_path / "created.db")
+    monkeypatch.setitem(test_app.config, "DATABASE", migrated)  # read by env.py
+    command.upgrade(Config("alembic.ini"), "head")
+    assert not database.create_schema(migrated)
+    assert database.create_schema(created)
+
+    def schema(dbfile):
+        with closing(sqlite3.connect(dbfile)) as conn:
+            names = set(conn.execute("SELECT type, name FROM sqlite_master"))
+            settings = [conn.execute(f"PRAGMA {p}").fetchone() for p in PRAGMAS]
+        engine = sa.create_engine(f"sqlite:///{dbfile}")
+        with engine.connect() as conn:
+            context = MigrationContext.configure(conn)
+            assert compare_metadata(context, database.meta) == []
+            revision = context.get_current_revision()
+        engine.dispose()
+        return names, settings, revision
+
+    PRAGMAS = ("auto_vacuum", "journal_mode")
+    assert schema(created) == schema(migrated)
+    assert schema(created)[2] == database.HEAD_REVISION
+
+
+def test_token_bucket_refills_and_evicts():
+    now = [0.0]
+    limiter = ratelimit.TokenBucketLimiter(
+        rate=1, burst=2, max_keys=3, clock=lambda: now[0]
+    )
+    assert limiter.acquire("a") == 0
+    assert limiter.acquire("a") == 0
+    assert limiter.acquire("a") == pytest.approx(1)
+    now[0] = 1.5
+    assert limiter.acquire("a") == 0
+    assert limiter.acquire("a") == pytest.approx(0.5)
+
+    # Idle buckets are dropped once they would have refilled completely
+    now[0] = 10
+    limiter.acquire("b")
+    assert list(limiter.buckets) == ["b"]
+    # and the hard cap holds regardless
+    for key in "cdef":
+        limiter.acquire(key)
+    assert len(limiter) == 3
+
+
+@pytest.mark.asyncio
+async def test_monitor_update_rate_limited(test_app, monkeypatch):
+    monkeypatch.setitem(test_app.config, "RATELIMIT_MONITOR_BURST", 2)
+    calls = []
+
+    async def update_monitor(key):
+        calls.append(key)
+        return 1
+
+    monkeypatch.setattr(hotpath, "update_monitor", update_monitor)
+    test_client = test_app.test_client()
+    for _ in range(2):
+        response = await test_client.post("/monitor/MABCD")
+        assert response.status_code == 200
+    response = await test_client.post("/monitor/MABCD")
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    assert calls == ["ABCD", "ABCD"]
+    # Other monitors have their own bucket
+    response = await test_client.post("/monitor/MOTHER")
+    assert response.status_code == 200
+
+
+def test_admission_controller():
+    now = [0.0]
+    controller = admission.AdmissionController(clock=lambda: now[0])
+    first = controller.enter()
+    second = controller.enter()
+    assert controller.admit(max_in_flight=3, max_queue_wait=1) == 0
+    # first is running, second has been waiting for 2.5s
+    first.started = 0.5
+    now[0] = 2.5
+    assert controller.queue_wait() == 2.5
+    assert controller.admit(max_in_flight=3, max_queue_wait=1) == 3
+    third = controller.enter()
+    assert controller.admit(max_in_flight=3, max_queue_wait=5) == 3
+    # Once the queue drains, the wait is gone right away
+    for ticket in (first, second, third):
+        controller.leave(ticket)
+    assert controller.admit(max_in_flight=3, max_queue_wait=1) == 0
+    assert controller.snapshot() == {
+        "in_flight": 0,
+        "peak_in_flight": 3,
+        "queue_wait": 0.0,
+        "admitted": 2,
+        "shed": {"queue_wait": 1, "in_flight": 1},
+    }
+
+
+@pytest.mark.asyncio
+async def test_monitor_update_shed_when_hotpath_backed_up(test_app, monkeypatch):
+    monkeypatch.setattr(admission, "controller", admission.AdmissionController())
+    monkeypatch.setitem(test_app.config, "ADMISSION_MAX_IN_FLIGHT", 2)
+    test_client = test_app.test_client()
+    release = threading.Event()
+    # Hold the hot-path thread, like a write stuck behind a busy database
+    blocked = [
+        asyncio.create_task(hotpath.run(lambda conn: release.wait(5))) for _ in range(2)
+    ]
+    await asyncio.sleep(0.05)
+    response = await test_client.post("/monitor/MABCD")
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
+    release.set()
+    await asyncio.gather(*blocked)
+    response = await test_client.post("/monitor/MABCD")
+    assert response.status_code == 404
+    response = await test_client.get(
+        "/admin/admission", headers={"x-admin-key": test_app.config["ADMIN_KEY"]}
+    )
+    assert (await response.get_json())["shed"] == {"in_flight": 1}
+
+
+def _ts(*args):
+    return datetime(*args, tzinfo=UTC).timestamp()
+
+
+@pytest.mark.parametrize(
+    "expr,after,expected",
+    [
+        # 2026-10-19 is a Monday
+        ("0 2 * * 1-5", _ts(2026, 10, 19, 2, 0), _ts(2026, 10, 20, 2, 0)),
+        ("0 2 * * mon-fri", _ts(2026, 10, 23, 3, 0), _ts(2026, 10, 26, 2, 0)),
+        ("*/15 * * * *", _ts(2026, 10, 19, 2, 7, 30), _ts(2026, 10, 19, 2, 15)),
+        ("@hourly", _ts(2026, 12, 31, 23, 0), _ts(2027, 1, 1, 0, 0)),
+        ("30 4 1 */3 *", _ts(2026, 10, 19), _ts(2027, 1, 1, 4, 30)),
+        ("0 0 29 feb *", _ts(2026, 3, 1), _ts(2028, 2, 29)),
+        # day of month OR day of week when both are restricted
+        ("0 9 1 * sun", _ts(2026, 10, 19), _ts(2026, 10, 25, 9, 0)),
+        ("0 0 * * 7", _ts(2026, 10, 19), _ts(2026, 10, 25)),
+        ("5-10 8-9 * * *", _ts(2026, 10, 19, 9, 10), _ts(2026, 10, 20, 8, 5)),
+        ("59 23 31 dec *", _ts(2026, 12, 31, 23, 59), _ts(2027, 12, 31, 23, 59)),
+    ],
+)
+def test_cron_next_fire(expr, after, expected):
+    assert cron.next_fire(expr, after) == expected
+
+
+@pytest.mark.parametrize(
+    "expr", ["* * * *", "60 * * * *", "* * * * 8", "*/0 * * * *", "0 0 30 2 *"]
+)
+def test_cron_invalid(expr):
+    with pytest.raises(ValueError):
+        cron.next_fire(expr, _ts(2026, 10, 19))
+
+
+@pytest.mark.asyncio
+async def test_monitor_create_scheduled(
+    test_app, min_create_payload, sample_user, test_user_key
+):
+    test_client = test_app.test_client()
+    min_create_payload["headers"]["x-user-key"] = test_user_key
+    del min_create_payload["json"]["frequency"]
+    min_create_payload["json"]["schedule"] = "0 2 * * 1-5"
+    min_create_payload["json"]["grace"] = 600
+    response = await test_client.post("/monitors", **min_create_payload)
+    assert response.status_code == 200
+    jr = await response.json
+    assert jr["schedule"] == "0 2 * * 1-5"
+    assert jr["report_if_not_called_in"] is None
+    path = parse.urlparse(jr["monitor_url"]).path
+    key = path.split("/")[-1][1:]
+
+    mon = await get_monitor_by_key(key)
+    assert mon["expires_at"] == cron.next_fire("0 2 * * 1-5", time.time()) + 600
+
+    await test_client.post(path)
+    mon = await get_monitor_by_key(key)
+    assert mon["expires_at"] == cron.next_fire("0 2 * * 1-5", time.time()) + 600
+
+
+@pytest.mark.asyncio
+async def test_monitor_create_schedule_bogus(
+    test_app, min_create_payload, sample_user, test_user_key
+):
+    test_client = test_app.test_client()
+    min_create_payload["headers"]["x-user-key"] = test_user_key
+    min_create_payload["json"]["schedule"] = "0 2 * * 1-5"  # and a frequency
+    response = await test_client.post("/monitors", **min_create_payload)
+    assert response.status_code == 400
+    del min_create_payload["json"]["frequency"]
+    min_create_payload["json"]["schedule"] = "0 25 * * *"
+    response = await test_client.post("/monitors", **min_create_payload)
+    assert response.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_monitors_export_import_roundtrip(
+    test_app, min_create_payload, sample_user, test_user_key
+):
+    test_client = test_app.test_client()
+    min_create_payload["headers"]["x-user-key"] = test_user_key
+    min_create_payload["json"]["webhook"]["form_fields"] = {"token": "t"}
+    min_create_payload["json"]["tags"] = ["db", "nightly"]
+    await test_client.post("/monitors", **min_create_payload)
+    headers = {"x-user-key": test_user_key}
+
+    response = await test_client.get("/monitors/export", headers=headers)
+    assert response.status_code == 200
+    lines = (await response.get_data()).splitlines()
+    assert len(lines) == 1
+    exported = json.loads(lines[0])
+    assert exported["slug"] == "testslug"
+    assert exported["frequency"] == 60
+    assert exported["webhooks"][0]["form_fields"] == {"token": "t"}
+    assert sorted(exported["tags"]) == ["db", "nightly"]
+
+    # Upsert the existing monitor by slug, add a scheduled one, and a bad line
+    exported["name"] = "renamed"
+    exported["tags"] = ["db"]
+    new = dict(exported, slug="other", frequency=None, schedule="@daily")
+    del new["api_key"]
+    body = b"\n".join(
+        [json.dumps(exported).encode(), json.dumps(new).encode(), b"{nope", b""]
+    )
+    response = await test_client.post("/monitors/import", data=body, headers=headers)
+    assert response.status_code == 200
+    jr = await response.json
+    assert jr["imported"] == 2
+    assert [e["line"] for e in jr["errors"]] == [3]
+
+    mon = await get_monitor_by_key(exported["api_key"])
+    assert mon["name"] == "renamed"
+    user = await get_user_by_user_key(test_user_key)
+    monitors = await database.get_monitors_by_user_id(user["id"])
+    assert sorted(m["slug"] for m in monitors) == ["other", "testslug"]
+    assert len({m["api_key"] for m in monitors}) == 2
+    # Tags were replaced, and the new monitor got its own
+    paused = database.PAUSED_INDEFINITELY
+    assert await database.set_paused(user["id"], paused, tag="db") == 2
+    assert await database.set_paused(user["id"], paused, tag="nightly") == 0
+
+
+@pytest.mark.asyncio
+async def test_monitors_import_replaces_bad_and_repeated_keys(
+    test_app, sample_user, test_user_key
+):
+    test_client = test_app.test_client()
+    headers = {"x-user-key": test_user_key}
+    key = "ABCDEFGHIJ123456"
+    webhook = {"url": "https://foo.com", "method": "post"}
+    lines = [
+        {"slug": slug, "api_key": api_key}
+        for slug, api_key in [
+            ("m-a", key),
+            ("m-b", key),
+            ("m-c", "a/b"),
+            ("m-d", key.lower()),
+        ]
+    ]
+    body = b"\n".join(
+        json.dumps(dict(line, name="n", frequency=60, webhook=webhook)).encode()
+        for line in lines
+    )
+    response = await test_client.post("/monitors/import", data=body, headers=headers)
+    assert response.status_code == 200
+    assert (await response.json)["imported"] == 4
+
+    user = await get_user_by_user_key(test_user_key)
+    monitors = await database.get_monitors_by_user_id(user["id"])
+    keys = {m["slug"]: m["api_key"] for m in monitors}
+    assert keys["m-a"] == key
+    assert len(set(keys.values())) == 4
+    assert all(restarter.MONITOR_KEY_RE.fullmatch(k) for k in keys.values())
+
+
+@pytest.mark.asyncio
+async def test_monitors_import_over_the_default_body_limit(
+    test_app, monkeypatch, sample_user, test_user_key
+):
+    test_client = test_app.test_client()
+    headers = {"x-user-key": test_user_key}
+    webhook = {"url": "https://foo.com", "method": "post"}
+    # Lines padded to just under the line limit, past Quart's 16 MB default
+    padding = b" " * 60000
+    lines = [
+        codec.dumpb(
+            {"name": "n", "slug": f"m-{i}", "frequency": 60, "webhook": webhook}
+        )
+        + padding
+        for i in range(300)
+    ]
+    body = b"\n".join(lines)
+    assert len(body) > test_app.config["MAX_CONTENT_LENGTH"]
+    response = await test_client.post("/monitors/import", data=body, headers=headers)
+    assert response.status_code == 200
+    assert (await response.json)["imported"] == 300
+
+    monkeypatch.setitem(test_app.config, "IMPORT_MAX_BYTES", len(body) - 1)
+    response = await test_client.post("/monitors/import", data=body, headers=headers)
+    assert response.status_code == 413
+    # Other routes keep the default
+    response = await test_client.post(
+        "/monitors",
+        data=body,
+        headers=dict(headers, **{"content-type": "application/json"}),
+    )
+    assert response.status_code == 413
+
+
+@pytest.mark.asyncio
+async def test_pause_and_resume_by_tag_and_slug(
+    test_app,
+    min_create_payload,
+    sample_user,
+    sample_user_two,
+    test_user_key,
+    test_user_key_two,
+):
+    client = test_app.test_client()
+    for key in (test_user_key, test_user_key_two):
+        for slug, tags in [("db-1", ["db", "db"]), ("db-2", ["db"]), ("web-1", [])]:
+            payload = dict(min_create_payload["json"], slug=slug, tags=tags)
+            response = await client.post(
+                "/monitors", json=payload, headers={"x-user-key": key}
+            )
+            assert response.status_code == 200
+    async with database.get_engine().begin() as conn:
+        await conn.execute(text("UPDATE monitor SET expires_at=0"))
+
+    async def expired_slugs():
+        # As the scan sees them
+        await hotpath.end_lapsed_pauses()
+        return sorted(row["slug"] for row in await hotpath.get_expired_monitors())
+
+    headers = {"x-user-key": test_user_key}
+    response = await client.post("/monitors/pause", json={"tag": "db"}, headers=headers)
+    assert await response.get_json() == {"paused": 2, "until": None}
+    response = await client.post("/monitors/pause", json={"tag": "db"}, headers=headers)
+    assert (await response.get_json())["paused"] == 0  # already paused
+    # The other user's monitors with the same tag alert as before
+    assert await expired_slugs() == ["db-1", "db-2", "web-1", "web-1"]
+
+    until = time.time() + 3600
+    response = await client.post(
+        "/monitors/pause", json={"slug": "web-*", "until": until}, headers=headers
+    )
+    assert (await response.get_json())["paused"] == 1
+    assert await expired_slugs() == ["db-1", "db-2", "web-1"]
+
+    response = await client.post(
+        "/monitors/resume", json={"tag": "db", "slug": "*-2"}, headers=headers
+    )
+    assert await response.get_json() == {"resumed": 1}
+    # The deadline it missed while paused doesn't alert; it has a new one
+    assert await expired_slugs() == ["db-1", "db-2", "web-1"]
+    mon = await database.get_monitor_by_user_id_slug(1, "db-2")
+    assert mon["paused_until"] is None
+    assert time.time() + 50 < mon["expires_at"] <= time.time() + 60
+
+    # Neither does one that lapsed during a pause that has just run out,
+    async with database.get_engine().begin() as conn:
+        await conn.execute(
+            text(
+                "UPDATE monitor SET paused_until=:pu "
+                "WHERE slug='web-1' AND user_id=1"
+            ),
+            {"pu": time.time() - 10},
+        )
+    assert await expired_slugs() == ["db-1", "db-2", "web-1"]
+    # but missing the first deadline after the pause does
+    async with database.get_engine().begin() as conn:
+        await conn.execute(
+            text(
+                "UPDATE monitor SET expires_at=0, paused_until=1 "
+                "WHERE slug='web-1' AND user_id=1"
+            )
+        )
+    assert await expired_slugs() == ["db-1", "db-2", "web-1", "web-1"]
+
+    for body in [{}, {"tag": "No Spaces"}, {"slug": "x", "until": 1}]:
+        response = await client.post("/monitors/pause", json=body, headers=headers)
+        assert response.status_code == 400, body
+    response = await client.delete(
+        "/monitor/M" + (await database.get_monitors_by_user_id(1))[0]["api_key"],
+        headers=headers,
+    )
+    assert response.status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_ndjson_lines_streams():
+    async def body():
+        for chunk in [b'{"a"', b': 1}\n{"b": 2}\n', b"\n", b'{"c": 3}']:
+            yield chunk
+
+    lines = [line async for line in restarter.ndjson_lines(body())]
+    assert lines == [b'{"a": 1}', b'{"b": 2}', b'{"c": 3}']
+
+
+@pytest.mark.asyncio
+async def test_backup_while_pinging(test_app, tmp_path, sample_user, test_user_key):
+    user = await get_user_by_user_key(test_user_key)
+    await database.insert_monitor(user["id"], "m", "PINGKEY", 60, "m1")
+    dbfile = test_app.config["DATABASE"]
+    # Bulk up the database so the backup takes a while
+    with closing(sqlite3.connect(dbfile)) as conn:
+        conn.executemany(
+            "INSERT INTO monitor (user_id, name, slug, frequency, expires_at, "
+            "api_key) VALUES (?, ?, ?, 60, 0, ?)",
+            ((user["id"], "x" * 500, f"s{i}", f"K{i}") for i in range(50000)),
+        )
+        conn.commit()
+
+    task = asyncio.create_task(
+        asyncio.to_thread(backup.run_backup, dbfile, str(tmp_path), keep=2)
+    )
+    pings = 0
+    slowest = 0
+    while not task.done():
+        start = time.perf_counter()
+        assert await hotpath.update_monitor("PINGKEY")
+        slowest = max(slowest, time.perf_counter() - start)
+        pings += 1
+    report = await task
+
+    assert pings > 1
+    # Pings weren't held up waiting for the backup to finish
+    assert slowest < report.duration
+    with closing(sqlite3.connect(report.path)) as conn:
+        assert conn.execute("PRAGMA integrity_check").fetchone() == ("ok",)
+        assert conn.execute("SELECT count(*) FROM monitor").fetchone() == (50001,)
+    assert report.pages > 0
+
+    # Rotation keeps the newest two
+    for _ in range(2):
+        await asyncio.to_thread(backup.run_backup, dbfile, str(tmp_path), keep=2)
+    assert len(backup.list_backups(str(tmp_path))) == 2
+    assert report.path not in backup.list_backups(str(tmp_path))
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize(
+    "method,path",
+    [
+        ("GET", "/admin/breakers"),
+        ("GET", "/admin/loop"),
+        ("GET", "/admin/migrations"),
+        ("GET", "/admin/admission"),
+        ("POST", "/admin/profile"),
+        ("POST", "/admin/backup"),
+    ],
+)
+async def test_admin_endpoints_need_admin_key(test_app, method, path):
+    test_client = test_app.test_client()
+    for headers in ({}, {"x-admin-key": "wrong"}):
+        response = await test_client.open(path, method=method, headers=headers)
+        assert response.status_code == 401
+
+
+@pytest.mark.asyncio
+async def test_admin_backup(test_app, tmp_path, monkeypatch):
+    monkeypatch.setitem(test_app.config, "BACKUP_DIR", str(tmp_path))
+    test_client = test_app.test_client()
+    response = await test_client.post("/admin/backup")
+    assert response.status_code == 401
+    response = await test_client.post(
+        "/admin/backup", headers={"x-admin-key": test_app.config["ADMIN_KEY"]}
+    )
+    assert response.status_code == 200
+    jr = await response.json
+    assert jr["path"].startswith(str(tmp_path))
+    assert jr["pages"] > 0
+
+
+def busy_wait(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+@pytest.mark.asyncio
+async def test_admin_profile(test_app):
+    test_client = test_app.test_client()
+    headers = {"x-admin-key": test_app.config["ADMIN_KEY"]}
+    response = await test_client.post("/admin/profile?seconds=1")
+    assert response.status_code == 401
+    for seconds in ("abc", "0", "3600"):
+        response = await test_client.post(
+            f"/admin/profile?seconds={seconds}", headers=headers
+        )
+        assert response.status_code == 400
+
+    async def busy_loop():
+        # Keeps the event loop thread busy, like a slow handler would
+        await asyncio.sleep(0.05)
+        busy_wait(0.3)
+
+    first = asyncio.create_task(
+        test_client.post("/admin/profile?seconds=0.5", headers=headers)
+    )
+    await asyncio.sleep(0.02)
+    second = await test_client.post("/admin/profile?seconds=0.5", headers=headers)
+    assert second.status_code == 409
+    await busy_loop()
+    response = await first
+    assert response.status_code == 200
+    assert int(response.headers["X-Profile-Samples"]) > 10
+    assert float(response.headers["X-Profile-Overhead"]) < 0.05
+    stacks = {}
+    for line in (await response.get_data(as_text=True)).splitlines():
+        stack, count = line.rsplit(" ", 1)
+        stacks[stack] = int(count)
+    busy = [s for s in stacks if s.endswith("test_1:busy_wait")]
+    assert busy and busy[0].startswith("MainThread;")
+    assert "restarter.test_1:test_admin_profile.<locals>.busy_loop" in busy[0]
+    assert sum(stacks[s] for s in busy) > 5
+
+
+@pytest.fixture
+def fresh_looplag():
+    looplag.reset()
+    yield
+    looplag.reset()
+
+
+def test_looplag_histogram(fresh_looplag):
+    for lag in (0.0005, 0.003, 0.003, 0.04, 9):
+        looplag.observe(lag)
+    snap = looplag.snapshot()
+    counts = {b["le_ms"]: b["count"] for b in snap["histogram"] if b["count"]}
+    assert counts == {1: 1, 5: 2, 50: 1, None: 1}
+    assert snap["p50_ms"] == 5
+    assert snap["p99_ms"] == 9000
+    assert snap["max_ms"] == 9000
+
+
+@pytest.mark.asyncio
+async def test_looplag_watchdog_logs_blocking_stack(fresh_looplag, caplog):
+    looplag.start(interval=0.02, threshold=0.1)
+    try:
+        await asyncio.sleep(0.1)
+        busy_wait(0.4)
+        await asyncio.sleep(0.05)
+    finally:
+        await looplag.stop()
+    snap = looplag.snapshot()
+    assert snap["samples"] > 3
+    assert snap["max_ms"] >= 300
+    # One report for the one stall, however long it lasted
+    assert snap["stalls"] == 1
+    stack = snap["recent_stalls"][0]["stack"]
+    assert "busy_wait" in stack
+    assert "test_looplag_watchdog_logs_blocking_stack" in stack
+    [record] = [r for r in caplog.records if r.name == "restarter.loop"]
+    assert record.levelno == logging.WARNING
+    assert record.stack == stack
+
+
+def test_serve_runtime_falls_back(caplog):
+    assert serve.runtime_options("standard") == {"loop": "asyncio", "http": "h11"}
+    options = serve.runtime_options(
+        "fast", installed=lambda name: None if name == "uvloop" else name
+    )
+    assert options["loop"] == "asyncio"
+    assert options["http"] == "httptools"
+    assert options["limit_concurrency"] == serve.RUNTIMES["fast"]["limit_concurrency"]
+    assert "uvloop isn't installed" in caplog.text
+
+
+def test_serve_imports_the_app_only_in_workers(monkeypatch):
+    # A fresh interpreter, as the master is: restarter is already loaded here
+    code = "import sys, serve; assert 'restarter' not in sys.modules, sys.modules"
+    root = os.path.dirname(serve.__file__)
+    subprocess.run([sys.executable, "-c", code], cwd=root, check=True)
+
+    calls = []
+    monkeypatch.setattr("uvicorn.run", lambda *args, **kw: calls.append((args, kw)))
+    serve.main(["--workers", "2"])
+    [((target,), options)] = calls
+    assert options["factory"] and options["workers"] == 2
+    module, _, name = target.partition(":")
+    assert getattr(__import__(module), name)() is app
+
+
+@pytest.mark.asyncio
+async def test_data_migration_resumes_after_crash(test_app, db):
+    seen = []
+    crash = [True]
+
+    def step(conn, cursor, limit):
+        # Three rows per batch; the third batch dies once, mid-transaction
+        ids = list(range((cursor or 0) + 1, min((cursor or 0) + 3, 10) + 1))
+        conn.execute(
+            "INSERT INTO monitor_tag (user_id, tag, monitor_id) "
+            "SELECT 1, 'migrated', value FROM json_each(:ids)",
+            {"ids": json.dumps(ids)},
+        )
+        if ids[0] == 7 and crash[0]:
+            crash[0] = False
+            raise RuntimeError("worker killed")
+        seen.extend(ids)
+        return (ids[-1] if ids[-1] < 10 else None), len(ids)
+
+    migration = datamigrations.DataMigration("test_numbers", step)
+    with pytest.raises(RuntimeError):
+        await datamigrations.run_migration(migration, pause=0)
+    status = (await datamigrations.status())["test_numbers"]
+    assert status["cursor"] == 6 and status["batches"] == 2
+    assert status["finished_at"] is None
+
+    assert await datamigrations.run_migration(migration, pause=0) == 4
+    status = (await datamigrations.status())["test_numbers"]
+    assert status["rows"] == 10 and status["finished_at"] is not None
+    assert seen == list(range(1, 11))
+    # The failed batch left nothing behind
+    tagged = await hotpath.run(
+        lambda conn: conn.execute(
+            "SELECT monitor_id FROM monitor_tag ORDER BY monitor_id"
+        ).fetchall()
+    )
+    assert [m for (m,) in tagged] == list(range(1, 11))
+    # Done is done
+    assert await datamigrations.run_migration(migration) == 0
+
+
+@pytest.mark.asyncio
+async def test_compact_webhook_json_migration(test_app, db):
+    old = [
+        (json.dumps({"X-Token": "abc"}), json.dumps({"a": 1, "b": "é"})),
+        ("{}", None),
+        ("not json", '{"already":"compact"}'),
+    ]
+    await hotpath.run(
+        lambda conn: conn.executemany(
+            "INSERT INTO webhook (monitor_id, url, method, headers, form_fields) "
+            "VALUES (1, 'https://example.com', 'post', ?, ?)",
+            old,
+        )
+    )
+    assert await datamigrations.run_migration(datamigrations.REGISTRY[0]) == 3
+    rows = await hotpath.run(
+        lambda conn: conn.execute(
+            "SELECT headers, form_fields FROM webhook ORDER BY id"
+        ).fetchall()
+    )
+    assert [tuple(r) for r in rows] == [
+        (codec.dumps({"X-Token": "abc"}), codec.dumps({"a": 1, "b": "é"})),
+        ("{}", None),
+        ("not json", '{"already":"compact"}'),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_read_connections_are_read_only(test_app, sample_user, test_user_key):
+    assert (await get_user_by_user_key(test_user_key))["email"] == "foo@bar.com"
+    async with database.get_read_engine().connect() as conn:
+        with pytest.raises(sa.exc.OperationalError, match="readonly"):
+            await conn.execute(text("DELETE FROM user"))
+    with pytest.raises(sqlite3.OperationalError, match="readonly"):
+        await hotpath.read(lambda conn: conn.execute("DELETE FROM user"))
+    # Readers see what the writer commits
+    await database.insert_user("new@bar.com", "x", "N" * 32)
+    assert await get_user_by_user_key("N" * 32)
+
+
+@pytest.mark.asyncio
+async def test_export_does_not_hold_a_read_connection(expired_monitor, test_user_key):
+    user = await get_user_by_user_key(test_user_key)
+    rows = database.iter_monitors_for_export(user["id"])
+    assert (await anext(rows))["slug"] == "m1"
+    # Mid-download, the pool API reads use is untouched
+    assert database.get_read_engine().pool.checkedout() == 0
+    with pytest.raises(sa.exc.OperationalError, match="readonly"):
+        async with database.get_export_engine().connect() as conn:
+            await conn.execute(text("DELETE FROM user"))
+    await rows.aclose()
+
+
+def test_batch_sizer_adapts():
+    sizer = maintenance.BatchSizer(size=100, max_lock=0.1, minimum=10, maximum=400)
+    sizer.update(0.5)
+    assert sizer.size == 50
+    sizer.update(0.05)  # within budget, leave it
+    assert sizer.size == 50
+    for _ in range(5):
+        sizer.update(0.001)
+    assert sizer.size == 400
+    for _ in range(10):
+        sizer.update(1)
+    assert sizer.size == 10
+
+
+@pytest.mark.asyncio
+async def test_maintenance_purges_and_compacts(sample_user, test_user_key, test_app):
+    dbfile = test_app.config["DATABASE"]
+    await database.get_engine().dispose()
+    with closing(sqlite3.connect(dbfile, isolation_level=None)) as conn:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+        conn.execute(
+            "INSERT INTO user (id, email, password, user_key, deleted_at) "
+            "VALUES (99, 'gone@bar.com', 'x', 'GONE', '2020-01-01 00:00:00')"
+        )
+        conn.execute("BEGIN")
+        for i in range(1500):
+            conn.execute(
+                "INSERT INTO monitor (id, user_id, name, slug, frequency, "
+                "expires_at, api_key) VALUES (?, 99, ?, ?, 60, 0, ?)",
+                (1000 + i, "x" * 500, f"s{i}", f"G{i}"),
+            )
+            conn.execute(
+                "INSERT INTO webhook (monitor_id, url, method) "
+                "VALUES (?, 'https://foo2.com', 'post')",
+                (1000 + i,),
+            )
+        conn.execute(
+            "INSERT INTO webhook (monitor_id, url, method) "
+            "VALUES (424242, 'https://orphan.com', 'post')"
+        )
+        conn.execute(
+            "INSERT INTO webhook_attempt (webhook_id, attempted_at, host, "
+            "duration_ms) VALUES (424242, 0, 'orphan.com', 1)"
+        )
+        conn.execute(
+            "INSERT INTO outbox (webhook_ids, url, method, created_at, "
+            "available_at, done_at) VALUES ('[1]', 'https://foo2.com', 'post', "
+            "0, 0, 1)"
+        )
+        conn.execute("COMMIT")
+    user = await get_user_by_user_key(test_user_key)
+    await database.insert_monitor(user["id"], "keep", "KEEPKEY", 60, "keep")
+
+    report = await maintenance.run_maintenance(
+        user_retention=0, outbox_retention=0, pause=0
+    )
+
+    assert report.users == 1
+    assert report.monitors == 1500
+    assert report.webhooks == 1501
+    assert report.attempts == 1
+    assert report.outbox == 1
+    assert report.pages_reclaimed > 0
+    assert await get_monitor_by_key("KEEPKEY") is not None
+    assert await get_user_by_user_key("GONE") is None
+    with closing(sqlite3.connect(dbfile)) as conn:
+        assert conn.execute("PRAGMA freelist_count").fetchone() == (0,)
+
+
+@pytest.mark.asyncio
+async def test_writes_share_the_hot_path_writer(
+    monkeypatch, expired_monitor, test_user_key
+):
+    user = await get_user_by_user_key(test_user_key)
+    delivery = {
+        "webhook_ids": [expired_monitor],
+        "url": "https://foo2.com",
+        "method": "post",
+        "headers": {},
+        "form_fields": {},
+    }
+    await hotpath.enqueue_deliveries([delivery])
+
+    def no_engine():
+        raise AssertionError("wrote outside the hot-path thread")
+
+    monkeypatch.setattr(database, "get_engine", no_engine)
+
+    async def outbox():
+        for _ in range(20):
+            for row in await database.claim_outbox(lease_seconds=0):
+                await database.retry_outbox(row["id"], row["lease_token"], 0, "x")
+
+    async def pause():
+        for _ in range(20):
+            await database.set_paused(user["id"], database.PAUSED_INDEFINITELY)
+            await database.set_paused(user["id"], None)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        *(hotpath.update_monitor("KEY1") for _ in range(200)),
+        outbox(),
+        pause(),
+        maintenance.run_maintenance(pause=0),
+        database.upsert_monitors(
+            user["id"],
+            [
+                {
+                    "name": "n",
+                    "slug": f"bulk-{i}",
+                    "frequency": 60,
+                    "schedule": None,
+                    "grace": None,
+                    "api_key": f"BULK{i:012d}",
+                    "webhooks": [],
+                }
+                for i in range(100)
+            ],
+        ),
+    )
+    # No "database is locked", and nothing waited out a busy timeout
+    assert results[:200] == [results[0]] * 200 and results[0]
+    assert time.perf_counter() - start < 5
+
+
+def sql_statements(module):
+    """(function or constant name, SQL) for every SQL string literal in a module."""
+    with open(module.__file__) as f:
+        tree = ast.parse(f.read())
+    found = []
+    for scope in ast.walk(tree):
+        if isinstance(scope, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            name = scope.name
+        elif isinstance(scope, ast.Assign) and scope in tree.body:
+            name = scope.targets[0].id
+        else:
+            continue
+        for node in ast.walk(scope):
+            if (
+                isinstance(node, ast.Constant)
+                and isinstance(node.value, str)
+                and re.match(r"(SELECT|INSERT|UPDATE|DELETE) ", node.value)
+            ):
+                found.append((name, node.value))
+    return found
+
+
+# Full scans that are inherent to the statement, by function and table
+ALLOWED_SCANS = {
+    # a single row
+    "current_revision": {"alembic_version"},
+    # finding orphans means visiting every webhook; maintenance does it in
+    # small batches over the covering monitor_id index
+    "purge_orphan_webhooks": {"webhook"},
+    "purge_orphan_attempts": {"webhook_attempt"},
+    # a row per data migration
+    "LIST_MIGRATIONS": {"data_migration"},
+}
+
+
+@pytest.fixture(scope="module")
+def migrated_db(tmp_path_factory):
+    dbfile = str(tmp_path_factory.mktemp("plans") / "plans.db")
+    saved = app.config.get("DATABASE")
+    app.config["DATABASE"] = dbfile
+    try:
+        restarter.upgrade_schema(dbfile)
+    finally:
+        app.config["DATABASE"] = saved
+    with closing(sqlite3.connect(dbfile)) as conn:
+        hotpath.add_functions(conn)
+        yield conn
+
+
+@pytest.mark.parametrize(
+    "function,sql",
+    [
+        pytest.param(f, sql, id=f"{module.__name__}.{f}")
+        for module in (database, hotpath, attempts, datamigrations)
+        for f, sql in sql_statements(module)
+    ],
+)
+def test_query_plan_has_no_full_scan(migrated_db, function, sql):
+    # Expanding bindparams ("IN :ids") need parentheses in raw SQLite
+    sql = re.sub(r"\bIN :(\w+)", r"IN (:\1)", sql)
+    params = dict.fromkeys(re.findall(r"(?<!:):(\w+)", sql))
+    plan = migrated_db.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+    tables = {
+        name
+        for (name,) in migrated_db.execute(
+            "SELECT name FROM sqlite_master WHERE type='table'"
+        )
+    }
+    scans = {
+        m[1]
+        for *_, detail in plan
+        if (m := re.match(r"SCAN (\w+)", detail)) and m[1] in tables
+    }
+    assert scans <= ALLOWED_SCANS.get(function, set()), [row[3] for row in plan]
+
+
+def test_fragment_cache_versions_and_evicts():
+    cache = fragments.FragmentCache(max_bytes=10)
+    cache.put("a", 1, "aaaa")
+    cache.put("b", 1, "bbbb")
+    assert cache.get("a", 1) == "aaaa"
+    assert cache.get("a", 2) is None  # stale version
+    cache.put("c", 1, "cccc")  # over the bound: b was least recently used
+    assert cache.get("b", 1) is None
+    assert cache.get("a", 1) == "aaaa"
+    assert cache.size == 8 and len(cache) == 2
+    cache.put("d", 1, "d" * 11)  # bigger than the whole cache
+    assert cache.get("d", 1) is None and cache.size == 8
+
+
+@pytest.mark.asyncio
+async def test_dashboard_etag_and_invalidation(
+    test_app, sample_user, test_user_key, monkeypatch
+):
+    monkeypatch.setattr(fragments, "caches", {})
+    user = await get_user_by_user_key(test_user_key)
+    await database.insert_monitor(user["id"], "backups", "PINGKEY", 60, "backups")
+    test_client = test_app.test_client()
+    async with test_client.session_transaction() as sess:
+        sess["logged_in"] = True
+        sess["user_id"] = user["id"]
+
+    response = await test_client.get("/")
+    assert response.status_code == 200
+    assert "Awaiting first check!" in await response.get_data(as_text=True)
+    etag = response.headers["ETag"]
+
+    response = await test_client.get("/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    cache = fragments.caches["dashboard"]
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # Pings don't change the page; it fetches the last checks separately
+    response = await test_client.get("/dashboard/checks")
+    assert await response.get_json() == {"backups": None}
+    for _ in range(2):
+        assert await hotpath.update_monitor("PINGKEY")
+        response = await test_client.get("/", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+    assert (cache.hits, cache.misses) == (3, 1)
+    response = await test_client.get("/dashboard/checks")
+    assert response.headers["Cache-Control"] == "no-store"
+    assert time.time() - (await response.get_json())["backups"] < 5
+
+    # Adding a monitor does
+    await database.insert_monitor(user["id"], "other", "OTHERKEY", 60, "other")
+    response = await test_client.get("/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert cache.misses == 2
+
+    async with test_client.session_transaction() as sess:
+        sess.clear()
+    response = await test_client.get("/dashboard/checks")
+    assert response.status_code == 401
+
+
+@pytest.mark.asyncio
+async def test_static_fingerprint_and_precompressed(test_app, tmp_path, monkeypatch):
+    (tmp_path / "app.css").write_text("body { color: black; }\n" * 200)
+    (tmp_path / "logo.jpg").write_bytes(os.urandom(1024))
+    results = {path: written for path, _, written in assets.precompress(tmp_path)}
+    assert ".gz" in results[str(tmp_path / "app.css")]
+    assert results[str(tmp_path / "logo.jpg")] == {}  # not worth it
+    monkeypatch.setattr(test_app, "static_folder", str(tmp_path))
+
+    async with test_app.test_request_context("/"):
+        url = quart.url_for("static", filename="app.css")
+    assert "v=" + assets.fingerprint(str(tmp_path / "app.css")) in url
+
+    test_client = test_app.test_client()
+    response = await test_client.get(url, headers={"Accept-Encoding": "gzip"})
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Content-Type"].startswith("text/css")
+    assert "immutable" in response.headers["Cache-Control"]
+    body = gzip.decompress(await response.get_data())
+    assert body == (tmp_path / "app.css").read_bytes()
+
+    response = await test_client.get("/static/app.css?v=stale")
+    assert "Content-Encoding" not in response.headers
+    assert "immutable" not in response.headers["Cache-Control"]
+
+
+async def _asgi_get(app, accept="gzip"):
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "path": "/",
+        "headers": [(b"accept-encoding", accept.encode())],
+    }
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    headers = dict(sent[0]["headers"])
+    return headers, b"".join(m.get("body", b"") for m in sent[1:])
+
+
+@pytest.mark.asyncio
+async def test_compression_middleware_streams_large_responses():
+    line = b'{"name": "backups", "slug": "backups"}\n'
+
+    async def export(scope, receive, send):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [
+                    (b"content-type", b"application/x-ndjson"),
+                    (b"etag", b'"abc"'),
+                ],
+            }
+        )
+        for _ in range(100):
+            await send({"type": "http.response.body", "body": line, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    middleware = CompressionMiddleware(export, minimum_size=1024)
+    headers, body = await _asgi_get(middleware)
+    assert headers[b"content-encoding"] == b"gzip"
+    assert headers[b"etag"] == b'W/"abc"'
+    assert gzip.decompress(body) == line * 100
+    assert len(body) < len(line) * 10
+
+    # Small bodies and clients that don't accept gzip are left alone
+    async def small(scope, receive, send):
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"application/json")],
+            }
+        )
+        await send({"type": "http.response.body", "body": b"{}", "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    headers, body = await _asgi_get(CompressionMiddleware(small))
+    assert b"content-encoding" not in headers and body == b"{}"
+    headers, body = await _asgi_get(middleware, accept="identity")
+    assert b"content-encoding" not in headers and body == line * 100
@@ -0,0 +1,107 @@
+"""Run the app under uvicorn with one of two runtime profiles.
+
+Usage: python -m serve [--runtime standard|fast] [uvicorn options]
+
+- standard: the asyncio event loop and the h11 parser, with uvicorn's own
+  defaults for everything else. It's what the service has always run,
+  pinned so that installing the speedups extra doesn't change it.
+- fast: uvloop and httptools, from the speedups extra. Falls back to
+  asyncio or h11, with a warning, for whichever isn't installed. Also sets:
+  - a listen backlog of 1024. Connections beyond --limit-concurrency wait
+    there, and a longer queue only holds clients until they time out.
+  - keep-alive of 30s instead of 5s, so the Fly proxy reuses connections to
+    the worker instead of reconnecting between bursts of pings.
+  - --limit-concurrency of 512 per worker. uvicorn answers connections past
+    it with a 503 straight away, before the app sees them. That's a cap on
+    memory; it sits above the ping admission limit, which sheds with a
+    Retry-After first.
+
+The runtime defaults to $FLYRESTARTER_RUNTIME, or standard.
+
+This module sits outside the restarter package so that the master process,
+which only binds the socket and supervises the workers, never imports the
+app: `python -m restarter.something` would run restarter/__init__.py, and
+with it every import and setup the app does, before spawning the workers
+that each do it all again. The workers load it through create_app.
+"""
+
+import argparse
+import importlib.util
+import logging
+import os
+
+logger = logging.getLogger("restarter.serve")
+
+RUNTIMES = {
+    "standard": {"loop": "asyncio", "http": "h11"},
+    "fast": {
+        "loop": "uvloop",
+        "http": "httptools",
+        "backlog": 1024,
+        "timeout_keep_alive": 30,
+        "limit_concurrency": 512,
+    },
+}
+# What to use when the module a runtime asks for isn't installed
+FALLBACKS = {"uvloop": "asyncio", "httptools": "h11"}
+
+
+def runtime_options(runtime, installed=importlib.util.find_spec):
+    """uvicorn options for a runtime, with missing implementations replaced."""
+    options = dict(RUNTIMES[runtime])
+    for key in ("loop", "http"):
+        if options[key] in FALLBACKS and installed(options[key]) is None:
+            logger.warning(
+                "%s isn't installed, using %s", options[key], FALLBACKS[options[key]]
+            )
+            options[key] = FALLBACKS[options[key]]
+    return options
+
+
+def create_app():
+    """Worker factory for uvicorn: the app is imported in each worker."""
+    from restarter import app
+
+    return app
+
+
+def main(argv=None):
+    import uvicorn
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--runtime",
+        choices=sorted(RUNTIMES),
+        default=os.environ.get("FLYRESTARTER_RUNTIME", "standard"),
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--log-config")
+    # Override the runtime's settings
+    parser.add_argument("--backlog", type=int)
+    parser.add_argument("--timeout-keep-alive", type=int)
+    parser.add_argument("--limit-concurrency", type=int)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    options = runtime_options(args.runtime)
+    for key in ("backlog", "timeout_keep_alive", "limit_concurrency"):
+        if getattr(args, key) is not None:
+            options[key] = getattr(args, key)
+    if args.log_config:
+        # Otherwise uvicorn's own logging config
+        options["log_config"] = args.log_config
+    logger.info("Serving with the %s runtime: %s", args.runtime, options)
+    uvicorn.run(
+        "serve:create_app",
+        factory=True,
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        **options,
+    )
+
+
+if __name__ == "__main__":
+    main()